@@ -1,19 +1,46 @@
+import csv
+import hashlib
 import os
+from datetime import date
+from functools import wraps
 
 from flask import Flask, render_template, request, redirect, flash, jsonify
-from flask import session, g
-from sqlalchemy.exc import IntegrityError
-
-# import text so we can use fstrings in our filter/sort queries
-from sqlalchemy.sql import text
+from flask import session, g, Response, stream_with_context, make_response
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy import event
 
 from flask_debugtoolbar import DebugToolbarExtension
 from flask_cors import CORS
+from requests import RequestException
 
 from forms import (UserAddForm, LoginForm, UserEditForm, 
-                    UserDeleteForm, MovieAddEditForm )
-from models import db, connect_db, User, Movie
-from services import movie_search, movie_search_by_id
+                    UserDeleteForm, MovieAddEditForm, PLATFORM_CHOICES )
+from models import db, connect_db, User, Movie, Title
+from backends import dialect, engine_options
+import replicas
+import shards
+from fragments import fragment_cache, FRAGMENT_FIELDS
+from streaming import STREAM_BATCH_SIZE, Rows, Later, stream_page
+import assets
+import metrics
+import query_budget
+from query_budget import max_queries, allow_repeats
+import profiler
+import slow_queries
+import traffic_capture
+from ledger_io import (LEDGER_FIELDS, EXPORT_FORMATS, EXPORT_BATCH_SIZE,
+                    gzip_chunks, open_ledger, restore_ledger)
+import search_index
+from search_index import title_index, PAGE_SIZE
+import popularity
+from popularity import leaderboards, ledger_points, changes
+import recommendations
+from recommendations import recommender
+import ledger_cache
+from ledger_cache import ledgers
+import similar
+from similar import similar_titles
+from services import movie_search, movie_search_by_id, api_configured
 
 app = Flask(__name__)
 cors = CORS()
@@ -23,16 +50,118 @@ cors = CORS()
 app.config['SQLALCHEMY_DATABASE_URI'] = (
     os.environ.get('DATABASE_URL', 'postgresql:///movie_ledger'))
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# read replicas, comma separated urls.  GET requests read from them (see
+# replicas.py).
+app.config['SQLALCHEMY_REPLICA_URIS'] = [
+    url for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url]
+app.config['REPLICA_MAX_LAG'] = float(os.environ.get('REPLICA_MAX_LAG', 2))
+app.config['REPLICA_STICKY_SECONDS'] = float(os.environ.get('REPLICA_STICKY_SECONDS', 10))
+# more databases to spread users over, comma separated urls, the main
+# database is the first shard (see shards.py)
+app.config['SQLALCHEMY_SHARD_URIS'] = [
+    url for url in os.environ.get('DATABASE_SHARD_URLS', '').split(',') if url]
+# each serving thread needs its own connection (see gunicorn.conf.py).
+# sqlite (see backends.py) gets no pool settings.
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(
+    app.config['SQLALCHEMY_DATABASE_URI'],
+    pool_size=int(os.environ.get('DB_POOL_SIZE', 5)))
 app.config['SQLALCHEMY_ECHO'] = True
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+# the tests turn this down, hashing passwords is most of their run time
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+# if set, /metrics needs "Authorization: Bearer <METRICS_TOKEN>"
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+# profiling (see profiler.py): requests with "X-Profile: <PROFILER_TOKEN>"
+# and PROFILE_SAMPLE_RATE of the rest are profiled, /admin/profiles
+# needs the token
+app.config['PROFILER_TOKEN'] = os.environ.get('PROFILER_TOKEN')
+app.config['PROFILE_SAMPLE_RATE'] = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+# log statements slower than this many seconds, with a sample of their
+# plans (see slow_queries.py), unset logs none
+if os.environ.get('SLOW_QUERY_SECONDS'):
+    app.config['SLOW_QUERY_SECONDS'] = float(os.environ['SLOW_QUERY_SECONDS'])
+app.config['SLOW_QUERY_EXPLAIN_RATE'] = float(os.environ.get('SLOW_QUERY_EXPLAIN_RATE', 0.1))
+# append a sanitized record of TRAFFIC_CAPTURE_RATE of requests to this
+# file, for replay_traffic.py (see traffic_capture.py), unset records none
+app.config['TRAFFIC_CAPTURE_FILE'] = os.environ.get('TRAFFIC_CAPTURE_FILE')
+app.config['TRAFFIC_CAPTURE_RATE'] = float(os.environ.get('TRAFFIC_CAPTURE_RATE', 1))
+if os.environ.get('TRAFFIC_CAPTURE_SALT'):
+    app.config['TRAFFIC_CAPTURE_SALT'] = os.environ['TRAFFIC_CAPTURE_SALT']
+# how many rendered movie fragments to keep around, 0 turns the cache off
+app.config['FRAGMENT_CACHE_SIZE'] = int(os.environ.get('FRAGMENT_CACHE_SIZE', 10000))
+# where `python recommendations.py build` writes the model workers serve
+app.config['RECOMMENDATIONS_FILE'] = os.environ.get(
+    'RECOMMENDATIONS_FILE', recommendations.DEFAULT_FILE)
+# and where `python similar.py build` writes the similar titles index
+app.config['SIMILAR_TITLES_FILE'] = os.environ.get(
+    'SIMILAR_TITLES_FILE', similar.DEFAULT_FILE)
+# how many movies of busy users' ledgers to keep in memory, 0 turns the
+# cache off (see ledger_cache.py)
+app.config['LEDGER_CACHE_ROWS'] = int(os.environ.get(
+    'LEDGER_CACHE_ROWS', ledger_cache.DEFAULT_MAX_ROWS))
 
 
 connect_db(app)
 
+# route reads to the replicas, the primary keeps the writes
+replicas.init_app(app, db)
+
+# and each user's statements to the shard they live in
+shards.init_app(app)
+
+# fingerprinted static urls and compression, set up before the debug
+# toolbar so compression runs after the toolbar edits the html
+assets.init_app(app)
+
+# request timing and query budgets, set up before add_user_to_g so its
+# query is counted
+metrics.init_app(app)
+query_budget.init_app(app)
+profiler.init_app(app)
+slow_queries.init_app(app)
+traffic_capture.init_app(app)
+
 toolbar = DebugToolbarExtension(app)
 
+# templates wrap per-movie markup in {% call cached_fragment(...) %}
+fragment_cache.maxsize = app.config['FRAGMENT_CACHE_SIZE']
+app.jinja_env.globals['cached_fragment'] = fragment_cache
+
+# keep the local title index (see search_index.py) up to date
+search_index.init_app(app)
+
+# keep title popularity counters for the leaderboards
+popularity.init_app(app)
+
+# serve co-occurrence recommendations, kept up with ledger writes
+recommendations.init_app(app)
+
+# and similar titles, by cast and year
+similar.init_app(app)
+
+# keep ledgers in memory for sorting and filtering, up with writes
+ledger_cache.init_app(app)
+
+
+@event.listens_for(Title, "after_update")
+def invalidate_title_fragments(mapper, connection, target):
+    """Drop the cached fragments for a title when its catalog row changes."""
+
+    fragment_cache.invalidate(target.imdb_id)
+
 CURR_USER_KEY = "curr_user"
+CURR_SHARD_KEY = "curr_shard"
+
+# the columns a ledger export is built from.  the title fields are
+# hybrids on Movie, so these resolve to the joined titles columns.
+EXPORT_COLUMNS = [getattr(Movie, field) for field in LEDGER_FIELDS]
+
+# the columns the ledger page shows, read as plain rows (see
+# show_my_movies).  labelled, so templates read row.title like they
+# would movie.title.
+LEDGER_PAGE_COLUMNS = [getattr(Movie, field).label(field)
+                       for field in FRAGMENT_FIELDS["ledger-item"]]
 
 ###############################################################################
 # do this before every request!
@@ -43,8 +172,15 @@ def add_user_to_g():
 
     # g.user will contain movies as well, since we set up the relationship in our model
     if CURR_USER_KEY in session:
+        shards.use(session.get(CURR_SHARD_KEY))
         g.user = User.query.get(session[CURR_USER_KEY])
 
+        # they were moved to another shard since they logged in
+        if g.user is None and shards.shard_map.enabled:
+            session[CURR_SHARD_KEY] = shards.shard_of(session[CURR_USER_KEY])
+            shards.use(session[CURR_SHARD_KEY])
+            g.user = User.query.get(session[CURR_USER_KEY])
+
     else:
         g.user = None
 
@@ -52,6 +188,64 @@ def add_user_to_g():
     # print("From app.before_request, g.user: ", g.user)
     # print("***************\n")
 
+###############################################################################
+# conditional GETs for pages built from the user's ledger
+
+def ledger_etag():
+    """Build the ETag for the current request from the user's ledger version.
+
+    The version changes on every ledger write, the path and query string
+    tell the different views/sorts apart, and the csrf token in the
+    session keeps a cached page's forms valid.
+    """
+
+    key = ":".join((str(g.user.id),
+                    str(g.user.ledger_version),
+                    request.full_path,
+                    session.get("csrf_token", "")))
+
+    return hashlib.sha1(key.encode("utf8")).hexdigest()
+
+
+def ledger_conditional(view):
+    """Answer GETs with a 304 when the user's ledger hasn't changed.
+
+    The check only needs g.user, which add_user_to_g already loaded, so
+    an unchanged ledger never touches the movies table.  Successful
+    responses get the ETag and Last-Modified headers.
+    """
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+
+        # nothing to validate against for anonymous users or writes
+        if not g.user or request.method != "GET":
+            return view(*args, **kwargs)
+
+        etag = ledger_etag()
+
+        # a pending flash message has to be rendered, so don't 304 it away
+        # compressed responses carry a weak version of the tag
+        if request.if_none_match.contains_weak(etag) and "_flashes" not in session:
+            resp = Response(status=304)
+        else:
+            resp = make_response(view(*args, **kwargs))
+
+            if resp.status_code != 200:
+                return resp
+
+        resp.set_etag(etag)
+        resp.last_modified = g.user.ledger_updated_at
+
+        # the browser may keep it, but has to check back with us each time
+        resp.cache_control.private = True
+        resp.cache_control.no_cache = True
+
+        return resp
+
+    return wrapper
+
+
 ###############################################################################
 # login, signup, logout
 
@@ -59,6 +253,7 @@ def do_login(user):
     """Log in user."""
 
     session[CURR_USER_KEY] = user.id
+    session[CURR_SHARD_KEY] = shards.current()
 
 
 def do_logout():
@@ -67,8 +262,12 @@ def do_logout():
     if CURR_USER_KEY in session:
         del session[CURR_USER_KEY]
 
+    session.pop(CURR_SHARD_KEY, None)
+
 
+# with shards, the shard map's insert and update are two more
 @app.route('/signup', methods=["GET", "POST"])
+@max_queries(4)
 def signup():
     """Handle user signup.
 
@@ -84,12 +283,16 @@ def signup():
 
     if form.validate_on_submit():
         try:
+            # with shards, the shard map hands out the id and the shard
+            user_id = shards.register(form.username.data)
+
             # send our user info to be registered
             u = User.signup(
                 username=form.username.data,
                 password=form.password.data,
                 email=form.email.data,
-                img_url=form.img_url.data # or User.img_url.default.arg
+                img_url=form.img_url.data, # or User.img_url.default.arg
+                id=user_id
             )
 
             db.session.commit()
@@ -110,6 +313,7 @@ def signup():
 
 
 @app.route('/login', methods=["GET", "POST"])
+@max_queries(2)
 def login():
     """Handle login of user.
     
@@ -119,6 +323,7 @@ def login():
     form = LoginForm()
 
     if form.validate_on_submit():
+        shards.use(shards.shard_of(username=form.username.data))
         u = User.authenticate(form.username.data, form.password.data)
 
         if u:
@@ -145,7 +350,9 @@ def logout():
 ###############################################################################
 # user routes
 
+# with shards, keeping the shard map's username is one more
 @app.route("/profile", methods=["GET", "POST"])
+@max_queries(5)
 def edit_profile():
     """Show/handle the user profile editing page.  Require auth!"""
 
@@ -175,6 +382,11 @@ def edit_profile():
                     newPW = User.hash_password(editForm.new_password.data)
                     u.password = newPW
 
+                # the username is shown on the ledger page
+                User.bump_ledger_version(u.id)
+                ledger_cache.track(u.id)
+                shards.rename(u.id, u.username)
+
                 # we do not need to db.session.add() since sqlalchemy 
                 # already has the user in memory        
                 db.session.commit()
@@ -193,7 +405,9 @@ def edit_profile():
     return render_template("profile.html", editForm=editForm, deleteForm=deleteForm, user=g.user)
 
 
+# with shards, taking the user off the shard map is one more
 @app.route('/profile/delete', methods=["POST"])
+@max_queries(8)
 def delete_profile():
     """Delete the current users information.  Require auth!"""
 
@@ -209,8 +423,19 @@ def delete_profile():
         u = User.authenticate(g.user.username, deleteForm.password.data)
 
         if u:
-            # need to use db.session.delete(obj) if we want the delete cascade to work
+            # delete the user's movies with a single statement, rather
+            # than having the relationship cascade load and delete them
+            # one by one (the relationship uses passive_deletes)
+            before = ledger_points(u.id)
+
+            Movie.query.filter_by(user_id=u.id).delete()
+
+            popularity.record(changes(before, {}))
+            recommendations.track(u.id, before, {})
+            ledger_cache.track(u.id, "reload")
+
             db.session.delete(u)
+            shards.forget(u.id)
             db.session.commit()
 
             do_logout()
@@ -227,29 +452,36 @@ def delete_profile():
 ###############################################################################
 # movie routes
 
-@app.route('/movies')
-def show_my_movies():
-    """Show all users movies, adding filters or sort if selected."""
+def ledger_options(args):
+    """Read the ledger filter and sort options from the query string.
 
-    if not g.user:
-        flash("Please login!", "danger")
-        return redirect("/login")
+    Returns (filters, kwargs, sort_str): the filter flags for our
+    template, the extra filter_by() **kwargs, and the sort as
+    "column [asc|desc]" (an empty string if there's no sort, see
+    ledger_query()).
+
+    The ledger page and the ledger exports both use this, so an export
+    always matches what the user is looking at.
+    """
 
     ##############################################
     # initialize
 
     # initialize our **kwargs for filter_by()
-    kwargs = {"user_id": g.user.id}
+    kwargs = {}
 
     # initalize our filter flags list to pass to our template
     filters = {}
 
+    # initialize our sort_str
+    sort_str = ""
+
     ##############################################
     # filter check
 
     # if there's a filter append to our filter_by() **kwargs
     # and also add to our filter flags list arg
-    if request.args.get('filter'):
+    if args.get('filter'):
 
         kwargs["favorite"] = True
         filters["filters"] = ['favorites']
@@ -257,55 +489,241 @@ def show_my_movies():
     ##############################################
     # sort check
 
-    # if there's a sort option, begin our sort_str
-    if request.args.get('sort'):
-
-        # initialize our sort_str
-        sort_str = ""
-
-        # append to our sort_str based on the query string arg
-        # and add to our filters flags list arg
-        if request.args['sort'] == "title":
-            sort_str = sort_str + "title"
-            filters["sort"] = 'title'
-        if request.args['sort'] == "year":
-            sort_str = sort_str + "year"
-            filters["sort"] = 'year'
-        if request.args['sort'] == "date_added":
-            sort_str = sort_str + "date_added"
-            filters["sort"] = 'date_added'
-        if request.args['sort'] == "date_viewed":
-            sort_str = sort_str + "date_viewed"
-            filters["sort"] = 'date_viewed'
+    # append to our sort_str based on the query string arg
+    # and add to our filters flags list arg.  only the known
+    # sort columns are accepted.
+    if args.get('sort') in LEDGER_SORTS:
+
+        sort_str = args['sort']
+        filters["sort"] = args['sort']
 
         # if there's an order, append the order to our sort_str
-        if request.args.get("order"):           
 
-            # ascending order
-            if request.args['order'] == "asc":
-                sort_str = sort_str + " asc"
-                filters["order"] = 'ascending'
+        # ascending order
+        if args.get('order') == "asc":
+            sort_str = sort_str + " asc"
+            filters["order"] = 'ascending'
+
+        # descending order
+        if args.get('order') == "desc":
+            sort_str = sort_str + " desc"
+            filters["order"] = 'descending'
+
+    return (filters, kwargs, sort_str)
+
+
+# the columns a ledger can be sorted on, by their name in the query string
+LEDGER_SORTS = {
+    "title": Title.title,
+    "year": Title.year,
+    "date_added": Movie.date_added,
+    "date_viewed": Movie.date_viewed,
+}
+
+
+def ledger_query(query, user_id, kwargs, sort_str):
+    """Apply a user's ledger filters and sort to a movies query.
+
+    title and year live on the shared titles catalog, so the catalog is
+    joined explicitly and the sort columns are always the titles table's
+    (until migrate_titles.py contract, movies has its own too).  They
+    sort by code point, like sqlite and the ledger cache (see
+    ledger_cache.py) do, whatever postgres' collation is.
+    """
+
+    query = query.filter_by(user_id=user_id, **kwargs).join(Movie.catalog)
+
+    if sort_str:
+        name, _, direction = sort_str.partition(" ")
+        column = LEDGER_SORTS[name]
+
+        if name in ("title", "year") and dialect(db.session) == "postgresql":
+            column = column.collate("C")
+
+        query = query.order_by(column.desc() if direction == "desc" else column.asc())
+
+    return query
+
+
+def recommended_titles(imdb_ids):
+    """Recommended imdb ids as api search results, for the templates.
+
+    Titles come from the local title index (see search_index.py), which
+    costs a query the first time a worker uses it.  Any it hasn't seen
+    are left out.
+    """
+
+    if not imdb_ids:
+        return []
+
+    title_index.ensure_loaded()
+
+    return [t for t in map(title_index.get, imdb_ids) if t]
+
+
+@app.route('/movies')
+@ledger_conditional
+@max_queries(3)
+def show_my_movies():
+    """Show all users movies, adding filters or sort if selected."""
+
+    if not g.user:
+        flash("Please login!", "danger")
+        return redirect("/login")
+
+    filters, kwargs, sort_str = ledger_options(request.args)
+
+    # just the columns the page shows, as lightweight named rows rather
+    # than Movie instances: no identity map, no change tracking, about a
+    # fifth of the memory and a third of the time per row on big ledgers.
+    # they're read off a server-side cursor while the page streams out
+    # (see streaming.py), so the list is never all in memory at once.
+    def read(kwargs, sort_str):
+        return (ledger_query(db.session.query(*LEDGER_PAGE_COLUMNS), g.user.id,
+                             kwargs, sort_str)
+                    .yield_per(STREAM_BATCH_SIZE))
+
+    # unless the ledger's in memory, read once and sorted and filtered
+    # there from then on (see ledger_cache.py).  ledgers too big to keep
+    # are streamed.
+    ledger = ledgers.get(g.user, lambda limit: read({}, "").limit(limit))
+
+    if ledger is not None:
+        rows = ledger.rows(kwargs, sort_str)
+    else:
+        rows = read(kwargs, sort_str)
+
+    imdb_ids = []
+
+    def listed(rows):
+        for row in rows:
+            imdb_ids.append(row.imdb_id)
+            yield row
+
+    # titles like the ones listed (see recommendations.py), shown after
+    # the list, so worked out once it's been sent
+    recommended = Later(lambda: recommended_titles(recommender.recommended(imdb_ids)))
+
+    # be sure to pass the necessary flags to the template
+    return stream_page('movies.html', user=g.user, movies=Rows(listed(rows)),
+                       filters=filters, recommended=recommended)
+
+
+def export_ledger(fmt):
+    """Stream the current user's ledger in the given ledger_io format.
 
-            # descending order
-            if request.args['order'] == "desc":
-                sort_str = sort_str + " desc"
-                filters["order"] = 'descending'
+    Rows come straight off a server-side cursor as plain tuples, so
+    memory stays flat no matter how big the ledger is.  If the client
+    accepts gzip, the stream is compressed as it goes.
+    """
+
+    if not g.user:
+        flash("Please login!", "danger")
+        return redirect("/login")
+
+    filters, kwargs, sort_str = ledger_options(request.args)
+
+    rows = (ledger_query(db.session.query(*EXPORT_COLUMNS), g.user.id, kwargs, sort_str)
+                .yield_per(EXPORT_BATCH_SIZE))
 
+    chunks = EXPORT_FORMATS[fmt]["write"](rows)
 
-        # WITH SORT TERM: make our final query using our built sort_str
-        movies = Movie.query.filter_by(**kwargs).order_by(text(sort_str)).all()
+    headers = {
+        "Content-Disposition": f'attachment; filename="movie-ledger.{fmt}"',
+        "Vary": "Accept-Encoding",
+    }
 
-        # be sure to pass the necessary flags to the template
-        return render_template('movies.html', user=g.user, movies=movies, filters=filters)
+    if "gzip" in request.headers.get("Accept-Encoding", ""):
+        chunks = gzip_chunks(chunks)
+        headers["Content-Encoding"] = "gzip"
 
+    # stream_with_context keeps our db session around until the
+    # generator has been fully sent
+    return Response(stream_with_context(chunks),
+                    mimetype=EXPORT_FORMATS[fmt]["mimetype"],
+                    headers=headers)
 
-    # NO SORT TERM: our final query with filter_by(**kwargs) only
-    movies = Movie.query.filter_by(**kwargs).all()
 
-    return render_template('movies.html', user=g.user, movies=movies, filters=filters)
+@app.route('/movies/export.csv')
+@ledger_conditional
+@max_queries(2)
+def export_movies_csv():
+    """Download the user's ledger (filtered and sorted) as csv."""
+
+    return export_ledger("csv")
+
+
+@app.route('/movies/export.ndjson')
+@ledger_conditional
+@max_queries(2)
+def export_movies_ndjson():
+    """Download the user's ledger (filtered and sorted) as ndjson."""
+
+    return export_ledger("ndjson")
     
 
+# internal api routes
+@app.route('/movies/restore', methods=["POST"])
+@max_queries(6)
+def restore_movies():
+    """Restore an exported ledger file into the current user's ledger.
+
+    Expects a multipart upload named "file" (.csv or .ndjson, optionally
+    .gz).  Rows are bulk loaded and merged, a movie already in the
+    ledger is updated to match the file.  Rows for titles that aren't in
+    the catalog are skipped, an upload never adds to it.
+    """
+
+    if not g.user:
+        return (jsonify({"message": "Please login!"}), 401)
+
+    upload = request.files.get("file")
+
+    if not upload or not upload.filename:
+        return (jsonify({"message": "No file sent"}), 400)
+
+    try:
+        records = open_ledger(upload.stream, upload.filename)
+    except ValueError as exc:
+        return (jsonify({"message": str(exc)}), 400)
+
+    try:
+        before = ledger_points(g.user.id)
+        counts = restore_ledger(records, user_id=g.user.id)
+        after = ledger_points(g.user.id)
+        popularity.record(changes(before, after))
+        recommendations.track(g.user.id, before, after)
+        ledger_cache.track(g.user.id, "reload")
+        db.session.commit()
+
+    # the COPY runs on the raw driver cursor, so driver errors come
+    # through as-is.  bad gzip and bad encodings are OSError/ValueError.
+    except (SQLAlchemyError, db.engine.dialect.dbapi.Error,
+            OSError, ValueError, csv.Error):
+        db.session.rollback()
+        return (jsonify({"message": "There was an error"}), 400)
+
+    resp = jsonify({"message": "success", **counts})
+
+    return (resp, 200)
+
+
+def catalog_fields(movie):
+    """A new Movie's title details, from an api result.
+
+    Every ledger with the title shares its catalog row (see Title), so
+    what goes in it comes from the api, never from what a user sent.
+    """
+
+    return {"title": movie["Title"],
+            "year": movie["Year"][0:4],
+            "actors": movie.get("Actors"),
+            "imdb_img": movie.get("Poster")}
+
+
 @app.route("/movie/<movie_id>", methods=["GET", "POST"])
+@ledger_conditional
+@max_queries(7)
 def handle_movie(movie_id):
     """Get a single movie based on the id.
     Add the movie if a post request is coming in.
@@ -350,8 +768,12 @@ def handle_movie(movie_id):
             m.platform=None if not form.platform.data else form.platform.data
             m.date_viewed=form.date_viewed.data
 
+            User.bump_ledger_version(g.user.id)
+
             db.session.commit()
 
+            fragment_cache.invalidate(movie_id)
+
             flash("Movie updated!", "success")
 
         # save a new movie
@@ -367,20 +789,30 @@ def handle_movie(movie_id):
             #   for value="" (different than date_viewed) and sqlalchemy will
             #   store that empty string in our db.
 
+            # the title's details come from the api, not the form's
+            # hidden fields (see catalog_fields)
+            try:
+                movie = movie_search_by_id(movie_id)
+            except Exception:
+                movie = {"Response": "False"}
+
+            if movie.get("Response") != "True":
+                flash("Sorry, we can't find the movie you are looking for.", "danger")
+                return redirect("/movie-search")
+
             m = Movie(imdb_id=movie_id,
                         user_id=g.user.id,
-                        title=form.title.data,
-                        year=form.year.data[0:4],
-                        actors=form.actors.data,
                         favorite=form.favorite.data,
                         platform=None if not form.platform.data else form.platform.data,
                         date_viewed=form.date_viewed.data,
-                        imdb_img=form.imdb_img.data
+                        **catalog_fields(movie)
                         )
 
             try:
                 db.session.add(m)
 
+                User.bump_ledger_version(g.user.id)
+
                 db.session.commit()
 
             except IntegrityError as exc:
@@ -401,23 +833,26 @@ def handle_movie(movie_id):
         # created in our js code
         movie = movie_search_by_id(movie_id)
 
+        if movie.get("Response") != "True":
+            return (jsonify({"message": "Movie not found"}), 404)
+
         # favorite will take the default value from our model
         # date_added will take the default from our model
         # date_viewed is optional so None <class 'NoneType'> will
         #   be our value and db field will be blank
         # platform is optional so None <class 'NoneType'> will
         #   be our value and db field will be blank
-        m = Movie(imdb_id=request.json["imdb_id"],
+        # the title's details come from the api too, not the request
+        m = Movie(imdb_id=movie_id,
                     user_id=g.user.id,
-                    title=request.json["title"],
-                    year=request.json["year"][0:4],
-                    actors=movie['Actors'],
-                    imdb_img=request.json["imdb_img"]
+                    **catalog_fields(movie)
                     )
 
         try:
             db.session.add(m)
 
+            User.bump_ledger_version(g.user.id)
+
             db.session.commit()
 
         except IntegrityError as exc:
@@ -476,19 +911,37 @@ def handle_movie(movie_id):
         form.date_viewed.data=movie_in_db.date_viewed
         form.date_added.data=movie_in_db.date_added
 
-    return render_template("movie-detail.html", form=form, movie=movie, movie_in_db=movie_in_db)
+    # "users who saved this also saved" (see recommendations.py)
+    also_saved = recommended_titles(recommender.also_saved(movie_id))
+
+    # and titles with the same cast around the same time (see similar.py)
+    similar_movies = recommended_titles(similar_titles.similar(movie_id))
+
+    return render_template("movie-detail.html", form=form, movie=movie, movie_in_db=movie_in_db,
+                           also_saved=also_saved, similar_movies=similar_movies)
 
 
 # internal api routes
 @app.route("/movie/<movie_id>", methods=["DELETE"])
+@max_queries(6)
 def delete_movie(movie_id):
     """Delete a movie from our db."""
 
+    before = ledger_points(g.user.id, [movie_id])
+
     # below we delete the item in sqlalchemy, but we need db.session.commit()
     Movie.query.filter_by(imdb_id=movie_id, user_id=g.user.id).delete()
 
+    popularity.record(changes(before, {}))
+    recommendations.track(g.user.id, before, {})
+    ledger_cache.track(g.user.id, "delete", [movie_id])
+
+    User.bump_ledger_version(g.user.id)
+
     db.session.commit()
 
+    fragment_cache.invalidate(movie_id)
+
     resp = jsonify({"message": "success"})
 
     return (resp, 200)
@@ -496,6 +949,7 @@ def delete_movie(movie_id):
 
 # internal api routes
 @app.route('/movie/<movie_id>/favorite', methods=["POST"])
+@max_queries(6)
 def add_remove_favorite(movie_id):
     """Add or remove a movie as a favorite"""
 
@@ -503,11 +957,158 @@ def add_remove_favorite(movie_id):
 
     m.favorite = not m.favorite
 
+    # hold on to the new value, reading m.favorite after the commit
+    # would reload the whole row
+    favorite = m.favorite
+
+    User.bump_ledger_version(g.user.id)
+
     db.session.commit();
 
+    fragment_cache.invalidate(movie_id)
+
     # send back our boolean value for "favorite"so we can 
     # keep the front end in sync with our database data
-    resp = jsonify({"message": "success", "favorite": m.favorite})
+    resp = jsonify({"message": "success", "favorite": favorite})
+
+    return (resp, 200)
+
+
+# the most imdb_ids a single batch operation may touch
+MAX_BATCH_IDS = 1000
+
+# the values each batch action writes, "delete" is handled on its own
+BATCH_ACTIONS = {
+    "delete": None,
+    "favorite": lambda value: {"favorite": True},
+    "unfavorite": lambda value: {"favorite": False},
+    "set-platform": lambda value: {"platform": value or None},
+    "set-date_viewed": lambda value: {
+        "date_viewed": date.fromisoformat(value) if value else None},
+}
+
+
+# the batch actions that change titles' popularity (see popularity.py)
+SCORED_BATCH_ACTIONS = {"delete", "favorite", "unfavorite"}
+
+
+def parse_batch_operation(op):
+    """Validate one batch operation and return (action, ids, values).
+
+    Raises ValueError with a message suitable for the client.
+    """
+
+    if not isinstance(op, dict):
+        raise ValueError("Each operation must be an object")
+
+    action = op.get("action")
+    ids = op.get("ids")
+
+    if action not in BATCH_ACTIONS:
+        raise ValueError(f"Unknown action: {action}")
+
+    if (not isinstance(ids, list) or not ids
+            or not all(isinstance(i, str) for i in ids)):
+        raise ValueError("ids must be a non-empty list of imdb ids")
+
+    if len(ids) > MAX_BATCH_IDS:
+        raise ValueError(f"A batch operation can have at most {MAX_BATCH_IDS} ids")
+
+    if action == "set-platform" and (not isinstance(op.get("value"), str)
+                                     or op.get("value") not in dict(PLATFORM_CHOICES)):
+        raise ValueError(f"Unknown platform: {op.get('value')}")
+
+    if action == "delete":
+        return (action, ids, None)
+
+    try:
+        values = BATCH_ACTIONS[action](op.get("value"))
+    except TypeError:
+        raise ValueError(f"Invalid date: {op.get('value')}")
+
+    # date.fromisoformat raises its own ValueError for a malformed date
+    return (action, ids, values)
+
+
+# internal api routes
+# one statement per operation (two on sqlite), however many there are
+@app.route('/movies/batch', methods=["POST"])
+@allow_repeats
+def batch_edit_movies():
+    """Apply many ledger edits in one request.
+
+    Expects json like:
+
+        {"operations": [
+            {"action": "favorite", "ids": ["tt0111161", "tt0068646"]},
+            {"action": "set-platform", "ids": ["tt0111161"], "value": "hulu"},
+            {"action": "delete", "ids": ["tt0050083"]}
+        ]}
+
+    Each operation runs as a single UPDATE or DELETE over all of its ids,
+    and all of the operations share one transaction.  The response lists
+    "ok" or "not found" for every id of every operation.
+    """
+
+    if not g.user:
+        return (jsonify({"message": "Please login!"}), 401)
+
+    data = request.get_json(silent=True)
+
+    if data is None:
+        data = {}
+
+    if not isinstance(data, dict):
+        return (jsonify({"message": "The batch must be an object"}), 400)
+
+    # a single operation can be sent without the "operations" wrapper
+    operations = data.get("operations", [data] if "action" in data else [])
+
+    if not operations:
+        return (jsonify({"message": "No operations sent"}), 400)
+
+    # validate everything up front so a bad operation doesn't leave
+    # the batch half applied
+    try:
+        parsed = [parse_batch_operation(op) for op in operations]
+    except ValueError as exc:
+        return (jsonify({"message": str(exc)}), 400)
+
+    results = []
+
+    try:
+        for action, ids, values in parsed:
+            scored = action in SCORED_BATCH_ACTIONS
+            before = ledger_points(g.user.id, ids) if scored else {}
+
+            if action == "delete":
+                found = Movie.batch_delete(g.user.id, ids)
+                ledger_cache.track(g.user.id, "delete", found)
+            else:
+                found = Movie.batch_update(g.user.id, ids, **values)
+                ledger_cache.track(g.user.id, "update", found, values)
+
+            if scored:
+                after = {} if action == "delete" else ledger_points(g.user.id, ids)
+                popularity.record(changes(before, after))
+                recommendations.track(g.user.id, before, after)
+
+            results.append({
+                "action": action,
+                "results": {i: "ok" if i in found else "not found" for i in ids}
+            })
+
+        User.bump_ledger_version(g.user.id)
+
+        db.session.commit()
+
+    except SQLAlchemyError:
+        db.session.rollback()
+        return (jsonify({"message": "There was an error"}), 500)
+
+    fragment_cache.invalidate(*(i for _, ids, _ in parsed for i in ids))
+
+    resp = jsonify({"message": "success", "results": results})
 
     return (resp, 200)
 
@@ -515,8 +1116,51 @@ def add_remove_favorite(movie_id):
 ###############################################################################
 # external api routes
 
+def search_titles(search_term, page):
+    """Get a page of search results, and whether there's a next page.
+
+    Asks the api first.  With no API_KEY, or when the api is down, our
+    local title index answers instead, and when the api finds nothing
+    the index gets a go too, with fuzzy matching that forgives typos.
+    Results from the index have "ml_local" set.
+    """
+
+    results = None
+
+    if api_configured():
+        try:
+            results = movie_search(search_term, page=page)
+
+            if results['Response'] == "True":
+                # based on the val of "Response" for the NEXT page we
+                # can render a next_page link or not
+                return (results, movie_search(search_term, page=page+1)['Response'])
+
+        except (RequestException, ValueError):
+            # we got this page, but not the next one
+            if results is not None and results['Response'] == "True":
+                return (results, "False")
+
+            app.logger.warning("movie search failed, using the title index", exc_info=True)
+
+    title_index.ensure_loaded()
+    local = title_index.search(search_term, page=page)
+
+    if local['Response'] != "True" and results is not None:
+        # the api's own error (e.g. "Too many results.") says more
+        return (results, "False")
+
+    local['ml_local'] = True
+    next_page = "True" if int(local['totalResults']) > page * PAGE_SIZE else "False"
+
+    return (local, next_page)
+
+
 # search movies from the omdb database.  must be logged in!
+#
+# the third query builds the title index, the first time it's used
 @app.route("/movie-search")
+@max_queries(3)
 def search_movies():
     """Get all the movies based on a search term from form data"""
      
@@ -539,10 +1183,11 @@ def search_movies():
         # if page > 1 then render our prev page when necessary.
         page = int(request.args['page']) if request.args.get('page') else 1 
 
-        # make the call to our external api
+        # make the call to our external api, or search our own title
+        # index if we can't (see search_titles)
         #
         # results will be a python dictionary (from services.py)
-        results_curr = movie_search(search_term, page=page)
+        results_curr, next_page = search_titles(search_term, page)
 
         # if we get an search results in our CURRENT api call, 
         # run a check to see if any of the returned results 
@@ -554,20 +1199,18 @@ def search_movies():
         # "Add to My List"  button or a note "Already in My List"
         if results_curr['Response'] == "True":
 
-            user_movies = [movie.imdb_id for movie in g.user.movies]
+            # only ask the db about the movies on this page of results,
+            # rather than loading the user's whole ledger
+            page_ids = [movie['imdbID'] for movie in results_curr['Search']]
+
+            user_movies = {imdb_id for (imdb_id,) in
+                            db.session.query(Movie.imdb_id)
+                                .filter(Movie.user_id == g.user.id,
+                                        Movie.imdb_id.in_(page_ids))}
 
             for movie in results_curr['Search']:
                 if movie['imdbID'] in user_movies:
                     movie["ml_inList"] = True
-        
-        # make the call to our external api for the NEXT page
-        #
-        # pass the "Rsponse" returned to our template
-        #
-        # based on the val of "Response" we can render a next_page link or not
-        results_next = movie_search(search_term, page=page+1)
-
-        next_page = results_next['Response']
 
         # render our template and pass the results of the api request
         # along with the search term (so we can create our search note)
@@ -576,14 +1219,32 @@ def search_movies():
         return render_template("movie-search.html", results=results_curr, search_term=search_term, page=page, next_page=next_page)
 
     # no search term submitted, so we just render our starting search  page
-    return render_template("movie-search.html", user=g.user)
+    return render_template("movie-search.html", user=g.user, popular=leaderboards.get())
+
+
+@app.route("/movie-search/suggest")
+@max_queries(2)
+def suggest_movies():
+    """Autocomplete titles we know for a partial search term, as json."""
+
+    if not g.user:
+        return (jsonify({"message": "Please login!"}), 401)
+
+    title_index.ensure_loaded()
+
+    suggestions = [{"imdbID": m['imdbID'], "Title": m['Title'], "Year": m['Year']}
+                    for m in title_index.prefix(request.args.get('term', ''))]
+
+    return jsonify(suggestions)
 
 
 ###############################################################################
 # homepage
 
+# the leaderboards take two queries when their cache needs a refresh
 @app.route("/")
+@max_queries(3)
 def homepage():
     """Show homepage."""
     
-    return render_template("home.html")
\ No newline at end of file
+    return render_template("home.html", popular=leaderboards.get())
\ No newline at end of file
@@ -0,0 +1,296 @@
+"""Serve static assets and compressed responses.
+
+Static files get content-hash fingerprinted urls, e.g.
+
+    asset_url("css/index.css") -> /static/css/index.3b0f1c9a2d4e.css
+
+which can be cached by browsers forever, since any change to the file is
+a new url.  Text responses (html, json, ndjson) are compressed on the
+fly, and static files are served from precompressed copies when they've
+been built.
+
+Build the precompressed copies at deploy with:
+
+    $ python assets.py build
+"""
+
+import gzip
+import hashlib
+import mimetypes
+import os
+import sys
+import zlib
+
+from flask import request, send_from_directory
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# a year, the longest max-age browsers reliably honor
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+# responses we compress on the fly
+COMPRESSIBLE_MIMETYPES = ("text/html", "text/csv", "application/json",
+                          "application/x-ndjson")
+
+# static files worth precompressing, images are already compressed
+PRECOMPRESS_EXTENSIONS = (".css", ".js", ".svg", ".html", ".txt", ".json")
+
+# how many hex chars of the content hash go in a fingerprinted name
+HASH_LENGTH = 12
+
+
+###############################################################################
+# fingerprinting
+
+def fingerprint(path):
+    """Return the short content hash of a file."""
+
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()[:HASH_LENGTH]
+
+
+def fingerprinted_name(filename, digest):
+    """Put a content hash in a filename, before its extension."""
+
+    root, ext = os.path.splitext(filename)
+
+    return f"{root}.{digest}{ext}"
+
+
+def build_manifest(static_folder):
+    """Map each static file to its fingerprinted name.
+
+    Returns (manifest, originals): original name -> fingerprinted name,
+    and the reverse, both relative to static_folder with / separators.
+    """
+
+    manifest = {}
+
+    for dirpath, dirnames, filenames in os.walk(static_folder):
+        for name in filenames:
+            # skip the precompressed copies we build ourselves
+            if name.endswith((".gz", ".br")):
+                continue
+
+            path = os.path.join(dirpath, name)
+            rel = os.path.relpath(path, static_folder).replace(os.sep, "/")
+
+            manifest[rel] = fingerprinted_name(rel, fingerprint(path))
+
+    originals = {hashed: rel for rel, hashed in manifest.items()}
+
+    return (manifest, originals)
+
+
+###############################################################################
+# compression
+
+def best_encoding(accept_encodings, available=("br", "gzip")):
+    """Pick the encoding to send from the request's Accept-Encoding."""
+
+    for encoding in available:
+        if encoding == "br" and brotli is None:
+            continue
+
+        if accept_encodings[encoding]:
+            return encoding
+
+    return None
+
+
+def compress(data, encoding):
+    """Compress a whole response body."""
+
+    if encoding == "br":
+        # quality 4 is about as fast as gzip and still smaller
+        return brotli.compress(data, quality=4)
+
+    return gzip.compress(data, compresslevel=6)
+
+
+def compress_stream(chunks, encoding):
+    """Compress a streamed response body as it's produced.
+
+    Each chunk is flushed so the client gets bytes as soon as we do.
+    """
+
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=4)
+
+        for chunk in chunks:
+            data = compressor.process(chunk) + compressor.flush()
+
+            if data:
+                yield data
+
+        yield compressor.finish()
+        return
+
+    # wbits=31 gives us a gzip header and trailer rather than raw zlib
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+
+    for chunk in chunks:
+        data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+        if data:
+            yield data
+
+    yield compressor.flush()
+
+
+def compress_response(response, min_size):
+    """Compress a text response if the client accepts it and it's worth it."""
+
+    if (response.status_code != 200
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES
+            or "Content-Encoding" in response.headers
+            or response.direct_passthrough):
+        return response
+
+    encoding = best_encoding(request.accept_encodings)
+
+    response.vary.add("Accept-Encoding")
+
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        # the original iterable may need closing (stream_with_context
+        # holds the request context open until it's closed)
+        original = response.response
+
+        if hasattr(original, "close"):
+            response.call_on_close(original.close)
+
+        response.response = compress_stream(response.iter_encoded(), encoding)
+        response.headers.pop("Content-Length", None)
+
+    else:
+        data = response.get_data()
+
+        if len(data) < min_size:
+            return response
+
+        response.set_data(compress(data, encoding))
+
+    response.headers["Content-Encoding"] = encoding
+
+    # the compressed bytes differ, so a strong validator would be a lie
+    etag, weak = response.get_etag()
+
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+
+    return response
+
+
+###############################################################################
+# precompressed static files
+
+def precompress(static_folder):
+    """Write .gz (and .br, if brotli is installed) copies of static files.
+
+    Returns the number of files written.
+    """
+
+    written = 0
+
+    for dirpath, dirnames, filenames in os.walk(static_folder):
+        for name in filenames:
+            if not name.endswith(PRECOMPRESS_EXTENSIONS):
+                continue
+
+            path = os.path.join(dirpath, name)
+
+            with open(path, "rb") as f:
+                data = f.read()
+
+            with open(path + ".gz", "wb") as f:
+                f.write(gzip.compress(data, compresslevel=9))
+            written += 1
+
+            if brotli is not None:
+                with open(path + ".br", "wb") as f:
+                    f.write(brotli.compress(data, quality=11))
+                written += 1
+
+    return written
+
+
+def send_static(static_folder, filename, max_age=None):
+    """Send a static file, using a precompressed copy if we have one."""
+
+    encoding = best_encoding(request.accept_encodings)
+
+    if encoding is not None:
+        ext = ".br" if encoding == "br" else ".gz"
+
+        path = safe_join(static_folder, filename + ext)
+
+        if path is not None and os.path.isfile(path):
+            # the mimetype has to come from the original name
+            mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+            response = send_from_directory(static_folder, filename + ext,
+                                           mimetype=mimetype,
+                                           max_age=max_age)
+            response.headers["Content-Encoding"] = encoding
+            response.vary.add("Accept-Encoding")
+            return response
+
+    response = send_from_directory(static_folder, filename, max_age=max_age)
+    response.vary.add("Accept-Encoding")
+
+    return response
+
+
+###############################################################################
+# flask setup
+
+def init_app(app):
+    """Set up fingerprinted static urls and response compression.
+
+    Call this before any extension that rewrites responses (like the
+    debug toolbar), so compression is the last thing to touch them.
+    """
+
+    app.config.setdefault("COMPRESS_MIN_SIZE", 500)
+
+    manifest, originals = build_manifest(app.static_folder)
+
+    def asset_url(filename):
+        """The fingerprinted url of a static file, for templates."""
+
+        return f"{app.static_url_path}/{manifest.get(filename, filename)}"
+
+    def static(filename):
+        """Serve static files, fingerprinted ones with far future caching."""
+
+        if filename in originals:
+            response = send_static(app.static_folder, originals[filename],
+                                   max_age=IMMUTABLE_MAX_AGE)
+            response.cache_control.public = True
+            response.cache_control.immutable = True
+            return response
+
+        return send_static(app.static_folder, filename)
+
+    @app.after_request
+    def compress_after_request(response):
+        return compress_response(response, app.config["COMPRESS_MIN_SIZE"])
+
+    app.view_functions["static"] = static
+    app.jinja_env.globals["asset_url"] = asset_url
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["build"]:
+        sys.exit("usage: python assets.py build")
+
+    static_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+
+    print(f"{precompress(static_folder)} precompressed files written")
@@ -0,0 +1,67 @@
+"""Run on postgres, or on sqlite for local development and tests.
+
+Production runs on postgres.  The app also runs on sqlite, e.g.
+
+    DATABASE_URL=sqlite://              (in memory, what the tests use)
+    DATABASE_URL=sqlite:///ledger.db    (a file next to app.py)
+
+so neither the tests nor a quick local run need a postgres server.
+
+Most of the app is plain SQLAlchemy and doesn't care which one it's
+talking to.  The few places that lean on postgres (COPY restores,
+UPDATE ... RETURNING, the titles migration) ask dialect() and keep a
+sqlite version next to the postgres one.
+"""
+
+import sqlite3
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import make_url
+
+
+def is_sqlite(database_url):
+    """Is this database url a sqlite database?"""
+
+    return make_url(database_url).get_backend_name() == "sqlite"
+
+
+def engine_options(database_url, pool_size):
+    """SQLALCHEMY_ENGINE_OPTIONS that suit the database we connect to.
+
+    sqlite connections are cheap (and an in memory db has exactly one),
+    so it gets no connection pool settings at all.
+    """
+
+    if is_sqlite(database_url):
+        return {}
+
+    return {
+        "pool_size": pool_size,
+        "pool_pre_ping": True,
+    }
+
+
+def dialect(session):
+    """The name of the dialect a session talks to, "postgresql" or "sqlite"."""
+
+    return session.get_bind().dialect.name
+
+
+def supports_returning(session):
+    """Can UPDATE and DELETE statements return the rows they touched?
+
+    sqlite itself can, but not through SQLAlchemy 1.3.
+    """
+
+    return dialect(session) == "postgresql"
+
+
+@event.listens_for(Engine, "connect")
+def _sqlite_pragmas(dbapi_connection, connection_record):
+    """sqlite only enforces foreign keys (and ON DELETE CASCADE) when asked."""
+
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
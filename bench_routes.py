@@ -0,0 +1,299 @@
+# Benchmark every route against seeded ledgers and compare to baselines.
+#
+# run using
+#   $ python bench_routes.py                   (compare to bench_baselines.json)
+#   $ python bench_routes.py --update          (write new baselines)
+#   $ python bench_routes.py --sizes 10 1000   (skip the 100k ledger)
+#
+# each ledger size gets its own user, seeded through restore_ledger.
+# the omdb api is stubbed out in process, so the numbers are ours alone.
+# for every route and size we report p50/p99 latency, queries per
+# request and peak memory allocated per request, and flag anything that
+# got slower (beyond --tolerance) or needs more queries than its
+# baseline.  exits with 1 if anything regressed.
+#
+# runs on an in memory sqlite db, or on DATABASE_URL if it's set (e.g.
+# postgresql:///movie_ledger_bench).  baselines are only comparable on
+# the machine (and db) they were recorded on.
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import date, timedelta
+
+os.environ.setdefault('DATABASE_URL', "sqlite://")
+
+import services
+from app import app, CURR_USER_KEY
+from models import db, User, Movie
+from ledger_io import restore_ledger
+from query_budget import recording_statements
+
+
+BASELINES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              "bench_baselines.json")
+
+SIZES = (10, 1000, 100000)
+
+# how many timed requests per route, fewer for the big ledgers
+ITERATIONS = {10: 50, 1000: 20, 100000: 5}
+
+# timings within this many ms of their baseline are noise, not regressions
+SLACK_MS = 3
+
+PLATFORMS = ("netflix", "amazon prime", "hbo max", "hulu", "apple tv", None)
+
+
+###############################################################################
+# stub api
+
+STUB_MOVIE = {
+    "Title": "Stub Movie", "Year": "2001", "Rated": "PG", "Released": "01 Jan 2001",
+    "Runtime": "101 min", "Genre": "Drama", "Actors": "Ann Actor, Bob Actor",
+    "Plot": "A stub.", "Poster": "N/A", "Response": "True",
+}
+
+
+def stub_api_get(api_url):
+    """Answer api calls without the network."""
+
+    if "&i=" in api_url:
+        imdb_id = api_url.rsplit("&i=", 1)[1]
+        return dict(STUB_MOVIE, imdbID=imdb_id)
+
+    return {
+        "Search": [{"Title": f"Stub Movie {i}", "Year": "2001", "imdbID": f"tt{i:08d}",
+                    "Type": "movie", "Poster": "N/A"} for i in range(10)],
+        "totalResults": "100",
+        "Response": "True",
+    }
+
+
+###############################################################################
+# seeding
+
+def ledger_records(size):
+    """Generate size ledger records with a spread of years, dates and platforms."""
+
+    start = date(2015, 1, 1)
+
+    for i in range(size):
+        yield {
+            "imdb_id": f"tt{i:08d}",
+            "title": f"Bench Movie {(i * 7919) % size:07d}",
+            "year": str(1950 + i % 75),
+            "actors": "Ann Actor, Bob Actor",
+            "imdb_img": "N/A",
+            "favorite": i % 5 == 0,
+            "platform": PLATFORMS[i % len(PLATFORMS)],
+            "date_viewed": (start + timedelta(days=i % 3000)).isoformat() if i % 3 else None,
+            "date_added": (start + timedelta(days=i % 2000)).isoformat(),
+        }
+
+
+def seed_user(size):
+    """Return the id of a user with a ledger of size movies, creating it if needed."""
+
+    username = f"bench{size}"
+    u = User.query.filter_by(username=username).first()
+
+    if u is None:
+        u = User(username=username, email="bench@test.com", password="unused", img_url="")
+        db.session.add(u)
+        db.session.commit()
+
+    if Movie.query.filter_by(user_id=u.id).count() != size:
+        Movie.query.filter_by(user_id=u.id).delete()
+        restore_ledger(ledger_records(size), user_id=u.id, trust_titles=True)
+        db.session.commit()
+
+    return u.id
+
+
+###############################################################################
+# routes
+
+def routes(size):
+    """(name, method, path factory, kwargs) for every route we benchmark.
+
+    Path factories take the iteration number, so destructive routes can
+    use a different movie each time.
+    """
+
+    movie = lambda i: f"tt{i % size:08d}"
+
+    return [
+        ("movies", "get", lambda i: "/movies", {}),
+        ("movies?sort=title", "get", lambda i: "/movies?sort=title&order=asc", {}),
+        ("movies?sort=year", "get", lambda i: "/movies?sort=year&order=desc", {}),
+        ("movies?sort=date_added", "get", lambda i: "/movies?sort=date_added&order=desc", {}),
+        ("movies?sort=date_viewed", "get", lambda i: "/movies?sort=date_viewed&order=asc", {}),
+        ("movies?filter=favorites", "get", lambda i: "/movies?filter=favorites", {}),
+        ("movie-search", "get", lambda i: "/movie-search?term=stub", {}),
+        ("movie-search/suggest", "get", lambda i: "/movie-search/suggest?term=bench mov", {}),
+        ("movie GET", "get", lambda i: f"/movie/{movie(i)}", {}),
+        ("movie POST", "post", lambda i: f"/movie/{movie(i)}",
+            {"data": {"date_added": "2020-01-01", "platform": "hulu", "favorite": "y"}}),
+        ("favorite", "post", lambda i: f"/movie/{movie(i)}/favorite", {}),
+        # delete runs last, and from the end of the ledger
+        ("delete", "delete", lambda i: f"/movie/{movie(size - 1 - i)}", {}),
+    ]
+
+
+def bench_route(client, method, path_for, kwargs, iterations):
+    """Time a route, count its queries and measure its allocations."""
+
+    send = getattr(client, method)
+
+    def call(path, **kwargs):
+        # a streamed page (see streaming.py) renders as its body is read,
+        # so read all of it, inside the request, and close it
+        resp = send(path, **kwargs)
+        resp.get_data()
+        resp.close()
+        return resp
+
+    # warm up caches (fragments, compiled queries) the way repeat visits would
+    call(path_for(iterations), **kwargs)
+
+    latencies = []
+    queries = []
+
+    for i in range(iterations):
+        with recording_statements() as statements:
+            start = time.perf_counter()
+            resp = call(path_for(i), **kwargs)
+            latencies.append(time.perf_counter() - start)
+
+        if resp.status_code >= 400:
+            sys.exit(f"{method.upper()} {path_for(i)} failed with {resp.status_code}")
+
+        queries.append(len(statements))
+
+    # tracemalloc slows everything down, so measure memory on its own
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    call(path_for(iterations + 1), **kwargs)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    latencies.sort()
+
+    return {
+        "p50_ms": round(statistics.median(latencies) * 1000, 2),
+        "p99_ms": round(latencies[max(int(len(latencies) * 0.99) - 1, 0)] * 1000, 2),
+        "queries": max(queries),
+        "alloc_kib": round(peak / 1024, 1),
+    }
+
+
+###############################################################################
+# baselines
+
+def compare(result, baseline, tolerance):
+    """Return a list of regressions of result against its baseline."""
+
+    if baseline is None:
+        return []
+
+    regressions = []
+
+    if result["p50_ms"] > baseline["p50_ms"] * (1 + tolerance) + SLACK_MS:
+        regressions.append(f"p50 {baseline['p50_ms']}ms -> {result['p50_ms']}ms")
+
+    if result["queries"] > baseline["queries"]:
+        regressions.append(f"queries {baseline['queries']} -> {result['queries']}")
+
+    if result["alloc_kib"] > baseline["alloc_kib"] * (1 + tolerance):
+        regressions.append(f"alloc {baseline['alloc_kib']}KiB -> {result['alloc_kib']}KiB")
+
+    return regressions
+
+
+def delta(result, baseline, field):
+    """Format the change of a field against its baseline as a percentage."""
+
+    if baseline is None or not baseline[field]:
+        return ""
+
+    return f"{(result[field] / baseline[field] - 1) * 100:+.0f}%"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark every route.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--update", action="store_true", help="write new baselines")
+    parser.add_argument("--tolerance", type=float, default=0.5,
+                        help="allowed slowdown before we call it a regression")
+    args = parser.parse_args()
+
+    app.config['SQLALCHEMY_ECHO'] = False
+    app.config['TESTING'] = True
+    app.config['WTF_CSRF_ENABLED'] = False
+    app.config['QUERY_BUDGET_RAISE'] = False
+    app.logger.disabled = True
+
+    services.API_KEY = "bench"
+    services.api_get = stub_api_get
+
+    db.create_all()
+
+    try:
+        with open(BASELINES_FILE) as f:
+            baselines = json.load(f)
+    except FileNotFoundError:
+        baselines = {}
+
+    results = {}
+    regressed = []
+
+    print(f"{'route':<26}{'size':>8}{'p50 ms':>10}{'p99 ms':>10}{'queries':>9}"
+          f"{'alloc KiB':>11}  vs baseline")
+
+    for size in args.sizes:
+        user_id = seed_user(size)
+        client = app.test_client()
+
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+        for name, method, path_for, kwargs in routes(size):
+            key = f"{name}|{size}"
+            result = bench_route(client, method, path_for, kwargs,
+                                 min(ITERATIONS.get(size, 5), size - 1))
+            results[key] = result
+
+            baseline = baselines.get(key)
+            problems = compare(result, baseline, args.tolerance)
+
+            if problems:
+                regressed.append(f"{key}: " + ", ".join(problems))
+
+            print(f"{name:<26}{size:>8}{result['p50_ms']:>10}{result['p99_ms']:>10}"
+                  f"{result['queries']:>9}{result['alloc_kib']:>11}  "
+                  f"{delta(result, baseline, 'p50_ms'):>6} {'REGRESSED' if problems else ''}")
+
+        # put back what delete and favorite changed, for the next run
+        Movie.query.filter_by(user_id=user_id).delete()
+        db.session.commit()
+
+    if args.update:
+        baselines.update(results)
+
+        with open(BASELINES_FILE, "w") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write("\n")
+
+        print(f"\nbaselines written to {BASELINES_FILE}")
+
+    elif regressed:
+        print("\nregressions:\n  " + "\n  ".join(regressed))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
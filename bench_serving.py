@@ -0,0 +1,210 @@
+# Compare gunicorn serving modes under a slow omdb api.
+#
+# run using
+#   $ python bench_serving.py
+#   $ python bench_serving.py --modes sync gthread gevent --latency 200
+#
+# starts a stub omdb server that answers after --latency ms, then for
+# each mode starts gunicorn (with gunicorn.conf.py) against it and
+# drives /movie-search from --clients concurrent logged in clients.
+# uses the db from DATABASE_URL (or the development db).
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+
+
+STUB_RESULTS = {
+    "Search": [{"Title": f"Stub Movie {i}", "Year": "2001", "imdbID": f"tt{i:07d}",
+                "Type": "movie", "Poster": "N/A"} for i in range(10)],
+    "totalResults": "100",
+    "Response": "True",
+}
+
+
+def start_stub_omdb(latency, answer=None, port=0):
+    """Serve canned search results after latency seconds, in a thread, on
+    port (any free one by default).
+
+    answer, if given, makes the results instead: it's called with the
+    request's query parameters (as from parse_qs) and returns the json.
+    """
+
+    canned = json.dumps(STUB_RESULTS).encode("utf8")
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(latency)
+
+            if answer is None:
+                body = canned
+            else:
+                body = json.dumps(answer(parse_qs(urlsplit(self.path).query))).encode("utf8")
+
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return f"http://127.0.0.1:{server.server_port}/"
+
+
+def wait_for(url, timeout=30):
+    """Wait until url answers."""
+
+    deadline = time.time() + timeout
+
+    while time.time() < deadline:
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.2)
+
+    sys.exit(f"{url} never came up")
+
+
+BENCH_USER = {"username": "bench", "password": "benchpass", "email": "bench@test.com"}
+
+
+def create_bench_user():
+    """Make sure our benchmark user exists."""
+
+    from models import db, User
+
+    bench_app()
+
+    if not User.query.filter_by(username=BENCH_USER["username"]).first():
+        User.signup(img_url="", **BENCH_USER)
+        db.session.commit()
+
+
+def logged_in_session(base):
+    """Log in as the benchmark user and return its session."""
+
+    s = requests.Session()
+    creds = BENCH_USER
+
+    resp = s.post(f"{base}/login", data=creds)
+
+    if not resp.url.endswith("/movies"):
+        sys.exit(f"couldn't log in to {base} as {creds['username']}")
+
+    return s
+
+
+def start_gunicorn(mode, workers, port, omdb_url):
+    """Start gunicorn serving bench_app() against omdb_url, returns its
+    process once it answers.
+    """
+
+    env = dict(os.environ,
+               GUNICORN_WORKER_CLASS=mode,
+               WEB_CONCURRENCY=str(workers),
+               OMDB_API_URL=omdb_url,
+               PORT=str(port),
+               WTF_CSRF_ENABLED="0")
+
+    proc = subprocess.Popen(["gunicorn", "bench_serving:bench_app()"], env=env,
+                            cwd=os.path.dirname(os.path.abspath(__file__)),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    try:
+        wait_for(f"http://127.0.0.1:{port}")
+    except BaseException:
+        proc.terminate()
+        raise
+
+    return proc
+
+
+def run_mode(mode, args, omdb_url):
+    """Start gunicorn in one mode, load it and return the stats."""
+
+    port = args.port
+    proc = start_gunicorn(mode, args.workers, port, omdb_url)
+
+    try:
+        base = f"http://127.0.0.1:{port}"
+
+        sessions = [logged_in_session(base) for _ in range(args.clients)]
+        latencies = []
+        deadline = time.time() + args.duration
+
+        def client(s):
+            while time.time() < deadline:
+                start = time.perf_counter()
+                s.get(f"{base}/movie-search?term=stub")
+                latencies.append(time.perf_counter() - start)
+
+        with ThreadPoolExecutor(args.clients) as pool:
+            list(pool.map(client, sessions))
+
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    latencies.sort()
+
+    return {
+        "mode": mode,
+        "requests": len(latencies),
+        "rps": len(latencies) / args.duration,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+    }
+
+
+def bench_app():
+    """The app as gunicorn should serve it for the benchmark."""
+
+    from app import app
+
+    app.config['SQLALCHEMY_ECHO'] = False
+    app.config['WTF_CSRF_ENABLED'] = os.environ.get('WTF_CSRF_ENABLED') != "0"
+    app.config['DEBUG_TB_ENABLED'] = False
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--modes", nargs="+", default=["sync", "gthread"])
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--clients", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--latency", type=float, default=100, help="omdb latency in ms")
+    parser.add_argument("--port", type=int, default=8111)
+    args = parser.parse_args()
+
+    create_bench_user()
+    omdb_url = start_stub_omdb(args.latency / 1000)
+
+    print(f"{args.workers} workers, {args.clients} clients, "
+          f"{args.latency:.0f}ms omdb latency, {args.duration:.0f}s per mode")
+
+    for mode in args.modes:
+        r = run_mode(mode, args, omdb_url)
+        print(f"{r['mode']:>8}: {r['rps']:7.1f} req/s  p50 {r['p50_ms']:7.1f}ms  "
+              f"p99 {r['p99_ms']:7.1f}ms  ({r['requests']} requests)")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,17 @@ from wtforms.validators import DataRequired, Email, Length, Optional
 import email_validator
 
 
+# the streaming platforms a user can record a movie as viewed on
+PLATFORM_CHOICES = [
+    ("", ""),
+    ("netflix", "Netflix"),
+    ("amazon prime", "Amazon Prime"),
+    ("hbo max", "HBO Max"),
+    ("hulu", "Hulu"),
+    ("apple tv", "Apple TV")
+    ]
+
+
 class UserAddForm(FlaskForm):
     """Form for adding users."""
 
@@ -45,15 +56,6 @@ class MovieAddEditForm(FlaskForm):
     actors = HiddenField("actors")
     imdb_img = HiddenField("imdb_img")
     favorite = BooleanField("Favorite")
-    platform = SelectField("Platform (optional)",
-                choices=[
-                    ("", ""),
-                    ("netflix", "Netflix"),
-                    ("amazon prime", "Amazon Prime"),
-                    ("hbo max", "HBO Max"),
-                    ("hulu", "Hulu"),
-                    ("apple tv", "Apple TV")
-                    ]
-                )
+    platform = SelectField("Platform (optional)", choices=PLATFORM_CHOICES)
     date_viewed = DateField("Date Viewed", validators=[Optional()])
     date_added = HiddenField("data_added")
\ No newline at end of file
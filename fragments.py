@@ -0,0 +1,119 @@
+"""Cache rendered template fragments for movies.
+
+Templates wrap the markup for one movie in a call block:
+
+    {% call cached_fragment("ledger-item", movie) %}
+        <li>...</li>
+    {% endcall %}
+
+The body is only rendered on a miss.  A fragment's key is its kind, the
+movie's imdb id and a content version: the values of every field the
+fragment shows.  Any change to those values is a different key, so a
+stale fragment can never be served, and invalidate() drops every
+version of a title at once when we know it changed.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+
+from markupsafe import Markup
+
+
+# the fields each kind of fragment renders, the first one is the imdb id.
+# "ledger-item" is a Movie from the ledger, "movie-detail" is the dict
+# we get back from the api.
+FRAGMENT_FIELDS = {
+    "ledger-item": ("imdb_id", "title", "year", "actors", "imdb_img",
+                    "date_viewed", "date_added", "platform", "favorite"),
+    "movie-detail": ("imdbID", "Title", "Poster", "Year", "Rated", "Released",
+                     "Runtime", "Genre", "Actors", "Plot"),
+}
+
+
+def _field(obj, name):
+    """Read a field from a model (attribute) or an api result (key)."""
+
+    if isinstance(obj, dict):
+        return obj.get(name)
+
+    return getattr(obj, name)
+
+
+class FragmentCache:
+    """A bounded, least recently used cache of rendered fragments."""
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+        self._fragments = OrderedDict()
+        # imdb id -> keys of its cached fragments, for invalidate()
+        self._keys = {}
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._fragments)
+
+    def __call__(self, kind, obj, caller):
+        """Return the cached markup for obj, rendering it with caller() on a miss."""
+
+        if not self.maxsize:
+            return caller()
+
+        values = tuple(_field(obj, name) for name in FRAGMENT_FIELDS[kind])
+        key = (kind, values)
+
+        with self._lock:
+            html = self._fragments.get(key)
+
+            if html is not None:
+                self._fragments.move_to_end(key)
+                self.hits += 1
+                return html
+
+            self.misses += 1
+
+        # render outside the lock, two threads may render the same
+        # fragment at once but they'll produce the same markup
+        html = Markup(caller())
+
+        with self._lock:
+            self._fragments[key] = html
+            self._keys.setdefault(values[0], set()).add(key)
+
+            while len(self._fragments) > self.maxsize:
+                old_key, _ = self._fragments.popitem(last=False)
+                self._forget(old_key)
+
+        return html
+
+    def _forget(self, key):
+        """Drop key from the imdb id index.  Call with the lock held."""
+
+        imdb_id = key[1][0]
+        keys = self._keys.get(imdb_id)
+
+        if keys is not None:
+            keys.discard(key)
+
+            if not keys:
+                del self._keys[imdb_id]
+
+    def invalidate(self, *imdb_ids):
+        """Drop every cached fragment for the given titles."""
+
+        with self._lock:
+            for imdb_id in imdb_ids:
+                for key in self._keys.pop(imdb_id, ()):
+                    self._fragments.pop(key, None)
+
+    def clear(self):
+        """Drop everything."""
+
+        with self._lock:
+            self._fragments.clear()
+            self._keys.clear()
+
+
+fragment_cache = FragmentCache()
@@ -0,0 +1,85 @@
+"""Gunicorn settings for serving the Movie Ledger.
+
+gunicorn picks this file up on its own, so the Procfile only needs
+`gunicorn app:app`.  Most of a request's time is spent waiting on the
+omdb api or postgres, so by default each worker runs several threads.
+
+Environment variables:
+    GUNICORN_WORKER_CLASS   gthread (default), gevent or sync
+    WEB_CONCURRENCY         worker processes (default: one per core)
+    GUNICORN_THREADS        threads per gthread worker
+    IO_RATIO                fraction of a request spent waiting on i/o,
+                            used to size threads when GUNICORN_THREADS
+                            isn't set (default 0.8, measure it from the
+                            Server-Timing header on real traffic)
+"""
+
+import gc
+import math
+import multiprocessing
+import os
+
+
+cores = multiprocessing.cpu_count()
+
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+
+# with preload_app the app is imported here in the master, so gevent has
+# to patch the stdlib before that happens rather than in the worker.
+# gevent mode needs `pip install gevent psycogreen`.
+if worker_class == "gevent":
+    from gevent import monkey
+    monkey.patch_all()
+
+    # let psycopg2 yield to other greenlets while it waits on postgres
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+
+# while one thread waits on i/o another can use the cpu, so to keep a
+# core busy we want 1 / (1 - io_ratio) threads on it
+io_ratio = min(float(os.environ.get("IO_RATIO", 0.8)), 0.95)
+
+if worker_class == "sync":
+    workers = int(os.environ.get("WEB_CONCURRENCY", 2 * cores + 1))
+    threads = 1
+else:
+    workers = int(os.environ.get("WEB_CONCURRENCY", cores))
+    threads = int(os.environ.get("GUNICORN_THREADS", math.ceil(1 / (1 - io_ratio))))
+
+# gevent ignores threads and runs this many greenlets per worker instead
+worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", 100))
+
+# one db connection per thread (or greenlet), read by app.py at import
+os.environ.setdefault("DB_POOL_SIZE",
+                      str(worker_connections if worker_class == "gevent" else threads))
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8000)}"
+
+# import the app once in the master so workers share its memory pages
+preload_app = True
+
+# hold off gc while the app is imported in the master.  gunicorn
+# preloads it before calling any server hook, and a collection touches
+# every object's header, which would copy the page it lives on into each
+# worker after the fork.
+gc.disable()
+
+
+def when_ready(server):
+    """Move everything the master has imported out of gc's reach.
+
+    This runs once, after the app is loaded and before the first worker
+    is forked.  Frozen objects are never scanned by a collection, in the
+    master or in a worker, so the pages they live on stay shared.
+    """
+
+    gc.freeze()
+    gc.enable()
+
+
+def post_fork(server, worker):
+    """Set up the worker process after it's been forked."""
+
+    # never share the master's db connections with a worker
+    from models import db
+    db.engine.dispose()
@@ -0,0 +1,532 @@
+"""Keep busy users' ledgers in memory, as columns, for instant sorting.
+
+Every sort and filter change on /movies used to be another query, the
+whole ledger read, sorted and joined to the catalog again.  Instead, the
+first time a user's ledger page is shown, each worker reads the ledger
+once (unsorted) into a Ledger, a column per field:
+
+- year, date_added and date_viewed as NumPy arrays (dates as
+  datetime64[D], NaT for none), favorite as bools and platform as a
+  small integer code.
+- title and year sort keys, each string's rank among the ledger's, made
+  the first time that sort is asked for.
+- the rest of what the page shows (imdb id, title, actors, poster) as
+  object arrays, so rows can be handed to the template without a query.
+
+Each sort's order is an argsort, kept until a write changes its column,
+and the favorites filter is a mask over it, so re-sorting a ledger of
+100k movies is well under a millisecond (rendering the page is the rest).
+Orders follow the database's: strings in code point order (sqlite's,
+and ledger_query() in app.py sorts them COLLATE "C" on postgres), no
+date first on sqlite and last on postgres (reversed for descending
+sorts).
+
+A Ledger is only served while it's current: it remembers the user's
+ledger_version it was read at, and every ledger write bumps that once
+per commit (see app.py).  Writes this worker makes are applied to the
+cached ledger as they commit, and it moves on a version with them:
+
+- movies added or changed through the ORM are noted by a flush
+  listener.
+- bulk writes (deletes, batches, restores) note what they did with
+  track(), like they do for popularity.py.
+
+A write by another worker (or one we couldn't apply) leaves the cached
+ledger a version behind, and it's read again on its next page view.
+
+The cache holds up to LEDGER_CACHE_ROWS movies per worker, over all its
+users, and drops the least recently viewed ledgers to make room.  A
+ledger bigger than that is never built: reading it stops one row past
+LEDGER_CACHE_ROWS and its page is streamed from the database like it
+was without the cache, as are its page views after that until it
+changes.  Set it to 0 to turn the cache off.  Like recommendations.py, this needs NumPy,
+without it every page view reads its ledger from the database.
+"""
+
+from collections import OrderedDict, namedtuple
+from datetime import datetime
+from threading import Lock
+
+from sqlalchemy import event
+
+from backends import dialect
+from fragments import FRAGMENT_FIELDS
+from models import db, Movie, Title
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# movies kept per worker, over all the ledgers it holds
+DEFAULT_MAX_ROWS = 200000
+
+# users whose ledgers were too big to cache, remembered so their page
+# views don't read it again
+MAX_OVERSIZED = 1000
+
+# a ledger page row, the fields the ledger item fragment shows
+LedgerRow = namedtuple("LedgerRow", FRAGMENT_FIELDS["ledger-item"])
+
+# the columns a write can change, and the sorts that depend on them
+EDITABLE = {"favorite": (), "platform": (), "date_viewed": ("date_viewed",)}
+
+# columns kept as python objects, as read
+OBJECT_COLUMNS = ("imdb_id", "title", "year", "actors", "imdb_img")
+
+# text sorts, by the rank of each string among the ledger's
+TEXT_SORTS = ("title", "year")
+
+
+def _day(value):
+    """A date (the date_added default is a datetime) as datetime64[D]."""
+
+    if value is None:
+        return np.datetime64("NaT", "D")
+
+    if isinstance(value, datetime):
+        value = value.date()
+
+    return np.datetime64(value, "D")
+
+
+class Ledger:
+    """One user's ledger as columns.  Never changed once made, writes
+    make a new one, so a page can keep rendering from the old one.
+    """
+
+    def __init__(self, version, columns, platforms, nulls_first):
+        self.version = version
+        self.columns = columns
+        # platform code -> name, code 0 is no platform
+        self.platforms = platforms
+        self.nulls_first = nulls_first
+
+        self._index = None
+        self._orders = {}
+
+    @classmethod
+    def from_rows(cls, version, rows, nulls_first=False):
+        """A Ledger from rows with the LedgerRow fields."""
+
+        fields = {name: [] for name in LedgerRow._fields}
+
+        for row in rows:
+            for name, value in zip(LedgerRow._fields, row):
+                fields[name].append(value)
+
+        platforms = [None]
+        codes = {None: 0}
+
+        columns = {name: _objects(fields[name]) for name in OBJECT_COLUMNS}
+        columns["favorite"] = np.array(fields["favorite"], dtype=bool)
+        columns["platform"] = np.array([_code(codes, platforms, value)
+                                        for value in fields["platform"]], dtype=np.int16)
+
+        for name in ("date_added", "date_viewed"):
+            columns[name] = np.array([_day(value) for value in fields[name]],
+                                     dtype="datetime64[D]")
+
+        return cls(version, columns, platforms, nulls_first)
+
+    def __len__(self):
+        return len(self.columns["imdb_id"])
+
+    def _positions(self, imdb_ids):
+        if self._index is None:
+            self._index = {imdb_id: i for i, imdb_id in enumerate(self.columns["imdb_id"])}
+
+        return [self._index[i] for i in imdb_ids if i in self._index]
+
+    ###########################################################################
+    # reading
+
+    def order(self, sort):
+        """Positions in ascending order of a sort column (in the order
+        read if there's no sort).
+        """
+
+        order = self._orders.get(sort)
+
+        if order is None:
+            if not sort:
+                order = np.arange(len(self))
+
+            elif sort in TEXT_SORTS:
+                # "" for a missing year sorts it first, like sqlite's NULL
+                keys = _objects([value or "" for value in self.columns[sort]])
+                order = np.argsort(np.unique(keys, return_inverse=True)[1], kind="stable")
+
+            else:
+                keys = self.columns[sort]
+
+                # NaT sorts after every date, but as an int64 it's the
+                # smallest there is
+                if self.nulls_first:
+                    keys = keys.view(np.int64)
+
+                order = np.argsort(keys, kind="stable")
+
+            self._orders[sort] = order
+
+        return order
+
+    def positions(self, kwargs, sort_str):
+        """The positions of the rows a ledger query with these filter_by()
+        kwargs and order_by() text would return, in its order.
+        """
+
+        sort, _, direction = sort_str.partition(" ")
+        order = self.order(sort)
+
+        if direction == "desc":
+            order = order[::-1]
+
+        if kwargs.get("favorite"):
+            order = order[self.columns["favorite"][order]]
+
+        return order
+
+    def rows(self, kwargs, sort_str):
+        """LedgerRows like a ledger query with these options returns."""
+
+        positions = self.positions(kwargs, sort_str)
+        columns = self.columns
+        platforms = self.platforms
+
+        values = []
+
+        # tolist() makes python values: str, bool, date (None for NaT)
+        for name in LedgerRow._fields:
+            if name == "platform":
+                values.append([platforms[code] for code in columns[name][positions].tolist()])
+            else:
+                values.append(columns[name][positions].tolist())
+
+        return map(LedgerRow._make, zip(*values))
+
+    ###########################################################################
+    # writing
+
+    def _changed(self, columns, platforms=None, sorts=None):
+        """A new Ledger with some columns replaced, keeping the orders of
+        the sorts they don't affect (sorts=None keeps none).
+        """
+
+        ledger = Ledger(self.version, {**self.columns, **columns},
+                        platforms or self.platforms, self.nulls_first)
+
+        if sorts is not None:
+            ledger._index = self._index
+            ledger._orders = {sort: order for sort, order in self._orders.items()
+                              if sort not in sorts}
+
+        return ledger
+
+    def updated(self, imdb_ids, values):
+        """The ledger with values set on these movies."""
+
+        positions = self._positions(imdb_ids)
+        platforms = list(self.platforms)
+        columns = {}
+        sorts = set()
+
+        for name, value in values.items():
+            if name not in EDITABLE:
+                continue
+
+            column = columns[name] = self.columns[name].copy()
+            sorts.update(EDITABLE[name])
+
+            if name == "platform":
+                value = _code({p: c for c, p in enumerate(platforms)}, platforms, value)
+            elif name != "favorite":
+                value = _day(value)
+
+            column[positions] = value
+
+        return self._changed(columns, platforms, sorts)
+
+    def added(self, row):
+        """The ledger with a movie added (or replaced)."""
+
+        ledger = self.deleted([row.imdb_id])
+        platforms = list(ledger.platforms)
+        codes = {p: c for c, p in enumerate(platforms)}
+        columns = {}
+
+        for name, value in zip(LedgerRow._fields, row):
+            if name in OBJECT_COLUMNS:
+                value = _objects([value])
+            elif name == "platform":
+                value = [_code(codes, platforms, value)]
+            elif name == "favorite":
+                value = [bool(value)]
+            else:
+                value = np.array([_day(value)], dtype="datetime64[D]")
+
+            columns[name] = np.concatenate([ledger.columns[name],
+                                            np.array(value, dtype=ledger.columns[name].dtype)])
+
+        return ledger._changed(columns, platforms)
+
+    def deleted(self, imdb_ids):
+        """The ledger without these movies."""
+
+        positions = self._positions(imdb_ids)
+
+        if not positions:
+            return self
+
+        keep = np.ones(len(self), dtype=bool)
+        keep[positions] = False
+
+        return self._changed({name: column[keep] for name, column in self.columns.items()})
+
+
+def _objects(values):
+    """A list as a 1d object array (np.array would make a 2d one of tuples)."""
+
+    array = np.empty(len(values), dtype=object)
+    array[:] = values
+
+    return array
+
+
+def _code(codes, platforms, platform):
+    """A platform's code, adding it to platforms if it's new."""
+
+    code = codes.get(platform)
+
+    if code is None:
+        code = codes[platform] = len(platforms)
+        platforms.append(platform)
+
+    return code
+
+
+###############################################################################
+# the cache
+
+class LedgerCache:
+    """The ledgers of the users a worker served lately, least recently
+    viewed dropped first.  Safe to share between threads.
+    """
+
+    def __init__(self, max_rows=DEFAULT_MAX_ROWS):
+        self.max_rows = max_rows
+
+        self._ledgers = OrderedDict()
+        self._rows = 0
+        # user id -> the ledger_version found too big to keep
+        self._oversized = OrderedDict()
+        self._lock = Lock()
+
+    @property
+    def enabled(self):
+        return np is not None and self.max_rows > 0
+
+    def __len__(self):
+        return len(self._ledgers)
+
+    def get(self, user, load):
+        """A user's current Ledger, read with load(limit) (up to limit rows
+        with the LedgerRow fields, in any order) if it isn't cached.  None
+        if the cache is off or the ledger is too big for it.
+        """
+
+        if not self.enabled:
+            return None
+
+        with self._lock:
+            if self._oversized.get(user.id) == user.ledger_version:
+                return None
+
+            ledger = self._ledgers.get(user.id)
+
+            if ledger is not None and ledger.version == user.ledger_version:
+                self._ledgers.move_to_end(user.id)
+                return ledger
+
+        # one row more than fits is enough to know it doesn't
+        ledger = Ledger.from_rows(user.ledger_version, load(self.max_rows + 1),
+                                  nulls_first=dialect(db.session) == "sqlite")
+
+        if len(ledger) > self.max_rows:
+            self.drop(user.id)
+
+            with self._lock:
+                self._oversized[user.id] = user.ledger_version
+
+                if len(self._oversized) > MAX_OVERSIZED:
+                    self._oversized.popitem(last=False)
+
+            return None
+
+        self._store(user.id, ledger)
+
+        return ledger
+
+    def _store(self, user_id, ledger):
+        with self._lock:
+            old = self._ledgers.pop(user_id, None)
+
+            if old is not None:
+                self._rows -= len(old)
+
+            if len(ledger) > self.max_rows:
+                return
+
+            self._ledgers[user_id] = ledger
+            self._rows += len(ledger)
+
+            while self._rows > self.max_rows:
+                _, evicted = self._ledgers.popitem(last=False)
+                self._rows -= len(evicted)
+
+    def drop(self, *user_ids):
+        """Forget users' ledgers."""
+
+        with self._lock:
+            for user_id in user_ids:
+                ledger = self._ledgers.pop(user_id, None)
+
+                if ledger is not None:
+                    self._rows -= len(ledger)
+
+    def drop_title(self, imdb_id):
+        """Forget the ledgers with a title in them, after its catalog row
+        changed.
+        """
+
+        with self._lock:
+            holding = [user_id for user_id, ledger in self._ledgers.items()
+                       if ledger._positions([imdb_id])]
+
+        self.drop(*holding)
+
+    def clear(self):
+        with self._lock:
+            self._ledgers = OrderedDict()
+            self._rows = 0
+            self._oversized = OrderedDict()
+
+    def apply(self, changes):
+        """Apply a commit's (user_id, action, imdb_ids, values) changes, and
+        move each user's cached ledger on a version.
+        """
+
+        by_user = OrderedDict()
+
+        for change in changes:
+            by_user.setdefault(change[0], []).append(change)
+
+        for user_id, user_changes in by_user.items():
+            with self._lock:
+                cached = ledger = self._ledgers.get(user_id)
+
+            if ledger is None:
+                continue
+
+            for _, action, imdb_ids, values in user_changes:
+                if action == "reload":
+                    ledger = None
+                    break
+
+                if action == "update":
+                    ledger = ledger.updated(imdb_ids, values)
+                elif action == "delete":
+                    ledger = ledger.deleted(imdb_ids)
+                elif action == "add":
+                    ledger = ledger.added(values)
+
+            if ledger is None:
+                self.drop(user_id)
+                continue
+
+            ledger = ledger._changed({}, sorts=())
+            ledger.version = cached.version + 1
+
+            with self._lock:
+                # it may have been read again (or dropped) meanwhile
+                current = self._ledgers.get(user_id)
+
+            if current is cached:
+                self._store(user_id, ledger)
+
+
+ledgers = LedgerCache()
+
+
+###############################################################################
+# keeping up with ledgers
+
+def track(user_id, action="touch", imdb_ids=(), values=None):
+    """Note a write to a user's ledger, applied to the cached ledger when
+    the session commits.
+
+    action is "update" (set values on imdb_ids), "delete" (imdb_ids),
+    "touch" (nothing in the ledger changed, but its version did) or
+    "reload" (something we can't apply, e.g. a restore).
+    """
+
+    pending = db.session.info.setdefault("ledger_cache_changes", [])
+    pending.append((user_id, action, tuple(imdb_ids), values))
+
+
+def _row(movie):
+    return LedgerRow._make(getattr(movie, name) for name in LedgerRow._fields)
+
+
+def _track_flush(session, flush_context):
+    """Note the movies added, changed or deleted through the ORM."""
+
+    pending = session.info.setdefault("ledger_cache_changes", [])
+
+    for obj in session.new:
+        if isinstance(obj, Movie):
+            pending.append((obj.user_id, "add", (obj.imdb_id,), _row(obj)))
+
+    for obj in session.dirty:
+        if isinstance(obj, Movie):
+            pending.append((obj.user_id, "update", (obj.imdb_id,),
+                            {name: getattr(obj, name) for name in EDITABLE}))
+
+    for obj in session.deleted:
+        if isinstance(obj, Movie):
+            pending.append((obj.user_id, "delete", (obj.imdb_id,), None))
+
+
+def _apply_commit(session):
+    changes = session.info.pop("ledger_cache_changes", None)
+
+    if changes:
+        ledgers.apply(changes)
+
+
+def _drop_rollback(session, previous_transaction):
+    session.info.pop("ledger_cache_changes", None)
+
+
+def _title_changed(mapper, connection, target):
+    ledgers.drop_title(target.imdb_id)
+
+
+###############################################################################
+# flask setup
+
+def init_app(app):
+    """Cache up to LEDGER_CACHE_ROWS movies, and keep them up with writes."""
+
+    app.config.setdefault("LEDGER_CACHE_ROWS", DEFAULT_MAX_ROWS)
+
+    ledgers.max_rows = app.config["LEDGER_CACHE_ROWS"]
+
+    if not ledgers.enabled:
+        return
+
+    event.listen(db.session, "after_flush", _track_flush)
+    event.listen(db.session, "after_commit", _apply_commit)
+    event.listen(db.session, "after_soft_rollback", _drop_rollback)
+    event.listen(Title, "after_update", _title_changed)
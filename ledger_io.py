@@ -0,0 +1,453 @@
+"""Read and write movie ledgers as csv and ndjson."""
+
+import csv
+import gzip
+import io
+import json
+import zlib
+from datetime import date
+
+from models import db
+from backends import dialect
+
+
+# the fields of a ledger file, in column order
+LEDGER_FIELDS = ("imdb_id", "title", "year", "actors", "imdb_img",
+                 "favorite", "platform", "date_viewed", "date_added")
+
+# how many rows we pull from the db cursor (and write per chunk) at a time
+EXPORT_BATCH_SIZE = 1000
+
+
+def _jsonable(value):
+    """Dates aren't json serializable, so send them as iso strings."""
+
+    return value.isoformat() if isinstance(value, date) else value
+
+
+def _batches(rows, size=EXPORT_BATCH_SIZE):
+    """Group an iterable of rows into lists of at most size rows."""
+
+    batch = []
+
+    for row in rows:
+        batch.append(row)
+
+        if len(batch) == size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+def _csv_rows(rows):
+    """Yield rows as headerless csv, a batch at a time."""
+
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+
+    for batch in _batches(rows):
+        buf.seek(0)
+        buf.truncate()
+
+        writer.writerows(batch)
+        yield buf.getvalue()
+
+
+def csv_chunks(rows):
+    """Yield a csv document, header first, a batch of rows at a time."""
+
+    buf = io.StringIO()
+    csv.writer(buf).writerow(LEDGER_FIELDS)
+    yield buf.getvalue()
+
+    yield from _csv_rows(rows)
+
+
+def ndjson_chunks(rows):
+    """Yield one json object per line, a batch of rows at a time."""
+
+    for batch in _batches(rows):
+        yield "".join(
+            json.dumps({f: _jsonable(v) for f, v in zip(LEDGER_FIELDS, row)}) + "\n"
+            for row in batch)
+
+
+def gzip_chunks(chunks):
+    """Gzip a stream of text chunks as they are produced."""
+
+    # wbits=31 gives us a gzip header and trailer rather than raw zlib
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode("utf8"))
+
+        if data:
+            yield data
+
+    yield compressor.flush()
+
+
+###############################################################################
+# restore
+
+# what we accept as true for "favorite" in a csv file
+TRUE_STRINGS = ("true", "t", "1", "yes", "y")
+
+
+def ledger_format(filename):
+    """Work out a ledger file's format from its name.
+
+    Returns (fmt, gzipped) or raises ValueError for unknown formats.
+    """
+
+    name = filename.lower()
+    gzipped = name.endswith(".gz")
+
+    if gzipped:
+        name = name[:-3]
+
+    for fmt in EXPORT_FORMATS:
+        if name.endswith(f".{fmt}"):
+            return (fmt, gzipped)
+
+    raise ValueError(f"Unknown ledger file type: {filename}")
+
+
+def open_ledger(stream, filename):
+    """Wrap a binary upload or file in a text stream of ledger records.
+
+    Returns a generator of dicts, one per csv row or ndjson line.
+    """
+
+    fmt, gzipped = ledger_format(filename)
+
+    if gzipped:
+        stream = gzip.GzipFile(fileobj=stream)
+
+    text_stream = io.TextIOWrapper(stream, encoding="utf8", newline="")
+
+    if fmt == "csv":
+        return iter(csv.DictReader(text_stream))
+
+    return (_json_record(line) for line in text_stream if line.strip())
+
+
+def _json_record(line):
+    """Parse an ndjson line, a bad line becomes an empty (skipped) record."""
+
+    try:
+        record = json.loads(line)
+    except ValueError:
+        return {}
+
+    return record if isinstance(record, dict) else {}
+
+
+def _parse_date(value):
+    """Parse an iso date (or date) from a ledger file, empty is None."""
+
+    if not value:
+        return None
+
+    return value if isinstance(value, date) else date.fromisoformat(value)
+
+
+def normalize_record(record, user_id=None):
+    """Turn a ledger record into a row for the restore staging table.
+
+    user_id, if given, overrides any user_id in the record.  Returns
+    None for records we can't use, they are counted as skipped.
+    """
+
+    try:
+        imdb_id = (record.get("imdb_id") or "").strip()
+        user_id = int(user_id if user_id is not None else record.get("user_id"))
+
+        if not imdb_id or len(imdb_id) > 10:
+            return None
+
+        favorite = record.get("favorite")
+
+        if isinstance(favorite, str):
+            favorite = favorite.strip().lower() in TRUE_STRINGS
+
+        return (imdb_id,
+                user_id,
+                record.get("title") or None,
+                (record.get("year") or "")[0:4] or None,
+                record.get("actors") or None,
+                record.get("imdb_img") or None,
+                "t" if favorite else "f",
+                record.get("platform") or None,
+                _parse_date(record.get("date_viewed")),
+                _parse_date(record.get("date_added")) or date.today())
+
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+
+class _ChunkReader:
+    """Just enough of a file object over an iterator of strings for COPY."""
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._buf = ""
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buf) < size:
+            chunk = next(self._chunks, None)
+
+            if chunk is None:
+                break
+
+            self._buf += chunk
+
+        if size < 0:
+            size = len(self._buf)
+
+        data, self._buf = self._buf[:size], self._buf[size:]
+
+        return data
+
+
+# every user with a row in the file gets a new ledger version, even if
+# nothing changed, which is harmless
+RESTORE_BUMP_SQL = """
+UPDATE users SET ledger_version = ledger_version + 1,
+    ledger_updated_at = now() AT TIME ZONE 'utc'
+WHERE id IN (SELECT DISTINCT user_id FROM ledger_restore)
+"""
+
+RESTORE_STAGING_SQL = """
+CREATE TEMP TABLE ledger_restore (
+    imdb_id text,
+    user_id integer,
+    title text,
+    year text,
+    actors text,
+    imdb_img text,
+    favorite boolean,
+    platform text,
+    date_viewed date,
+    date_added date
+) ON COMMIT DROP
+"""
+
+RESTORE_COPY_SQL = "COPY ledger_restore FROM STDIN WITH (FORMAT csv)"
+
+# with trust_titles, titles we haven't seen before go into the catalog,
+# titles we already have keep their current (api sourced) data
+RESTORE_TITLES_SQL = """
+INSERT INTO titles (imdb_id, title, year, actors, imdb_img)
+SELECT DISTINCT ON (imdb_id) imdb_id, title, year, actors, imdb_img
+FROM ledger_restore
+WHERE title IS NOT NULL AND year IS NOT NULL AND imdb_img IS NOT NULL
+ORDER BY imdb_id
+ON CONFLICT (imdb_id) DO NOTHING
+"""
+
+# rows for unknown users or titles not in the catalog are skipped by
+# the joins.  unchanged rows are skipped by the WHERE on the update.
+# xmax is 0 only for freshly inserted rows.
+RESTORE_MERGE_SQL = """
+WITH merged AS (
+    INSERT INTO movies (imdb_id, user_id, favorite, platform, date_viewed, date_added)
+    SELECT DISTINCT ON (r.imdb_id, r.user_id)
+        r.imdb_id, r.user_id, r.favorite, r.platform, r.date_viewed, r.date_added
+    FROM ledger_restore r
+    JOIN titles t ON t.imdb_id = r.imdb_id
+    JOIN users u ON u.id = r.user_id
+    ORDER BY r.imdb_id, r.user_id
+    ON CONFLICT (imdb_id, user_id) DO UPDATE SET
+        favorite = EXCLUDED.favorite,
+        platform = EXCLUDED.platform,
+        date_viewed = EXCLUDED.date_viewed,
+        date_added = EXCLUDED.date_added
+    WHERE (movies.favorite, movies.platform, movies.date_viewed, movies.date_added)
+        IS DISTINCT FROM
+        (EXCLUDED.favorite, EXCLUDED.platform, EXCLUDED.date_viewed, EXCLUDED.date_added)
+    RETURNING (xmax = 0) AS inserted
+)
+SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted)
+FROM merged
+"""
+
+
+def _restore_postgresql(cursor, rows, trust_titles):
+    """COPY and merge rows into postgres, returns (inserted, updated)."""
+
+    cursor.execute(RESTORE_STAGING_SQL)
+    cursor.copy_expert(RESTORE_COPY_SQL, _ChunkReader(_csv_rows(rows)))
+
+    if trust_titles:
+        cursor.execute(RESTORE_TITLES_SQL)
+
+    cursor.execute(RESTORE_MERGE_SQL)
+    inserted, updated = cursor.fetchone()
+    cursor.execute(RESTORE_BUMP_SQL)
+
+    return (inserted, updated)
+
+
+###############################################################################
+# sqlite restores
+#
+# sqlite has no COPY, DISTINCT ON, xmax or ON COMMIT DROP, so the same
+# merge is spelled out differently: rows are staged with executemany,
+# duplicates are dropped from the staging table up front (the last one
+# wins), and inserted/updated are counted before the upsert.
+
+SQLITE_STAGING_SQL = """
+CREATE TEMP TABLE ledger_restore (
+    imdb_id text,
+    user_id integer,
+    title text,
+    year text,
+    actors text,
+    imdb_img text,
+    favorite boolean,
+    platform text,
+    date_viewed date,
+    date_added date
+)
+"""
+
+SQLITE_INSERT_SQL = "INSERT INTO ledger_restore VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+
+SQLITE_DEDUPE_SQL = """
+DELETE FROM ledger_restore WHERE rowid NOT IN (
+    SELECT max(rowid) FROM ledger_restore GROUP BY imdb_id, user_id)
+"""
+
+SQLITE_TITLES_SQL = """
+INSERT INTO titles (imdb_id, title, year, actors, imdb_img)
+SELECT imdb_id, title, year, actors, imdb_img
+FROM ledger_restore
+WHERE title IS NOT NULL AND year IS NOT NULL AND imdb_img IS NOT NULL
+GROUP BY imdb_id
+ON CONFLICT (imdb_id) DO NOTHING
+"""
+
+# does a row have anything new for the movie it matches
+_SQLITE_CHANGED = """
+    movies.favorite IS NOT {new}.favorite OR movies.platform IS NOT {new}.platform
+    OR movies.date_viewed IS NOT {new}.date_viewed OR movies.date_added IS NOT {new}.date_added
+"""
+
+SQLITE_COUNT_SQL = f"""
+SELECT count(*) FILTER (WHERE movies.imdb_id IS NULL),
+    count(*) FILTER (WHERE movies.imdb_id IS NOT NULL AND ({_SQLITE_CHANGED.format(new="r")}))
+FROM ledger_restore r
+JOIN titles t ON t.imdb_id = r.imdb_id
+JOIN users u ON u.id = r.user_id
+LEFT JOIN movies ON movies.imdb_id = r.imdb_id AND movies.user_id = r.user_id
+"""
+
+# the WHERE true keeps sqlite from reading ON CONFLICT as a join constraint
+SQLITE_MERGE_SQL = f"""
+INSERT INTO movies (imdb_id, user_id, favorite, platform, date_viewed, date_added)
+SELECT r.imdb_id, r.user_id, r.favorite, r.platform, r.date_viewed, r.date_added
+FROM ledger_restore r
+JOIN titles t ON t.imdb_id = r.imdb_id
+JOIN users u ON u.id = r.user_id
+WHERE true
+ON CONFLICT (imdb_id, user_id) DO UPDATE SET
+    favorite = excluded.favorite,
+    platform = excluded.platform,
+    date_viewed = excluded.date_viewed,
+    date_added = excluded.date_added
+WHERE {_SQLITE_CHANGED.format(new="excluded")}
+"""
+
+SQLITE_BUMP_SQL = """
+UPDATE users SET ledger_version = ledger_version + 1,
+    ledger_updated_at = datetime('now')
+WHERE id IN (SELECT DISTINCT user_id FROM ledger_restore)
+"""
+
+
+def _sqlite_row(row):
+    """Store a staging row the way SQLAlchemy stores booleans and dates in sqlite."""
+
+    (imdb_id, user_id, title, year, actors, imdb_img,
+        favorite, platform, date_viewed, date_added) = row
+
+    return (imdb_id, user_id, title, year, actors, imdb_img,
+            1 if favorite == "t" else 0, platform,
+            date_viewed.isoformat() if date_viewed else None,
+            date_added.isoformat())
+
+
+def _restore_sqlite(cursor, rows, trust_titles):
+    """Stage and merge rows into a sqlite database, returns (inserted, updated)."""
+
+    cursor.execute("DROP TABLE IF EXISTS temp.ledger_restore")
+    cursor.execute(SQLITE_STAGING_SQL)
+
+    try:
+        cursor.executemany(SQLITE_INSERT_SQL, map(_sqlite_row, rows))
+        cursor.execute(SQLITE_DEDUPE_SQL)
+
+        if trust_titles:
+            cursor.execute(SQLITE_TITLES_SQL)
+
+        cursor.execute(SQLITE_COUNT_SQL)
+        inserted, updated = cursor.fetchone()
+        cursor.execute(SQLITE_MERGE_SQL)
+        cursor.execute(SQLITE_BUMP_SQL)
+    finally:
+        cursor.execute("DROP TABLE IF EXISTS temp.ledger_restore")
+
+    return (inserted, updated)
+
+
+def restore_ledger(records, user_id=None, trust_titles=False):
+    """Bulk load ledger records with COPY and merge them into movies.
+
+    Records are staged in a temp table with a single COPY, then merged
+    with two set based upserts, all in the current transaction.  On
+    sqlite they're staged with executemany instead.  The caller is
+    responsible for committing.
+
+    The titles catalog is shared by every user, so by default records
+    only go in for titles already in it, and their title data is
+    ignored.  Only with trust_titles (our own data: seeding, moving
+    shards, an admin's load) do unknown titles go into the catalog from
+    the records.
+
+    Returns a dict of inserted, updated and skipped counts.
+    """
+
+    counts = {"total": 0}
+
+    def rows():
+        for record in records:
+            counts["total"] += 1
+            row = normalize_record(record, user_id)
+
+            if row is not None:
+                yield row
+
+    # run on the session's own connection so we share its transaction
+    cursor = db.session.connection().connection.cursor()
+
+    restore = _restore_sqlite if dialect(db.session) == "sqlite" else _restore_postgresql
+
+    try:
+        inserted, updated = restore(cursor, rows(), trust_titles)
+    finally:
+        cursor.close()
+
+    return {
+        "inserted": inserted,
+        "updated": updated,
+        "skipped": counts["total"] - inserted - updated,
+    }
+
+
+EXPORT_FORMATS = {
+    "csv": {"mimetype": "text/csv", "write": csv_chunks},
+    "ndjson": {"mimetype": "application/x-ndjson", "write": ndjson_chunks},
+}
@@ -0,0 +1,241 @@
+"""Time each request and expose the numbers.
+
+For every request we add up the time spent in postgres (and the number
+of queries), in the omdb api (and the number of calls) and rendering
+templates.  Those go back to the browser in a Server-Timing header,
+so they show up in the devtools network tab, and are aggregated per
+endpoint into histograms served in the Prometheus text format at
+/metrics.
+
+Each gunicorn worker keeps its own numbers, so scrape every worker (or
+sum them up) when running more than one.
+"""
+
+import hmac
+import time
+from threading import Lock
+
+from flask import g, has_request_context, request, Response, abort
+from flask import before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from services import api_called
+from streaming import after_stream
+
+
+# upper bounds (seconds) of our request latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# the parts of a request we time, in Server-Timing order
+TIMED_PARTS = ("db", "omdb", "tmpl")
+
+
+class Histogram:
+    """Cumulative bucket counts plus a sum and count, Prometheus style."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+        self.sum += value
+        self.count += 1
+
+
+class RequestMetrics:
+    """Per endpoint request latencies and time spent in each part."""
+
+    def __init__(self):
+        self._lock = Lock()
+        # endpoint -> Histogram of total request time
+        self.latency = {}
+        # (endpoint, part) -> [seconds, count]
+        self.parts = {}
+        # (endpoint, status) -> count
+        self.responses = {}
+
+    def record(self, endpoint, status, total, timings):
+        with self._lock:
+            self.latency.setdefault(endpoint, Histogram()).observe(total)
+
+            key = (endpoint, status)
+            self.responses[key] = self.responses.get(key, 0) + 1
+
+            for part, (seconds, count) in timings.items():
+                totals = self.parts.setdefault((endpoint, part), [0.0, 0])
+                totals[0] += seconds
+                totals[1] += count
+
+    def render(self):
+        """Return everything in the Prometheus text exposition format."""
+
+        lines = []
+
+        with self._lock:
+            lines.append("# HELP movie_ledger_request_duration_seconds Time spent handling requests.")
+            lines.append("# TYPE movie_ledger_request_duration_seconds histogram")
+
+            for endpoint, h in sorted(self.latency.items()):
+                for bound, count in zip(h.buckets, h.counts):
+                    lines.append(f'movie_ledger_request_duration_seconds_bucket{{endpoint="{endpoint}",le="{bound}"}} {count}')
+                lines.append(f'movie_ledger_request_duration_seconds_bucket{{endpoint="{endpoint}",le="+Inf"}} {h.count}')
+                lines.append(f'movie_ledger_request_duration_seconds_sum{{endpoint="{endpoint}"}} {h.sum:.6f}')
+                lines.append(f'movie_ledger_request_duration_seconds_count{{endpoint="{endpoint}"}} {h.count}')
+
+            lines.append("# HELP movie_ledger_responses_total Responses sent, by status.")
+            lines.append("# TYPE movie_ledger_responses_total counter")
+
+            for (endpoint, status), count in sorted(self.responses.items()):
+                lines.append(f'movie_ledger_responses_total{{endpoint="{endpoint}",status="{status}"}} {count}')
+
+            lines.append("# HELP movie_ledger_part_seconds_total Time spent in the db, the omdb api and templates.")
+            lines.append("# TYPE movie_ledger_part_seconds_total counter")
+            lines.append("# HELP movie_ledger_part_calls_total Queries, api calls and template renders.")
+            lines.append("# TYPE movie_ledger_part_calls_total counter")
+
+            for (endpoint, part), (seconds, count) in sorted(self.parts.items()):
+                lines.append(f'movie_ledger_part_seconds_total{{endpoint="{endpoint}",part="{part}"}} {seconds:.6f}')
+                lines.append(f'movie_ledger_part_calls_total{{endpoint="{endpoint}",part="{part}"}} {count}')
+
+        return "\n".join(lines) + "\n"
+
+
+request_metrics = RequestMetrics()
+
+
+###############################################################################
+# timing
+
+def add_timing(part, seconds):
+    """Add time spent in one part of the current request, if there is one."""
+
+    if not has_request_context():
+        return
+
+    timings = g.get("timings")
+
+    if timings is None:
+        return
+
+    totals = timings.setdefault(part, [0.0, 0])
+    totals[0] += seconds
+    totals[1] += 1
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _query_started(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _query_finished(conn, cursor, statement, parameters, context, executemany):
+    add_timing("db", time.perf_counter() - conn.info["query_start"].pop())
+
+
+@event.listens_for(Engine, "handle_error")
+def _query_failed(context):
+    # after_cursor_execute never runs for a failed query
+    starts = context.connection.info.get("query_start") if context.connection else None
+
+    if starts:
+        starts.pop()
+
+
+def _api_called(sender, seconds, **extra):
+    add_timing("omdb", seconds)
+
+
+def _template_started(sender, template, context, **extra):
+    g.template_start = time.perf_counter()
+
+
+def _template_finished(sender, template, context, **extra):
+    start = g.pop("template_start", None)
+
+    if start is not None:
+        add_timing("tmpl", time.perf_counter() - start)
+
+
+def server_timing(timings, total):
+    """Build the Server-Timing header value for a request."""
+
+    entries = []
+
+    for part in TIMED_PARTS:
+        if part in timings:
+            seconds, count = timings[part]
+            entries.append(f'{part};dur={seconds * 1000:.1f};desc="{count}x"')
+
+    entries.append(f"total;dur={total * 1000:.1f}")
+
+    return ", ".join(entries)
+
+
+###############################################################################
+# flask setup
+
+def init_app(app):
+    """Time every request, and serve the numbers at /metrics.
+
+    Call this before registering other before_request functions, so
+    their queries are counted as part of the request.
+
+    Set METRICS_TOKEN to require "Authorization: Bearer <token>" for
+    /metrics.
+    """
+
+    app.config.setdefault("METRICS_TOKEN", None)
+
+    @app.before_request
+    def start_timing():
+        g.request_start = time.perf_counter()
+        g.timings = {}
+
+    @app.after_request
+    def finish_timing(response):
+        start = g.get("request_start")
+
+        if start is None:
+            return response
+
+        total = time.perf_counter() - start
+        endpoint = request.endpoint or "unknown"
+        timings = g.timings
+
+        # the header goes out before a streamed body, so it only has what
+        # happened up to now.  the metrics wait for the body to be sent.
+        response.headers["Server-Timing"] = server_timing(timings, total)
+
+        if response.is_streamed:
+            after_stream(response, lambda: request_metrics.record(
+                endpoint, response.status_code, time.perf_counter() - start, timings))
+        else:
+            request_metrics.record(endpoint, response.status_code, total, timings)
+
+        return response
+
+    before_render_template.connect(_template_started, app)
+    template_rendered.connect(_template_finished, app)
+    api_called.connect(_api_called)
+
+    @app.route("/metrics")
+    def show_metrics():
+        """Request metrics for Prometheus to scrape."""
+
+        token = app.config["METRICS_TOKEN"]
+
+        # compared in constant time, like the profiler's token
+        if token and not hmac.compare_digest(
+                request.headers.get("Authorization", "").encode("utf8"),
+                f"Bearer {token}".encode("utf8")):
+            abort(401)
+
+        return Response(request_metrics.render(),
+                        content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,149 @@
+# Move title metadata off of the movies table and into the shared
+# titles catalog, without taking the site down.
+#
+# run using
+#   $ python migrate_titles.py expand
+#   (deploy the new code)
+#   $ python migrate_titles.py contract
+#
+# expand:   create titles, relax the old NOT NULL columns on movies and
+#           add a trigger so rows written or edited by not-yet-upgraded
+#           workers still land in the catalog.  the foreign key is added
+#           NOT VALID so it is enforced for new rows without scanning
+#           the table under a lock.  then backfill.
+# backfill: copy the distinct titles out of movies in small batches,
+#           committing after each so no long lock is ever held.  the
+#           new code inner joins movies to titles, so every movie must
+#           have its title before it's deployed: expand runs this, and
+#           it can be run again (it skips titles already copied).
+# contract: validate the foreign key, then drop the trigger and the
+#           old columns.  only run this once every worker is on the
+#           new code.
+#
+# postgres only.  sqlite databases (see backends.py) only ever exist in
+# the new shape, db.create_all() builds the catalog for them.
+
+import sys
+
+from sqlalchemy.sql import text
+
+from models import db, Title
+from app import app
+from backends import dialect
+
+
+BATCH_SIZE = 1000
+
+
+EXPAND_SQL = """
+ALTER TABLE movies ALTER COLUMN title DROP NOT NULL;
+ALTER TABLE movies ALTER COLUMN year DROP NOT NULL;
+ALTER TABLE movies ALTER COLUMN imdb_img DROP NOT NULL;
+
+CREATE OR REPLACE FUNCTION movies_sync_title() RETURNS trigger AS $$
+BEGIN
+    IF NEW.title IS NOT NULL THEN
+        INSERT INTO titles (imdb_id, title, year, actors, imdb_img)
+        VALUES (NEW.imdb_id, NEW.title, NEW.year, NEW.actors, NEW.imdb_img)
+        ON CONFLICT (imdb_id) DO NOTHING;
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS movies_sync_title ON movies;
+CREATE TRIGGER movies_sync_title BEFORE INSERT OR UPDATE ON movies
+    FOR EACH ROW EXECUTE PROCEDURE movies_sync_title();
+
+ALTER TABLE movies DROP CONSTRAINT IF EXISTS movies_imdb_id_fkey;
+ALTER TABLE movies ADD CONSTRAINT movies_imdb_id_fkey
+    FOREIGN KEY (imdb_id) REFERENCES titles (imdb_id) NOT VALID;
+"""
+
+# the most recently added row for a title has the freshest api data
+BACKFILL_SQL = """
+INSERT INTO titles (imdb_id, title, year, actors, imdb_img)
+SELECT DISTINCT ON (imdb_id) imdb_id, title, year, actors, imdb_img
+FROM movies
+WHERE imdb_id = ANY(:ids) AND title IS NOT NULL
+ORDER BY imdb_id, date_added DESC
+ON CONFLICT (imdb_id) DO NOTHING
+"""
+
+NEXT_BATCH_SQL = """
+SELECT DISTINCT imdb_id FROM movies
+WHERE imdb_id > :last
+ORDER BY imdb_id
+LIMIT :limit
+"""
+
+CONTRACT_SQL = """
+ALTER TABLE movies VALIDATE CONSTRAINT movies_imdb_id_fkey;
+DROP TRIGGER IF EXISTS movies_sync_title ON movies;
+DROP FUNCTION IF EXISTS movies_sync_title();
+ALTER TABLE movies DROP COLUMN IF EXISTS title;
+ALTER TABLE movies DROP COLUMN IF EXISTS year;
+ALTER TABLE movies DROP COLUMN IF EXISTS actors;
+ALTER TABLE movies DROP COLUMN IF EXISTS imdb_img;
+"""
+
+
+def expand():
+    """Create the catalog, keep it in sync with old style writes and fill
+    it in.
+
+    Returns the number of titles backfilled.
+    """
+
+    Title.__table__.create(db.engine, checkfirst=True)
+
+    with db.engine.begin() as conn:
+        conn.execute(text(EXPAND_SQL))
+
+    # after the trigger, so nothing written while this runs is missed
+    return backfill()
+
+
+def backfill(batch_size=BATCH_SIZE):
+    """Copy titles out of movies, one short transaction per batch.
+
+    Returns the number of titles inserted.
+    """
+
+    last = ""
+    inserted = 0
+
+    while True:
+        with db.engine.begin() as conn:
+            ids = [row[0] for row in conn.execute(
+                text(NEXT_BATCH_SQL), last=last, limit=batch_size)]
+
+            if not ids:
+                return inserted
+
+            inserted += conn.execute(text(BACKFILL_SQL), ids=ids).rowcount
+
+        last = ids[-1]
+
+
+def contract():
+    """Validate the foreign key and drop the old per-user copies."""
+
+    with db.engine.begin() as conn:
+        conn.execute(text(CONTRACT_SQL))
+
+
+if __name__ == "__main__":
+    phases = {"expand": expand, "backfill": backfill, "contract": contract}
+
+    if len(sys.argv) != 2 or sys.argv[1] not in phases:
+        sys.exit(f"usage: python migrate_titles.py {'|'.join(phases)}")
+
+    with app.app_context():
+        if dialect(db.session) != "postgresql":
+            sys.exit("migrate_titles.py only migrates postgres databases")
+
+        result = phases[sys.argv[1]]()
+
+    if sys.argv[1] in ("expand", "backfill"):
+        print(f"{result} titles copied to the catalog")
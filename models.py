@@ -1,11 +1,16 @@
 """Models for Movie Ledger."""
 
-from flask_sqlalchemy import SQLAlchemy
 from flask_bcrypt import Bcrypt
+from sqlalchemy import event
+from sqlalchemy.ext.hybrid import hybrid_property
+
+from backends import supports_returning
+from replicas import RoutingSQLAlchemy
 
 from datetime import datetime
 
-db = SQLAlchemy()
+# reads can go to read replicas, see replicas.py
+db = RoutingSQLAlchemy()
 bcrypt = Bcrypt()
 
 
@@ -13,6 +18,7 @@ def connect_db(app):
     """Connect to the database."""
     db.app = app
     db.init_app(app)
+    bcrypt.init_app(app)
 
 
 class User(db.Model):
@@ -32,12 +38,26 @@ class User(db.Model):
                     default=None,
                     nullable=False)
 
+    # bumped on every write to the user's ledger, so responses built
+    # from the ledger can be validated with an ETag (see app.py)
+    ledger_version = db.Column(db.Integer,
+                    default=0,
+                    server_default="0",
+                    nullable=False)
+    ledger_updated_at = db.Column(db.DateTime,
+                    default=datetime.utcnow,
+                    nullable=True)
+
 
     # define our relationship for users to movies, and backref
     #
     # the first arg in the relationship method is the class name
     # of the model we want to reference with this relationship
-    movies = db.relationship('Movie', backref='user', cascade='all, delete')
+    #
+    # passive_deletes leaves deleting a user's movies to the database's
+    # ON DELETE CASCADE instead of loading every movie to delete it
+    movies = db.relationship('Movie', backref='user', cascade='all, delete',
+                    passive_deletes=True)
 
 
     def __repr__(self):
@@ -47,8 +67,11 @@ class User(db.Model):
 
 
     @classmethod
-    def signup(cls, username, password, email, img_url=None):
-        """Signup a user with a hashed password and return the user."""
+    def signup(cls, username, password, email, img_url=None, id=None):
+        """Signup a user with a hashed password and return the user.
+
+        id is for sharded setups, where the shard map picks it.
+        """
 
         # hash our users password with bcrypt
         hashed = bcrypt.generate_password_hash(password)
@@ -57,6 +80,7 @@ class User(db.Model):
         # create our user object with the newly hashed password and
         # the data passed from app.py/signup
         user = User(
+                id=id,
                 username=username,
                 password=hashed_pwd,
                 email=email,
@@ -81,6 +105,20 @@ class User(db.Model):
             return False
 
 
+    @classmethod
+    def bump_ledger_version(cls, user_id):
+        """Mark a user's ledger as changed.
+
+        The increment happens in sql so concurrent writes never hand out
+        the same version twice.  The caller is responsible for committing.
+        """
+
+        cls.query.filter_by(id=user_id).update({
+                cls.ledger_version: cls.ledger_version + 1,
+                cls.ledger_updated_at: datetime.utcnow()
+            }, synchronize_session=False)
+
+
     def hash_password(password):
         # hash our users password with bcrypt
         hashed = bcrypt.generate_password_hash(password)
@@ -89,24 +127,131 @@ class User(db.Model):
 
 
 
-class Movie(db.Model):
-    __tablename__ = "movies"
+class Title(db.Model):
+    """Shared catalog of title metadata, one row per imdb_id.
+
+    Every user's ledger entry for a title points at the same row here,
+    so refreshing a title's metadata is a single row update.
+    """
+
+    __tablename__ = "titles"
 
     imdb_id = db.Column(db.String(10),
                         primary_key=True)
-    user_id = db.Column(db.Integer,
-                        db.ForeignKey('users.id'),
-                        primary_key=True)
     title = db.Column(db.Text,
                         nullable=False)
     year = db.Column(db.String(4),
                         nullable=False)
     actors = db.Column(db.Text,
                         nullable=True)
-    platform = db.Column(db.Text,
-                        nullable=True)
     imdb_img = db.Column(db.Text,
                         nullable=False)
+
+    # ledger adds plus favorites, kept up to date by popularity.py.  the
+    # index makes the all time leaderboard a read of its first rows.
+    popularity = db.Column(db.Integer,
+                        default=0,
+                        server_default="0",
+                        nullable=False,
+                        index=True)
+
+
+    def __repr__(self):
+        """Show Info about title"""
+
+        t = self
+
+        return f"<Title imdb_id={t.imdb_id} title={t.title} year={t.year}>"
+
+
+class PopularityBucket(db.Model):
+    """A title's popularity gained (or lost) on one day.
+
+    The recent leaderboards add up the last few days of buckets, old
+    buckets are compacted away (see popularity.py).
+    """
+
+    __tablename__ = "popularity_buckets"
+
+    imdb_id = db.Column(db.String(10),
+                        db.ForeignKey('titles.imdb_id'),
+                        primary_key=True)
+    day = db.Column(db.Date,
+                        primary_key=True,
+                        index=True)
+    points = db.Column(db.Integer,
+                        default=0,
+                        nullable=False)
+
+
+class UserShard(db.Model):
+    """Which shard a user lives in (see shards.py).
+
+    Only in the main database.  Hands out user ids, so they're unique
+    across the shards, and keeps usernames unique across them too.
+    """
+
+    __tablename__ = "user_shards"
+
+    user_id = db.Column(db.Integer,
+                        primary_key=True,
+                        autoincrement=True)
+    username = db.Column(db.String(20),
+                        unique=True,
+                        nullable=False)
+    shard = db.Column(db.String(20),
+                        nullable=False)
+
+
+# the columns that used to live on every movies row and now live on titles
+TITLE_FIELDS = ("title", "year", "actors", "imdb_img")
+
+
+def _title_field(name):
+    """Expose a Title column on Movie so existing code keeps working.
+
+    Reads and writes go to the shared catalog row.  Until a new movie
+    has been flushed it has no catalog row yet, so the values are held
+    on the movie and moved to the catalog in _attach_titles below.
+
+    At the class level the expression is the Title column, so queries
+    that filter or sort on it need to join Movie.catalog.
+    """
+
+    def fget(self):
+        if self.catalog is not None:
+            return getattr(self.catalog, name)
+        return self.__dict__.get("_title_data", {}).get(name)
+
+    def fset(self, value):
+        if self.catalog is not None:
+            setattr(self.catalog, name, value)
+        else:
+            self.__dict__.setdefault("_title_data", {})[name] = value
+
+    def expr(cls):
+        return getattr(Title, name)
+
+    return hybrid_property(fget, fset, expr=expr)
+
+
+class Movie(db.Model):
+    """A single entry in a user's ledger.
+
+    Only the per-user fields are stored here, title metadata comes from
+    the shared Title catalog through the catalog relationship.
+    """
+
+    __tablename__ = "movies"
+
+    imdb_id = db.Column(db.String(10),
+                        db.ForeignKey('titles.imdb_id'),
+                        primary_key=True)
+    user_id = db.Column(db.Integer,
+                        db.ForeignKey('users.id', ondelete='CASCADE'),
+                        primary_key=True)
+    platform = db.Column(db.Text,
+                        nullable=True)
     favorite = db.Column(db.Boolean,
                         default=False,
                         nullable=False)
@@ -117,6 +262,16 @@ class Movie(db.Model):
                         nullable=False)
 
 
+    # the catalog row is always needed to render a movie, so load it
+    # in the same query as the ledger entry
+    catalog = db.relationship('Title', lazy='joined', innerjoin=True)
+
+    title = _title_field("title")
+    year = _title_field("year")
+    actors = _title_field("actors")
+    imdb_img = _title_field("imdb_img")
+
+
     # define our relationship for users to movies, and backref
     #
     # the first arg in the relationship method is the class name
@@ -129,4 +284,111 @@ class Movie(db.Model):
        
         m = self
        
-        return f"<Movie imdb_id={m.imdb_id} user_id={m.user_id} title={m.title} year={m.year} favorite={m.favorite} platform={m.platform}>"
\ No newline at end of file
+        return f"<Movie imdb_id={m.imdb_id} user_id={m.user_id} title={m.title} year={m.year} favorite={m.favorite} platform={m.platform}>"
+
+
+    @classmethod
+    def batch_update(cls, user_id, imdb_ids, **values):
+        """Set values on many of a user's movies with one UPDATE.
+
+        Returns the set of imdb_ids that were actually in the ledger.
+        The caller is responsible for committing.
+        """
+
+        if not supports_returning(db.session):
+            imdb_ids = cls._batch_ids(user_id, imdb_ids)
+
+            if imdb_ids:
+                db.session.execute(cls.__table__.update()
+                    .where(cls.user_id == user_id)
+                    .where(cls.imdb_id.in_(imdb_ids))
+                    .values(**values))
+
+            return imdb_ids
+
+        stmt = (cls.__table__.update()
+                    .where(cls.user_id == user_id)
+                    .where(cls.imdb_id.in_(imdb_ids))
+                    .values(**values)
+                    .returning(cls.imdb_id))
+
+        return {row.imdb_id for row in db.session.execute(stmt)}
+
+
+    @classmethod
+    def batch_delete(cls, user_id, imdb_ids):
+        """Delete many of a user's movies with one DELETE.
+
+        Returns the set of imdb_ids that were actually in the ledger.
+        The caller is responsible for committing.
+        """
+
+        if not supports_returning(db.session):
+            imdb_ids = cls._batch_ids(user_id, imdb_ids)
+
+            if imdb_ids:
+                db.session.execute(cls.__table__.delete()
+                    .where(cls.user_id == user_id)
+                    .where(cls.imdb_id.in_(imdb_ids)))
+
+            return imdb_ids
+
+        stmt = (cls.__table__.delete()
+                    .where(cls.user_id == user_id)
+                    .where(cls.imdb_id.in_(imdb_ids))
+                    .returning(cls.imdb_id))
+
+        return {row.imdb_id for row in db.session.execute(stmt)}
+
+
+    @classmethod
+    def _batch_ids(cls, user_id, imdb_ids):
+        """The imdb_ids that are in a user's ledger, for databases
+        without RETURNING.  Run in the same transaction as the write.
+        """
+
+        stmt = (db.select([cls.imdb_id])
+                    .where(cls.user_id == user_id)
+                    .where(cls.imdb_id.in_(imdb_ids)))
+
+        return {row.imdb_id for row in db.session.execute(stmt)}
+
+
+@event.listens_for(db.session, "before_flush")
+def _attach_titles(session, flush_context, instances):
+    """Point new movies at their catalog row, creating it if needed.
+
+    The catalog row is shared by every ledger with the title, so a new
+    movie's title data only fills a row that's new (or fields it lacks),
+    it never overwrites what's there.  Views take that data from the
+    api, not from the request.
+
+    Several pending movies can share an imdb_id (different users), so
+    we keep track of the titles we've already resolved in this flush.
+    """
+
+    resolved = {}
+
+    for obj in list(session.new):
+        if not isinstance(obj, Movie) or obj.catalog is not None:
+            continue
+
+        data = obj.__dict__.pop("_title_data", {})
+
+        t = resolved.get(obj.imdb_id)
+
+        if t is None:
+            with session.no_autoflush:
+                t = session.query(Title).get(obj.imdb_id)
+
+            if t is None:
+                t = Title(imdb_id=obj.imdb_id)
+                session.add(t)
+
+            resolved[obj.imdb_id] = t
+
+        for name, value in data.items():
+            if value is not None and getattr(t, name) is None:
+                setattr(t, name, value)
+
+        obj.catalog = t
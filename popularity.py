@@ -0,0 +1,329 @@
+"""Popular titles, this week and of all time.
+
+Every title has a popularity score: a point for each ledger it's in,
+plus a point for each user who has it as a favorite.  Scores are kept
+as counters, adjusted by every write to a ledger, so showing the
+leaderboards never means counting up the movies table:
+
+- titles.popularity is the all time score, and its index makes the all
+  time leaderboard a read of the top rows.
+- popularity_buckets holds the points each title gained (or lost) per
+  day, and "this week" adds up the last WINDOW_DAYS of them.
+
+Writes through the ORM (adding a movie, changing a favorite) are
+counted by a flush listener.  Bulk writes (deletes, batches, restores)
+don't go through the ORM, so those take ledger_points() before and
+record() the changes() after.
+
+The leaderboards are cached per worker for LEADERBOARD_TTL seconds, so
+most page views just read the top N from memory.
+
+With shards (see shards.py) each shard counts its own users' ledgers,
+and the leaderboards add up each shard's top N.  A title just outside
+the top N on every shard can miss out, which is fine for a leaderboard.
+
+Buckets too old for the window are dropped by compaction, run it every
+hour or so (cron, Heroku Scheduler):
+
+    $ python popularity.py compact
+
+and give an existing database its all time scores with:
+
+    $ python popularity.py rebuild
+"""
+
+import sys
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+from threading import Lock
+
+from sqlalchemy import bindparam, event, func, inspect
+from sqlalchemy.sql import text
+
+from models import db, Movie, Title, PopularityBucket
+from shards import all_shards, each_shard
+
+
+# what a title scores for being in a ledger, and for being a favorite
+ADD_POINTS = 1
+FAVORITE_POINTS = 1
+
+# how many days "this week" covers, today included
+WINDOW_DAYS = 7
+
+# titles per leaderboard
+LEADERBOARD_SIZE = 10
+
+# a leaderboard row
+Entry = namedtuple("Entry", "imdb_id title year imdb_img points")
+
+
+def points(favorite):
+    """What one ledger entry is worth to its title."""
+
+    return ADD_POINTS + (FAVORITE_POINTS if favorite else 0)
+
+
+def today():
+    """Buckets are utc days, like the rest of our timestamps."""
+
+    return datetime.utcnow().date()
+
+
+###############################################################################
+# counting
+
+def ledger_points(user_id, imdb_ids=None):
+    """What each of a user's movies is worth, {imdb_id: points}.
+
+    imdb_ids limits it to those movies, otherwise it's the whole ledger.
+    """
+
+    query = (db.session.query(Movie.imdb_id, Movie.favorite)
+                .filter(Movie.user_id == user_id))
+
+    if imdb_ids is not None:
+        query = query.filter(Movie.imdb_id.in_(imdb_ids))
+
+    return {imdb_id: points(favorite) for imdb_id, favorite in query}
+
+
+def changes(before, after):
+    """The points each title gained between two ledger_points()."""
+
+    deltas = {}
+
+    for imdb_id in before.keys() | after.keys():
+        delta = after.get(imdb_id, 0) - before.get(imdb_id, 0)
+
+        if delta:
+            deltas[imdb_id] = delta
+
+    return deltas
+
+
+RECORD_TITLES_SQL = text("""
+UPDATE titles SET popularity = popularity + :points WHERE imdb_id = :imdb_id
+""")
+
+RECORD_BUCKETS_SQL = text("""
+INSERT INTO popularity_buckets (imdb_id, day, points)
+VALUES (:imdb_id, :day, :points)
+ON CONFLICT (imdb_id, day) DO UPDATE SET
+    points = popularity_buckets.points + excluded.points
+""").bindparams(bindparam("day", type_=db.Date))
+
+
+def record(deltas, connection=None):
+    """Add points to titles' scores, {imdb_id: points}.
+
+    Runs in the session's transaction (or on connection), so the scores
+    commit or roll back with the write that changed them.
+    """
+
+    if not deltas:
+        return
+
+    # always in the same order, so concurrent writers can't deadlock
+    day = today()
+    params = [{"imdb_id": imdb_id, "points": deltas[imdb_id], "day": day}
+                for imdb_id in sorted(deltas)]
+
+    execute = (connection or db.session).execute
+
+    execute(RECORD_TITLES_SQL, params)
+    execute(RECORD_BUCKETS_SQL, params)
+
+
+def _favorite_before(state):
+    """A movie's favorite value as of its last load or flush."""
+
+    history = state.attrs.favorite.history
+
+    if history.deleted:
+        return history.deleted[0]
+
+    return state.attrs.favorite.value
+
+
+def _count_flush(session, flush_context):
+    """Score the movies added, deleted or (un)favorited by a flush.
+
+    after_flush still sees the session's new, dirty and deleted objects
+    and their attribute history as they were before the flush.
+    """
+
+    deltas = {}
+
+    def add(imdb_id, delta):
+        deltas[imdb_id] = deltas.get(imdb_id, 0) + delta
+
+    for obj in session.new:
+        if isinstance(obj, Movie):
+            add(obj.imdb_id, points(obj.favorite))
+
+    for obj in session.dirty:
+        if isinstance(obj, Movie):
+            history = inspect(obj).attrs.favorite.history
+
+            if history.added and history.deleted:
+                add(obj.imdb_id, points(history.added[0]) - points(history.deleted[0]))
+
+    for obj in session.deleted:
+        if isinstance(obj, Movie):
+            add(obj.imdb_id, -points(_favorite_before(inspect(obj))))
+
+    record({i: d for i, d in deltas.items() if d}, connection=session.connection())
+
+
+###############################################################################
+# leaderboards
+
+class Leaderboards:
+    """The most popular titles this week and of all time, cached."""
+
+    def __init__(self, ttl=60, size=LEADERBOARD_SIZE):
+        self.ttl = ttl
+        self.size = size
+
+        self._boards = None
+        self._loaded_at = 0
+        self._lock = Lock()
+
+    def _all_time(self):
+        return (db.session.query(Title.imdb_id, Title.title, Title.year,
+                                 Title.imdb_img, Title.popularity.label("points"))
+                    .filter(Title.popularity > 0)
+                    .order_by(Title.popularity.desc(), Title.imdb_id)
+                    .limit(self.size)
+                    .all())
+
+    def _this_week(self):
+        total = func.sum(PopularityBucket.points)
+
+        week = (db.session.query(PopularityBucket.imdb_id, total.label("points"))
+                    .filter(PopularityBucket.day > today() - timedelta(days=WINDOW_DAYS))
+                    .group_by(PopularityBucket.imdb_id)
+                    .having(total > 0)
+                    .subquery())
+
+        return (db.session.query(Title.imdb_id, Title.title, Title.year,
+                                 Title.imdb_img, week.c.points)
+                    .join(week, week.c.imdb_id == Title.imdb_id)
+                    .order_by(week.c.points.desc(), Title.imdb_id)
+                    .limit(self.size)
+                    .all())
+
+    def _merged(self, board):
+        """A leaderboard over every shard, adding up their points."""
+
+        entries = {}
+
+        for row in all_shards(board):
+            entry = entries.get(row.imdb_id)
+            points = row.points + (entry.points if entry else 0)
+            entries[row.imdb_id] = Entry(row.imdb_id, row.title, row.year, row.imdb_img, points)
+
+        ranked = sorted(entries.values(), key=lambda entry: (-entry.points, entry.imdb_id))
+
+        return ranked[:self.size]
+
+    def get(self):
+        """{"week": [...], "all_time": [...]}, rows of imdb_id, title,
+        year, imdb_img and points, best first.
+        """
+
+        with self._lock:
+            if self._boards is not None and time.monotonic() - self._loaded_at < self.ttl:
+                return self._boards
+
+        # query outside the lock, two threads may both refresh but
+        # they'll get the same answer
+        boards = {"week": self._merged(self._this_week),
+                  "all_time": self._merged(self._all_time)}
+
+        with self._lock:
+            self._boards = boards
+            self._loaded_at = time.monotonic()
+
+        return boards
+
+    def clear(self):
+        """Reload on the next get()."""
+
+        with self._lock:
+            self._boards = None
+
+
+leaderboards = Leaderboards()
+
+
+###############################################################################
+# maintenance
+
+def compact(keep_days=WINDOW_DAYS):
+    """Drop buckets too old for the leaderboards, returns how many.
+
+    Their points are already in titles.popularity.  The caller is
+    responsible for committing.
+    """
+
+    cutoff = today() - timedelta(days=keep_days)
+
+    return (PopularityBucket.query
+                .filter(PopularityBucket.day <= cutoff)
+                .delete(synchronize_session=False))
+
+
+REBUILD_SQL = text("""
+UPDATE titles SET popularity = COALESCE((
+    SELECT count(*) * :add_points
+        + sum(CASE WHEN movies.favorite THEN :favorite_points ELSE 0 END)
+    FROM movies
+    WHERE movies.imdb_id = titles.imdb_id
+), 0)
+""")
+
+
+def rebuild():
+    """Recount every title's all time score from movies.
+
+    The one place we scan the whole movies table, for giving an existing
+    database its scores (or fixing them after an admin bulk load).  The
+    caller is responsible for committing.
+    """
+
+    return db.session.execute(REBUILD_SQL, {"add_points": ADD_POINTS,
+                                            "favorite_points": FAVORITE_POINTS}).rowcount
+
+
+###############################################################################
+# flask setup
+
+def init_app(app):
+    """Count ORM ledger writes, and cache leaderboards for LEADERBOARD_TTL."""
+
+    app.config.setdefault("LEADERBOARD_TTL", 60)
+
+    leaderboards.ttl = app.config["LEADERBOARD_TTL"]
+
+    event.listen(db.session, "after_flush", _count_flush)
+
+
+if __name__ == "__main__":
+    from app import app
+
+    commands = {"compact": compact, "rebuild": rebuild}
+
+    if len(sys.argv) != 2 or sys.argv[1] not in commands:
+        sys.exit(f"usage: python popularity.py {'|'.join(commands)}")
+
+    with app.app_context():
+        count = 0
+
+        for _ in each_shard():
+            count += commands[sys.argv[1]]()
+            db.session.commit()
+
+    print(f"{sys.argv[1]}: {count} rows")
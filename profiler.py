@@ -0,0 +1,321 @@
+"""Profile requests in production, on demand.
+
+/metrics says which routes are slow, this says why.  A request is run
+under cProfile when:
+
+- it carries "X-Profile: <PROFILER_TOKEN>", e.g. to profile one slow
+  page from curl or the browser, or
+- it's picked at random, PROFILE_SAMPLE_RATE of all requests (0.01 for
+  one in a hundred), to see what the traffic we get actually costs.
+
+Each profile is added up into its endpoint's hotspots, and the last
+PROFILE_KEEP are kept whole.  Memory is looked at with tracemalloc
+snapshots, started by the first snapshot (tracing slows every
+allocation, so it's off until asked for) and each compared with the one
+before.  All of it is served to whoever has the token:
+
+    GET  /admin/profiles               hotspots per endpoint, recent profiles
+    GET  /admin/profiles/<id>.prof     a raw profile, for pstats or snakeviz
+    POST /admin/memory/snapshot        top allocations, and growth since the last
+    POST /admin/memory/stop            stop tracing
+
+with "Authorization: Bearer <PROFILER_TOKEN>".  Without PROFILER_TOKEN
+the admin routes are 404s and only sampling profiles.  When nothing's
+being profiled each request costs a header lookup and a random number.
+
+Each gunicorn worker profiles its own requests, like metrics.py.
+"""
+
+import cProfile
+import hmac
+import itertools
+import marshal
+import pstats
+import random
+import time
+import tracemalloc
+from collections import deque
+from threading import Lock
+
+from flask import g, request, jsonify, Response, abort
+
+from streaming import after_stream
+
+
+# hotspots listed per endpoint
+TOP_FUNCTIONS = 20
+
+# allocation sites listed per snapshot
+TOP_ALLOCATIONS = 25
+
+# stack frames tracemalloc keeps per allocation
+TRACE_FRAMES = 10
+
+
+def _function(key):
+    """A readable name for a pstats function key."""
+
+    filename, line, name = key
+
+    if filename == "~":
+        # a builtin, name is like "<method 'join' of 'str' objects>"
+        return name
+
+    return f"{filename}:{line}({name})"
+
+
+class Profiles:
+    """Hotspots per endpoint, and the most recent profiles whole."""
+
+    def __init__(self, keep=50):
+        self._recent = deque(maxlen=keep)
+        self._stats = {}
+        self._counts = {}
+        self._ids = itertools.count(1)
+        self._lock = Lock()
+
+    @property
+    def keep(self):
+        return self._recent.maxlen
+
+    @keep.setter
+    def keep(self, keep):
+        with self._lock:
+            self._recent = deque(self._recent, maxlen=keep)
+
+    def add(self, endpoint, profile, seconds):
+        """Keep a finished cProfile.Profile of a request to endpoint."""
+
+        profile.create_stats()
+
+        # before pstats takes the stats over (it empties profile.stats)
+        raw = marshal.dumps(profile.stats)
+
+        with self._lock:
+            if endpoint in self._stats:
+                self._stats[endpoint].add(profile)
+            else:
+                self._stats[endpoint] = pstats.Stats(profile)
+
+            self._counts[endpoint] = self._counts.get(endpoint, 0) + 1
+
+            self._recent.append({
+                "id": next(self._ids),
+                "endpoint": endpoint,
+                "at": time.time(),
+                "seconds": round(seconds, 6),
+                "stats": raw,
+            })
+
+    def hotspots(self, limit=TOP_FUNCTIONS):
+        """{endpoint: {"requests": n, "functions": [...]}}, the functions
+        that took the most time of their own, worst first.
+        """
+
+        with self._lock:
+            found = {}
+
+            for endpoint, stats in self._stats.items():
+                functions = sorted(stats.stats.items(), key=lambda item: -item[1][2])
+
+                found[endpoint] = {
+                    "requests": self._counts[endpoint],
+                    "functions": [
+                        {"function": _function(key), "calls": calls,
+                         "tottime": round(tottime, 6), "cumtime": round(cumtime, 6)}
+                        for key, (_, calls, tottime, cumtime, _) in functions[:limit]
+                    ],
+                }
+
+            return found
+
+    def recent(self):
+        """The profiles kept whole, newest first, without their stats."""
+
+        with self._lock:
+            return [{name: value for name, value in entry.items() if name != "stats"}
+                    for entry in reversed(self._recent)]
+
+    def raw(self, profile_id):
+        """A kept profile in the format cProfile's dump_stats() writes."""
+
+        with self._lock:
+            for entry in self._recent:
+                if entry["id"] == profile_id:
+                    return entry["stats"]
+
+        return None
+
+    def clear(self):
+        with self._lock:
+            self._recent.clear()
+            self._stats = {}
+            self._counts = {}
+
+
+profiles = Profiles()
+
+
+###############################################################################
+# memory
+
+class MemorySnapshots:
+    """tracemalloc snapshots, each compared with the one before."""
+
+    def __init__(self):
+        self._last = None
+        self._lock = Lock()
+
+    def snapshot(self, limit=TOP_ALLOCATIONS):
+        """Take a snapshot (starting tracing if it's off), returns the top
+        allocation sites and what grew since the last snapshot.
+        """
+
+        with self._lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(TRACE_FRAMES)
+                self._last = None
+
+            snapshot = tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(False, tracemalloc.__file__),
+            ])
+
+            current, peak = tracemalloc.get_traced_memory()
+
+            report = {
+                "traced_bytes": current,
+                "peak_bytes": peak,
+                "top": [_allocation(stat) for stat in snapshot.statistics("lineno")[:limit]],
+                "growth": None,
+            }
+
+            if self._last is not None:
+                growth = snapshot.compare_to(self._last, "lineno")
+                report["growth"] = [_allocation(stat) for stat in growth[:limit]]
+
+            self._last = snapshot
+
+            return report
+
+    def stop(self):
+        with self._lock:
+            tracemalloc.stop()
+            self._last = None
+
+
+def _allocation(stat):
+    frame = stat.traceback[0]
+    found = {"where": f"{frame.filename}:{frame.lineno}",
+             "bytes": stat.size, "count": stat.count}
+
+    # a comparison also says how much it changed
+    if isinstance(stat, tracemalloc.StatisticDiff):
+        found["bytes_diff"] = stat.size_diff
+        found["count_diff"] = stat.count_diff
+
+    return found
+
+
+memory = MemorySnapshots()
+
+
+###############################################################################
+# flask setup
+
+def init_app(app):
+    """Profile requests asked for with X-Profile, and PROFILE_SAMPLE_RATE of
+    the rest, and serve the results to PROFILER_TOKEN holders.
+    """
+
+    app.config.setdefault("PROFILER_TOKEN", None)
+    app.config.setdefault("PROFILE_SAMPLE_RATE", 0)
+    app.config.setdefault("PROFILE_KEEP", 50)
+
+    profiles.keep = app.config["PROFILE_KEEP"]
+
+    def authorized(header, value):
+        token = app.config["PROFILER_TOKEN"]
+
+        # compared in constant time, so the token can't be guessed a
+        # character at a time from how long a refusal takes
+        return bool(token) and hmac.compare_digest(
+            request.headers.get(header, "").encode("utf8"),
+            value.format(token=token).encode("utf8"))
+
+    @app.before_request
+    def start_profile():
+        rate = app.config["PROFILE_SAMPLE_RATE"]
+
+        if not ((rate and random.random() < rate)
+                or ("X-Profile" in request.headers and authorized("X-Profile", "{token}"))):
+            return
+
+        g.profile = cProfile.Profile()
+        g.profile_start = time.perf_counter()
+        g.profile.enable()
+
+    @app.after_request
+    def finish_profile(response):
+        profile = g.pop("profile", None)
+
+        if profile is None:
+            return response
+
+        endpoint = request.endpoint or "unknown"
+        start = g.profile_start
+
+        def finish():
+            profile.disable()
+            profiles.add(endpoint, profile, time.perf_counter() - start)
+
+        # a streamed body is rendered after we return (see streaming.py),
+        # profile it too
+        if response.is_streamed:
+            after_stream(response, finish)
+        else:
+            finish()
+
+        return response
+
+    def require_token():
+        if not authorized("Authorization", "Bearer {token}"):
+            abort(404 if not app.config["PROFILER_TOKEN"] else 401)
+
+    @app.route("/admin/profiles")
+    def show_profiles():
+        """Hotspots per endpoint, and the profiles that can be downloaded."""
+
+        require_token()
+
+        return jsonify({"hotspots": profiles.hotspots(), "recent": profiles.recent()})
+
+    @app.route("/admin/profiles/<int:profile_id>.prof")
+    def download_profile(profile_id):
+        """A raw profile: python -m pstats <file>, or snakeviz <file>."""
+
+        require_token()
+
+        stats = profiles.raw(profile_id)
+
+        if stats is None:
+            abort(404)
+
+        return Response(stats, mimetype="application/octet-stream", headers={
+            "Content-Disposition": f'attachment; filename="profile-{profile_id}.prof"'})
+
+    @app.route("/admin/memory/snapshot", methods=["POST"])
+    def memory_snapshot():
+        """Top allocations now, and growth since the last snapshot."""
+
+        require_token()
+
+        return jsonify(memory.snapshot())
+
+    @app.route("/admin/memory/stop", methods=["POST"])
+    def memory_stop():
+        """Stop tracing allocations."""
+
+        require_token()
+        memory.stop()
+
+        return jsonify({"message": "stopped"})
@@ -0,0 +1,184 @@
+"""Keep an eye on how many queries each request makes.
+
+Views declare how many statements they should need:
+
+    @app.route('/movies')
+    @max_queries(2)
+    def show_my_movies():
+        ...
+
+Every request's statements are recorded.  A request that goes over its
+view's budget, or that runs the same statement (with different
+parameters) QUERY_REPEAT_LIMIT or more times, which is what an N+1
+looks like, is logged (unless the view is decorated with
+allow_repeats).  With QUERY_BUDGET_RAISE set (the test suites
+set it) it raises QueryBudgetExceeded instead, so a regression fails
+the test that caused it.
+
+QueryBudgetTestMixin adds assertQueryBudget() for checking a block of
+test code directly.
+"""
+
+from collections import Counter
+from contextlib import contextmanager
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from streaming import after_stream
+
+
+class QueryBudgetExceeded(Exception):
+    """A request (or test block) ran more queries than it should have."""
+
+
+def max_queries(budget):
+    """Declare the most statements a view should run, add_user_to_g's included."""
+
+    def decorator(view):
+        view.query_budget = budget
+        return view
+
+    return decorator
+
+
+def allow_repeats(view):
+    """Skip the N+1 check for a view that repeats statements by design,
+    e.g. one per item of a batch the client sent.
+    """
+
+    view.allow_repeats = True
+    return view
+
+
+def repeated_statements(statements, limit):
+    """Return the statements that ran limit or more times, with their counts."""
+
+    return {stmt: count for stmt, count in Counter(statements).items() if count >= limit}
+
+
+def check_statements(statements, budget, repeat_limit):
+    """Return a list of problems with a set of statements (empty if none).
+
+    A repeat_limit of None skips the N+1 check.
+    """
+
+    problems = []
+
+    if budget is not None and len(statements) > budget:
+        problems.append(f"{len(statements)} queries, budget is {budget}")
+
+    if repeat_limit is None:
+        return problems
+
+    for stmt, count in repeated_statements(statements, repeat_limit).items():
+        # the first line is plenty to recognise a statement in the logs
+        problems.append(f"possible N+1, ran {count} times: {stmt.splitlines()[0]}")
+
+    return problems
+
+
+###############################################################################
+# recording
+
+# the statement lists currently recording, innermost last.  requests add
+# one to g, assertQueryBudget pushes its own here.
+_recorders = []
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _record_statement(conn, cursor, statement, parameters, context, executemany):
+    for statements in _recorders:
+        statements.append(statement)
+
+    if has_request_context():
+        statements = g.get("statements")
+
+        if statements is not None:
+            statements.append(statement)
+
+
+@contextmanager
+def recording_statements():
+    """Record every statement run inside the block into the yielded list."""
+
+    statements = []
+    _recorders.append(statements)
+
+    try:
+        yield statements
+    finally:
+        _recorders.remove(statements)
+
+
+###############################################################################
+# tests
+
+class QueryBudgetTestMixin:
+    """assertQueryBudget() for TestCases."""
+
+    @contextmanager
+    def assertQueryBudget(self, max_queries, repeat_limit=3):
+        """Fail if the block runs more than max_queries statements or an N+1."""
+
+        with recording_statements() as statements:
+            yield statements
+
+        problems = check_statements(statements, max_queries, repeat_limit)
+
+        if problems:
+            self.fail("; ".join(problems) + "\n\n" + "\n\n".join(statements))
+
+
+###############################################################################
+# flask setup
+
+def init_app(app):
+    """Record each request's statements and check them against its budget."""
+
+    app.config.setdefault("QUERY_BUDGET_RAISE", False)
+    app.config.setdefault("QUERY_REPEAT_LIMIT", 3)
+
+    @app.before_request
+    def start_recording():
+        g.statements = []
+
+    @app.after_request
+    def check_query_budget(response):
+        statements = g.get("statements")
+
+        if statements is None:
+            return response
+
+        view = current_app.view_functions.get(request.endpoint)
+        budget = getattr(view, "query_budget", None)
+        repeat_limit = (None if getattr(view, "allow_repeats", False)
+                        else current_app.config["QUERY_REPEAT_LIMIT"])
+
+        label = f"{request.method} {request.path}"
+        app = current_app._get_current_object()
+
+        # a streamed body runs its queries after we return (see
+        # streaming.py), check them all once it's been sent
+        if response.is_streamed:
+            after_stream(response,
+                         lambda: _report(app, label, statements, budget, repeat_limit))
+        else:
+            _report(app, label, statements, budget, repeat_limit)
+
+        return response
+
+
+def _report(app, label, statements, budget, repeat_limit):
+    """Log (or raise) a request's problems with its budget."""
+
+    problems = check_statements(statements, budget, repeat_limit)
+
+    if problems:
+        message = f"{label}: " + "; ".join(problems)
+
+        if app.config["QUERY_BUDGET_RAISE"]:
+            raise QueryBudgetExceeded(message)
+
+        app.logger.warning(message)
@@ -0,0 +1,560 @@
+"""Recommendations from who saved what.
+
+The movies table is a users x titles matrix, and titles that keep
+turning up in the same ledgers are a good guess for each other.  From it
+we serve:
+
+- also_saved(): "users who saved this also saved", on the movie page.
+- recommended(): a personalized list for a ledger, on /movies, the
+  titles most often saved alongside the ones already in it.
+
+A batch job reads the movies table into a sparse matrix X (one row per
+user, one column per title) and, for every title, keeps the NEIGHBORS
+titles saved with it most, scored by cosine similarity:
+
+    cooccurrence(a, b) / sqrt(savers(a) * savers(b))
+
+Every pair's co-occurrence is X.T @ X, which is never built whole: it's
+computed BLOCK_SIZE titles at a time and each block is cut down to its
+top NEIGHBORS before the next one, so the build's memory is bounded by
+a block and the model, not by the number of pairs.  Ledgers of more than
+MAX_USER_TITLES movies are left out of the counts, n movies are n^2
+pairs and say little about any one of them.
+
+The model is a handful of flat arrays, 4 bytes per saved movie and a
+few hundred per title (its neighbors), written to RECOMMENDATIONS_FILE.
+Run the build every hour or so (cron, Heroku Scheduler):
+
+    $ python recommendations.py build
+
+Each worker loads the file the first time it's asked, and again when a
+newer build lands.  Between builds, movies added to and deleted from
+ledgers are applied to the worker's model when they commit: the title's
+co-occurrence with the rest of that ledger goes up or down.  A worker
+only sees the writes it serves, and a title new since the last build
+waits for the next one, the build puts every worker back in step.
+
+NumPy and SciPy are optional.  Without them (or before the first build)
+there are no recommendations and the pages leave them out.
+"""
+
+import os
+import sys
+import time
+from threading import Lock
+
+from sqlalchemy import event
+
+from models import db, Movie
+from shards import all_shards
+
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:
+    np = sparse = None
+
+
+# neighbors kept per title
+NEIGHBORS = 20
+
+# titles per block of X.T @ X
+BLOCK_SIZE = 1024
+
+# bigger ledgers aren't counted, see above
+MAX_USER_TITLES = 1000
+
+# most of a ledger recommended() looks at, its first (as listed) titles
+MAX_PROFILE = 500
+
+# how many titles a list shows
+LIST_SIZE = 10
+
+# co-occurrence changes a worker keeps between builds, past this it
+# stops taking new ones until the next build
+MAX_PENDING = 1000000
+
+# seconds between checks for a new build
+RELOAD_INTERVAL = 30
+
+# rows read from the movies table at a time by the build
+BUILD_BATCH_SIZE = 50000
+
+DEFAULT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            "recommendations.npz")
+
+
+###############################################################################
+# building
+
+def _read_movies(rows):
+    """(user_id, imdb_id) rows as two arrays, read a batch at a time."""
+
+    users = []
+    titles = []
+    batch = []
+
+    for row in rows:
+        batch.append(row)
+
+        if len(batch) == BUILD_BATCH_SIZE:
+            users.append(np.array([u for u, _ in batch], dtype=np.int64))
+            titles.append(np.array([t.encode() for _, t in batch], dtype="S10"))
+            batch = []
+
+    if batch:
+        users.append(np.array([u for u, _ in batch], dtype=np.int64))
+        titles.append(np.array([t.encode() for _, t in batch], dtype="S10"))
+
+    if not users:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype="S10")
+
+    return np.concatenate(users), np.concatenate(titles)
+
+
+def rank_in_rows(rows, values):
+    """Rank entries of a sparse block within their rows, best value first.
+
+    Returns the order that sorts the entries by row then value, and each
+    sorted entry's rank: its position past the start of its row.
+    """
+
+    order = np.lexsort((-values, rows))
+    rows = rows[order]
+
+    return order, np.arange(len(rows)) - np.searchsorted(rows, rows)
+
+
+def _top_neighbors(block, first, savers, neighbors, counts, scores):
+    """Keep the top NEIGHBORS of each row of a block of X.T @ X.
+
+    block is a CSR matrix of the co-occurrence of titles first.. with
+    every title.
+    """
+
+    rows = np.repeat(np.arange(block.shape[0]), np.diff(block.indptr))
+    cols = block.indices
+    together = block.data
+
+    # a title always co-occurs with itself
+    keep = cols != rows + first
+    rows, cols, together = rows[keep], cols[keep], together[keep]
+
+    similarity = together / np.sqrt(savers[rows + first].astype(np.float64) * savers[cols])
+
+    order, rank = rank_in_rows(rows, similarity)
+    rows, cols = rows[order], cols[order]
+    together, similarity = together[order], similarity[order]
+
+    top = rank < neighbors.shape[1]
+
+    neighbors[rows[top] + first, rank[top]] = cols[top]
+    counts[rows[top] + first, rank[top]] = together[top]
+    scores[rows[top] + first, rank[top]] = similarity[top]
+
+
+def build(rows):
+    """Build a model from (user_id, imdb_id) rows, returns its arrays."""
+
+    user_ids, imdb_ids = _read_movies(rows)
+
+    titles, cols = np.unique(imdb_ids, return_inverse=True)
+    users, user_rows = np.unique(user_ids, return_inverse=True)
+    del user_ids, imdb_ids
+
+    # X itself, every user's titles, kept for the updates between builds
+    order = np.lexsort((cols, user_rows))
+    indices = cols[order].astype(np.int32)
+    indptr = np.concatenate(([0], np.cumsum(np.bincount(user_rows, minlength=len(users)))))
+
+    # the ledgers we count
+    ledger_sizes = np.diff(indptr)
+    counted = ledger_sizes[user_rows] <= MAX_USER_TITLES
+
+    x = sparse.csr_matrix((np.ones(int(counted.sum()), dtype=np.int32),
+                           (user_rows[counted], cols[counted])),
+                          shape=(len(users), len(titles)))
+    del order, cols, user_rows, counted
+
+    savers = np.asarray(x.sum(axis=0)).ravel().astype(np.int32)
+
+    neighbors = np.full((len(titles), NEIGHBORS), -1, dtype=np.int32)
+    counts = np.zeros((len(titles), NEIGHBORS), dtype=np.int32)
+    scores = np.zeros((len(titles), NEIGHBORS), dtype=np.float32)
+
+    xt = x.T.tocsr()
+
+    for first in range(0, len(titles), BLOCK_SIZE):
+        block = xt[first:first + BLOCK_SIZE] @ x
+        _top_neighbors(block, first, savers, neighbors, counts, scores)
+
+    return {
+        "titles": titles, "savers": savers,
+        "neighbors": neighbors, "counts": counts, "scores": scores,
+        "users": users, "indptr": indptr.astype(np.int64), "indices": indices,
+    }
+
+
+def save(model, path):
+    """Write a model where workers will find it.
+
+    Written next to path and renamed into place, so a worker never loads
+    half a file.
+    """
+
+    partial = path + ".partial.npz"
+    np.savez(partial, **model)
+    os.replace(partial, path)
+
+
+###############################################################################
+# serving
+
+class BuiltModel:
+    """A model a build job wrote to path, as a dict of arrays.
+
+    Each worker loads it the first time it's needed, and again when a
+    newer build lands.  Safe to share between threads.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+        self._model = None
+        self._mtime = None
+        self._checked_at = None
+        self._lock = Lock()
+
+    def _reset(self):
+        """Drop anything kept alongside the model.  Called with the lock held."""
+
+    def load(self, model):
+        """Serve model (arrays, as from a build)."""
+
+        with self._lock:
+            self._model = model
+            self._reset()
+
+    def clear(self):
+        """Forget the model, until the next build is loaded."""
+
+        self.load(None)
+        self._mtime = None
+        self._checked_at = None
+
+    def ensure_loaded(self):
+        """Load the latest build, if there's a newer one than ours.
+
+        Looks at the file at most every RELOAD_INTERVAL seconds.
+        """
+
+        if np is None:
+            return
+
+        if self._checked_at is not None and time.monotonic() - self._checked_at < RELOAD_INTERVAL:
+            return
+
+        self._checked_at = time.monotonic()
+
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return
+
+        if mtime == self._mtime:
+            return
+
+        with np.load(self.path) as arrays:
+            model = {name: arrays[name] for name in arrays.files}
+
+        self.load(model)
+        self._mtime = mtime
+
+    @staticmethod
+    def _find(keys, key):
+        """key's position in the sorted array keys, or None."""
+
+        i = int(np.searchsorted(keys, key))
+
+        if i < len(keys) and keys[i] == key:
+            return i
+
+        return None
+
+    def _column(self, model, imdb_id):
+        return self._find(model["titles"], imdb_id.encode())
+
+
+class Recommender(BuiltModel):
+    """A loaded model, plus the ledger changes since it was built."""
+
+    def __init__(self, path=DEFAULT_FILE):
+        super().__init__(path)
+
+        # co-occurrence changes since the build, title column -> {other
+        # title column: change}, and savers changes, column -> change
+        self._pending = {}
+        self._pending_size = 0
+        self._savers = {}
+
+        # user_id -> title columns added to / deleted from their ledger
+        # since the build
+        self._added = {}
+        self._deleted = {}
+
+    def _reset(self):
+        """A new build has every change so far, drop ours."""
+
+        self._pending = {}
+        self._pending_size = 0
+        self._savers = {}
+        self._added = {}
+        self._deleted = {}
+
+    def _ledger(self, model, user_id):
+        """A user's title columns as of now.  Call with the lock held."""
+
+        row = self._find(model["users"], user_id)
+        columns = set()
+
+        if row is not None:
+            start, stop = model["indptr"][row], model["indptr"][row + 1]
+            columns.update(model["indices"][start:stop].tolist())
+
+        columns |= self._added.get(user_id, set())
+        columns -= self._deleted.get(user_id, set())
+
+        return columns
+
+    def _change(self, model, ledgers, user_id, imdb_id, sign):
+        """Count one title in or out of a ledger.  Call with the lock held.
+
+        ledgers holds [ledger (as from _ledger()), counted] for this
+        apply()'s users, kept up with its changes so each is only built
+        once.  A ledger too big to count when the apply started isn't
+        counted for any of its changes, so deleting a big ledger is a set
+        operation per title, not a pass over the rest of it.
+        """
+
+        column = self._column(model, imdb_id)
+
+        if column is None:
+            return
+
+        if user_id not in ledgers:
+            ledger = self._ledger(model, user_id)
+            ledgers[user_id] = [ledger, len(ledger) <= MAX_USER_TITLES]
+
+        ledger, counted = ledgers[user_id]
+
+        if (column in ledger) == (sign > 0):
+            return
+
+        if sign > 0:
+            self._added.setdefault(user_id, set()).add(column)
+            self._deleted.get(user_id, set()).discard(column)
+            ledger.add(column)
+        else:
+            self._deleted.setdefault(user_id, set()).add(column)
+            self._added.get(user_id, set()).discard(column)
+
+        # like the build, big ledgers aren't counted
+        counted = ledgers[user_id][1] = counted and len(ledger) <= MAX_USER_TITLES
+
+        if counted and self._pending_size <= MAX_PENDING:
+            self._savers[column] = self._savers.get(column, 0) + sign
+
+            for other in ledger:
+                if other != column:
+                    for a, b in ((column, other), (other, column)):
+                        pending = self._pending.setdefault(a, {})
+                        pending[b] = pending.get(b, 0) + sign
+
+                    self._pending_size += 2
+
+        if sign < 0:
+            ledger.discard(column)
+
+    def apply(self, changes):
+        """Apply committed ledger changes, (user_id, imdb_id, +1 or -1)."""
+
+        with self._lock:
+            model = self._model
+
+            if model is None:
+                return
+
+            ledgers = {}
+
+            for user_id, imdb_id, sign in changes:
+                self._change(model, ledgers, user_id, imdb_id, sign)
+
+    def also_saved(self, imdb_id, limit=LIST_SIZE):
+        """imdb ids of the titles most saved alongside imdb_id, best first."""
+
+        self.ensure_loaded()
+
+        with self._lock:
+            model = self._model
+
+            if model is None:
+                return []
+
+            column = self._column(model, imdb_id)
+
+            if column is None:
+                return []
+
+            together = {}
+
+            for other, count in zip(model["neighbors"][column].tolist(),
+                                    model["counts"][column].tolist()):
+                if other >= 0:
+                    together[other] = count
+
+            for other, change in self._pending.get(column, {}).items():
+                together[other] = together.get(other, 0) + change
+
+            savers = model["savers"]
+            own = int(savers[column]) + self._savers.get(column, 0)
+
+            scored = []
+
+            for other, count in together.items():
+                theirs = int(savers[other]) + self._savers.get(other, 0)
+
+                if count > 0 and own > 0 and theirs > 0:
+                    scored.append((-count / (own * theirs) ** 0.5, other))
+
+            scored.sort()
+
+            return [model["titles"][other].decode() for _, other in scored[:limit]]
+
+    def recommended(self, imdb_ids, limit=LIST_SIZE):
+        """imdb ids of the titles most like a ledger's, best first.
+
+        Each title's neighbors are scored by their similarity to it, and
+        summed over the first MAX_PROFILE of imdb_ids.  Titles already in
+        imdb_ids aren't recommended.  Uses the build as it is, without
+        the changes since.
+        """
+
+        self.ensure_loaded()
+
+        model = self._model
+
+        if model is None or not imdb_ids or not len(model["titles"]):
+            return []
+
+        keys = np.array([i.encode() for i in imdb_ids[:MAX_PROFILE]], dtype="S10")
+        titles = model["titles"]
+
+        positions = np.minimum(np.searchsorted(titles, keys), len(titles) - 1)
+        columns = positions[titles[positions] == keys]
+
+        if not len(columns):
+            return []
+
+        neighbors = model["neighbors"][columns].ravel()
+        scores = model["scores"][columns].ravel()
+
+        found = neighbors >= 0
+        candidates, which = np.unique(neighbors[found], return_inverse=True)
+        totals = np.bincount(which, weights=scores[found])
+
+        # what's already saved isn't a recommendation
+        saved = set(imdb_ids)
+        found = []
+
+        for i in np.argsort(-totals, kind="stable"):
+            imdb_id = titles[candidates[i]].decode()
+
+            if imdb_id not in saved:
+                found.append(imdb_id)
+
+                if len(found) == limit:
+                    break
+
+        return found
+
+
+recommender = Recommender()
+
+
+###############################################################################
+# keeping up with ledgers
+
+def track(user_id, before, after):
+    """Note the movies a bulk write added to or deleted from a ledger.
+
+    before and after are anything keyed by the ledger's imdb ids (e.g.
+    popularity.ledger_points()).  They're applied when the session
+    commits.
+    """
+
+    pending = db.session.info.setdefault("recommendation_changes", [])
+    pending.extend((user_id, imdb_id, -1) for imdb_id in before.keys() - after.keys())
+    pending.extend((user_id, imdb_id, 1) for imdb_id in after.keys() - before.keys())
+
+
+def _track_flush(session, flush_context):
+    """Note the movies added or deleted through the ORM."""
+
+    pending = session.info.setdefault("recommendation_changes", [])
+
+    for obj in session.new:
+        if isinstance(obj, Movie):
+            pending.append((obj.user_id, obj.imdb_id, 1))
+
+    for obj in session.deleted:
+        if isinstance(obj, Movie):
+            pending.append((obj.user_id, obj.imdb_id, -1))
+
+
+def _apply_commit(session):
+    changes = session.info.pop("recommendation_changes", None)
+
+    if changes:
+        recommender.apply(changes)
+
+
+def _drop_rollback(session, previous_transaction):
+    session.info.pop("recommendation_changes", None)
+
+
+###############################################################################
+# flask setup
+
+def init_app(app):
+    """Serve the build at RECOMMENDATIONS_FILE, and keep it up with ledgers."""
+
+    app.config.setdefault("RECOMMENDATIONS_FILE", DEFAULT_FILE)
+
+    recommender.path = app.config["RECOMMENDATIONS_FILE"]
+
+    if np is None:
+        return
+
+    event.listen(db.session, "after_flush", _track_flush)
+    event.listen(db.session, "after_commit", _apply_commit)
+    event.listen(db.session, "after_soft_rollback", _drop_rollback)
+
+
+if __name__ == "__main__":
+    from app import app
+
+    if sys.argv[1:] != ["build"]:
+        sys.exit("usage: python recommendations.py build")
+
+    if np is None:
+        sys.exit("recommendations need numpy and scipy installed")
+
+    with app.app_context():
+        started = time.monotonic()
+        rows = all_shards(lambda: db.session.query(Movie.user_id, Movie.imdb_id)
+                                      .yield_per(BUILD_BATCH_SIZE))
+        model = build(rows)
+        save(model, recommender.path)
+
+    print(f"build: {len(model['titles'])} titles, {len(model['indices'])} movies "
+          f"in {time.monotonic() - started:.1f}s")
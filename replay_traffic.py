@@ -0,0 +1,391 @@
+# Replay captured production traffic (see traffic_capture.py) against a
+# build, and compare builds.
+#
+# run using
+#   $ python replay_traffic.py capture.ndjson --base http://staging:8000 --output old.json
+#   $ python replay_traffic.py capture.ndjson --base http://staging:8000 --compare old.json
+#   $ python replay_traffic.py capture.ndjson.gz --start-app --rate 4 --output new.json
+#
+# requests go out at the pace they were captured, or --rate times faster
+# (0 for as fast as --concurrency allows).  each captured user gets a
+# stand-in on the staging build, one of user1 .. user--users with
+# --password, as seeded by seed.py, so requests keep their mix of
+# ledgers and a user's requests stay together.  only reads are
+# replayed, add --writes for the rest.  signups, logins, logouts,
+# profile changes and uploads never are.
+#
+# the staging build should call a stub omdb api: --omdb-port PORT serves
+# one on this machine for the run (point the build's OMDB_API_URL at
+# http://127.0.0.1:PORT/).  --start-app instead starts the app here with
+# gunicorn (see bench_serving.py), on DATABASE_URL, against a stub of
+# its own.
+#
+# the report has latency percentiles, errors (5xx or no answer) and
+# status mismatches (not the captured status, e.g. a movie the stand-in
+# doesn't have) per endpoint, next to the captured latencies.  with
+# --compare it also shows the change from an earlier --output, and exits
+# with 1 if anything got slower (beyond --tolerance) or failed more.
+
+import argparse
+import gzip
+import json
+import re
+import statistics
+import sys
+import time
+import zlib
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from bench_serving import start_gunicorn, start_stub_omdb
+
+
+# requests a stand-in can't (or shouldn't) make again
+NOT_REPLAYED = ("signup", "login", "logout", "edit_profile", "delete_profile",
+                "restore_movies")
+
+# methods replayed without --writes
+READ_METHODS = ("GET", "HEAD")
+
+# latencies within this many ms of the baseline's are noise, not regressions
+SLACK_MS = 5
+
+CSRF_TOKEN = re.compile(r'<input[^>]*name="csrf_token"[^>]*value="([^"]*)"')
+
+STUB_MOVIE = {
+    "Rated": "PG", "Released": "01 Jan 2001", "Runtime": "101 min", "Genre": "Drama",
+    "Actors": "Ann Actor, Bob Actor", "Plot": "A stub.", "Poster": "N/A",
+    "Response": "True",
+}
+
+
+###############################################################################
+# stub api
+
+def stub_id(*parts):
+    """A made up imdb id, the same for the same parts."""
+
+    return f"tt{zlib.crc32(':'.join(map(str, parts)).encode('utf8')) % 10 ** 8:08d}"
+
+
+def stub_answer(params):
+    """Search results that depend on the term and page, and a movie for
+    any id, so pages look like real ones.
+    """
+
+    if "i" in params:
+        imdb_id = params["i"][0]
+        return dict(STUB_MOVIE, Title=f"Movie {imdb_id}", Year="2001", imdbID=imdb_id)
+
+    term = params.get("s", [""])[0]
+    page = params.get("page", ["1"])[0]
+
+    return {
+        "Search": [{"Title": f"{term.title()} {i}", "Year": str(1980 + i),
+                    "imdbID": stub_id(term, page, i), "Type": "movie", "Poster": "N/A"}
+                   for i in range(10)],
+        "totalResults": "100",
+        "Response": "True",
+    }
+
+
+###############################################################################
+# captured requests
+
+def read_records(filenames, writes=False, limit=None):
+    """The replayable records of the capture files, oldest first."""
+
+    records = []
+
+    for filename in filenames:
+        opener = gzip.open if filename.endswith(".gz") else open
+
+        with opener(filename, "rt", encoding="utf8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+
+                record = json.loads(line)
+
+                if (record.get("endpoint") in NOT_REPLAYED or record.get("files")
+                        or not writes and record["method"] not in READ_METHODS):
+                    continue
+
+                records.append(record)
+
+    records.sort(key=lambda record: record["at"])
+
+    return records[:limit] if limit else records
+
+
+class StandIns:
+    """A logged in session on the staging build for each captured user."""
+
+    def __init__(self, base, users, password):
+        self.base = base
+        self.users = users
+        self.password = password
+        self._sessions = {}
+
+    def username(self, user):
+        return f"user{int(user, 16) % self.users + 1}"
+
+    def log_in_all(self, records):
+        """Log in the stand-ins for the records' users, before the timing
+        starts.
+        """
+
+        for user in {record.get("user") for record in records} - {None}:
+            self._sessions[user] = self.log_in(self.username(user))
+
+    def session(self, user):
+        """(session, csrf token) for a captured user, a new anonymous
+        session for no user.
+        """
+
+        if user is None:
+            return requests.Session(), None
+
+        return self._sessions[user]
+
+    def log_in(self, username):
+        s = requests.Session()
+
+        found = CSRF_TOKEN.search(s.get(f"{self.base}/login").text)
+        token = found.group(1) if found else None
+
+        resp = s.post(f"{self.base}/login", allow_redirects=False, data={
+            "username": username, "password": self.password, "csrf_token": token})
+
+        if not resp.headers.get("Location", "").endswith("/movies"):
+            sys.exit(f"couldn't log in to {self.base} as {username}, "
+                     f"seed it with `python seed.py --users {self.users}`")
+
+        return s, token
+
+
+def replay_one(stand_ins, record):
+    """Send a captured request again, returns (endpoint, ms, status or None)."""
+
+    s, token = stand_ins.session(record.get("user"))
+    kwargs = {"params": record.get("args") or None}
+
+    if "form" in record:
+        kwargs["data"] = dict(record["form"], csrf_token=token)
+
+    if "json" in record:
+        kwargs["json"] = record["json"]
+
+    start = time.perf_counter()
+
+    try:
+        resp = s.request(record["method"], stand_ins.base + record["path"],
+                         allow_redirects=False, timeout=30, **kwargs)
+        resp.content  # the whole body, it may be streamed
+        status = resp.status_code
+    except requests.RequestException:
+        status = None
+
+    return record.get("endpoint") or "unknown", (time.perf_counter() - start) * 1000, status
+
+
+def replay(records, stand_ins, rate, concurrency):
+    """Replay records at rate times their captured pace, returns
+    [(record, endpoint, ms, status)].
+    """
+
+    results = []
+    first = records[0]["at"]
+    start = time.monotonic()
+
+    def send(record):
+        results.append((record, *replay_one(stand_ins, record)))
+
+    with ThreadPoolExecutor(concurrency) as pool:
+        for record in records:
+            if rate:
+                wait = (record["at"] - first) / rate - (time.monotonic() - start)
+
+                if wait > 0:
+                    time.sleep(wait)
+
+            pool.submit(send, record)
+
+    return results
+
+
+###############################################################################
+# the report
+
+def percentile(values, q):
+    """The q (0 to 1) percentile of sorted values."""
+
+    return values[max(int(len(values) * q + 0.5) - 1, 0)]
+
+
+def summarize(results):
+    """Latencies and failures per endpoint, and for "all" of them."""
+
+    by_endpoint = defaultdict(list)
+
+    for result in results:
+        by_endpoint[result[1]].append(result)
+        by_endpoint["all"].append(result)
+
+    report = {}
+
+    for endpoint, found in sorted(by_endpoint.items()):
+        latencies = sorted(ms for _, _, ms, _ in found)
+        captured = sorted(record["ms"] for record, _, _, _ in found if "ms" in record)
+
+        report[endpoint] = {
+            "requests": len(found),
+            "errors": sum(1 for _, _, _, status in found if status is None or status >= 500),
+            "mismatches": sum(1 for record, _, _, status in found
+                              if status is not None and status != record.get("status")),
+            "p50_ms": round(statistics.median(latencies), 2),
+            "p90_ms": round(percentile(latencies, 0.9), 2),
+            "p99_ms": round(percentile(latencies, 0.99), 2),
+            "max_ms": round(latencies[-1], 2),
+            "captured_p50_ms": round(statistics.median(captured), 2) if captured else None,
+            "captured_p99_ms": round(percentile(captured, 0.99), 2) if captured else None,
+        }
+
+    return report
+
+
+def compare(result, baseline, tolerance):
+    """Return a list of regressions of an endpoint's result against its baseline."""
+
+    if baseline is None:
+        return []
+
+    regressions = []
+
+    for stat in ("p50_ms", "p99_ms"):
+        if result[stat] > baseline[stat] * (1 + tolerance) + SLACK_MS:
+            regressions.append(f"{stat[:3]} {baseline[stat]}ms -> {result[stat]}ms")
+
+    # per request, so runs of different lengths compare
+    for stat in ("errors", "mismatches"):
+        if result[stat] / result["requests"] > baseline[stat] / baseline["requests"]:
+            regressions.append(f"{stat} {baseline[stat]}/{baseline['requests']} -> "
+                               f"{result[stat]}/{result['requests']}")
+
+    return regressions
+
+
+def print_report(report, baselines, tolerance):
+    """Print the report, returns whether anything regressed."""
+
+    regressed = False
+
+    print(f"{'endpoint':<24} {'reqs':>6} {'p50':>8} {'p90':>8} {'p99':>8} "
+          f"{'prod p50':>8} {'errors':>6} {'mismatch':>8}")
+
+    for endpoint, r in report.items():
+        captured = f"{r['captured_p50_ms']:8.1f}" if r["captured_p50_ms"] is not None else "       -"
+
+        print(f"{endpoint:<24} {r['requests']:>6} {r['p50_ms']:8.1f} {r['p90_ms']:8.1f} "
+              f"{r['p99_ms']:8.1f} {captured} {r['errors']:>6} {r['mismatches']:>8}")
+
+        if baselines is None:
+            continue
+
+        baseline = baselines.get(endpoint)
+
+        if baseline is None:
+            print(f"{'':<24} new, no baseline")
+            continue
+
+        print(f"{'':<24} was {baseline['p50_ms']:.1f} / {baseline['p90_ms']:.1f} / "
+              f"{baseline['p99_ms']:.1f}ms, {baseline['errors']} errors")
+
+        for regression in compare(r, baseline, tolerance):
+            print(f"{'':<24} REGRESSED: {regression}")
+            regressed = True
+
+    return regressed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay captured traffic against a build.")
+    parser.add_argument("files", nargs="+", help="capture files, .ndjson, optionally .gz")
+    parser.add_argument("--base", help="the build to replay against, e.g. http://staging:8000")
+    parser.add_argument("--start-app", action="store_true",
+                        help="serve this checkout with gunicorn and replay against it")
+    parser.add_argument("--port", type=int, default=8111, help="for --start-app")
+    parser.add_argument("--workers", type=int, default=2, help="for --start-app")
+    parser.add_argument("--omdb-port", type=int, help="serve a stub omdb api on this port")
+    parser.add_argument("--omdb-latency", type=float, default=100, help="stub latency in ms")
+    parser.add_argument("--rate", type=float, default=1,
+                        help="how many times faster than captured, 0 for flat out")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--users", type=int, default=100, help="seeded users to stand in")
+    parser.add_argument("--password", default="password", help="the seeded users' password")
+    parser.add_argument("--writes", action="store_true", help="replay writes as well as reads")
+    parser.add_argument("--limit", type=int, help="replay only the first LIMIT requests")
+    parser.add_argument("--output", help="write the report here, to --compare to later")
+    parser.add_argument("--compare", help="a report to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="how much slower than --compare counts as a regression")
+    args = parser.parse_args(argv)
+
+    if not args.base and not args.start_app:
+        parser.error("give the build to replay against with --base, or --start-app")
+
+    records = read_records(args.files, writes=args.writes, limit=args.limit)
+
+    if not records:
+        sys.exit("nothing to replay")
+
+    omdb_latency = args.omdb_latency / 1000
+    proc = None
+
+    if args.omdb_port is not None:
+        start_stub_omdb(omdb_latency, stub_answer, args.omdb_port)
+
+    if args.start_app:
+        proc = start_gunicorn("gthread", args.workers, args.port,
+                              start_stub_omdb(omdb_latency, stub_answer))
+        args.base = f"http://127.0.0.1:{args.port}"
+
+    try:
+        span = records[-1]["at"] - records[0]["at"]
+        print(f"replaying {len(records)} requests captured over {span:.0f}s "
+              f"against {args.base}, " + (f"at {args.rate}x" if args.rate else "flat out"))
+
+        stand_ins = StandIns(args.base.rstrip("/"), args.users, args.password)
+        stand_ins.log_in_all(records)
+
+        start = time.perf_counter()
+        results = replay(records, stand_ins, args.rate, args.concurrency)
+        print(f"done in {time.perf_counter() - start:.1f}s\n")
+
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+
+    report = summarize(results)
+
+    baselines = None
+
+    if args.compare:
+        with open(args.compare) as f:
+            baselines = json.load(f)
+
+    regressed = print_report(report, baselines, args.tolerance)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write("\n")
+
+    sys.exit(1 if regressed else 0)
+
+
+if __name__ == "__main__":
+    main()
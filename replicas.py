@@ -0,0 +1,277 @@
+"""Send reads to postgres read replicas, and keep the primary for writes.
+
+Replicas are set with DATABASE_REPLICA_URLS, comma separated, and get
+the same engine options as the primary (see backends.py).  The session
+picks one of them for the reads of GET and HEAD requests:
+
+- everything else goes to the primary: flushes, INSERT/UPDATE/DELETE
+  and text that isn't a SELECT, and every statement of a POST (or other
+  write) request, since what those read feeds what they write.
+- once a request's transaction writes, the rest of it stays on the
+  primary.
+- a user who wrote reads from the primary for REPLICA_STICKY_SECONDS
+  after, so they see their own writes.  The time of their last write is
+  kept in their (signed) session cookie, so it holds across workers.
+- a replica more than REPLICA_MAX_LAG seconds behind (or whose lag we
+  couldn't check) isn't used.  When none are fit, reads go to the
+  primary.
+
+Each request reads from a single replica, so its reads agree with each
+other.  Lag is measured off the request path, by a thread per worker
+that asks each postgres replica every REPLICA_LAG_CHECK_INTERVAL seconds
+how far its replay is behind what it has received.  sqlite has no
+replication, a sqlite replica (as in the tests) is never behind.
+
+With no replicas set, every statement goes to the primary, as before.
+"""
+
+import logging
+import os
+import random
+import threading
+import time
+
+from flask import g, has_request_context, request, session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, event, orm
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.sql.elements import TextClause
+
+from backends import engine_options
+
+
+logger = logging.getLogger(__name__)
+
+# requests whose reads can go to a replica
+READ_METHODS = ("GET", "HEAD")
+
+# the session cookie key holding the time of the user's last write
+LAST_WRITE_KEY = "last_write_at"
+
+LAG_SQL = """
+SELECT CASE
+    WHEN NOT pg_is_in_recovery() THEN 0
+    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+END
+"""
+
+
+def is_write(clause):
+    """Does a statement write?  Text counts unless it's a SELECT."""
+
+    if isinstance(clause, UpdateBase):
+        return True
+
+    if isinstance(clause, TextClause):
+        return not clause.text.lstrip().upper().startswith("SELECT")
+
+    return False
+
+
+class ReplicaRouter:
+    """Which replica, if any, a request reads from."""
+
+    def __init__(self):
+        self.urls = []
+        self.pool_size = 5
+        self.max_lag = 2
+        self.sticky_seconds = 10
+        self.check_interval = 1
+
+        # replica url -> (lag in seconds, time.monotonic() it was measured)
+        self._lag = {}
+        self._engines = {}
+        self._checker_pid = None
+        self._lock = threading.Lock()
+
+    def configure(self, urls, pool_size=5):
+        """Use these replicas from now on."""
+
+        with self._lock:
+            self.urls = list(urls)
+            self.pool_size = pool_size
+            self._lag = {}
+            self._engines = {}
+
+    def engine(self, url):
+        """The engine for a replica, made the first time it's needed (in
+        each worker, engines don't survive a fork).
+        """
+
+        engine = self._engines.get(url)
+
+        if engine is None:
+            with self._lock:
+                engine = self._engines.get(url)
+
+                if engine is None:
+                    engine = create_engine(url, **engine_options(url, self.pool_size))
+                    self._engines[url] = engine
+
+        return engine
+
+    ###########################################################################
+    # lag
+
+    def measure(self):
+        """Measure every replica's lag now."""
+
+        for url in self.urls:
+            engine = self.engine(url)
+
+            try:
+                if engine.dialect.name == "sqlite":
+                    lag = 0.0
+                else:
+                    with engine.connect() as conn:
+                        lag = float(conn.execute(LAG_SQL).scalar())
+
+            except Exception:
+                logger.warning("couldn't check the lag of %s", engine.url, exc_info=True)
+                lag = None
+
+            self._lag[url] = (lag, time.monotonic())
+
+    def _check_lag(self):
+        while True:
+            self.measure()
+            time.sleep(self.check_interval)
+
+    def _ensure_checker(self):
+        """Start this worker's lag checking thread (gunicorn forks the app
+        after preloading it, so each process needs its own).
+        """
+
+        if self._checker_pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._checker_pid != os.getpid():
+                self._checker_pid = os.getpid()
+                threading.Thread(target=self._check_lag, daemon=True,
+                                 name="replica-lag").start()
+
+    def lag(self, url):
+        """A replica's last measured lag, None if it isn't known or current."""
+
+        lag, measured_at = self._lag.get(url, (None, 0))
+
+        # a check that's gone quiet doesn't vouch for the replica any more
+        if time.monotonic() - measured_at > self.check_interval * 5:
+            return None
+
+        return lag
+
+    ###########################################################################
+    # routing
+
+    def sticky(self):
+        """Did the current user write recently enough to read from the primary?"""
+
+        last_write = session.get(LAST_WRITE_KEY)
+
+        return last_write is not None and time.time() - last_write < self.sticky_seconds
+
+    def read_engine(self):
+        """The replica engine for the current request's reads, or None for
+        the primary.  Decided once per request.
+        """
+
+        if not self.urls or not has_request_context():
+            return None
+
+        if "read_replica" in g:
+            return g.read_replica
+
+        engine = None
+
+        if request.method in READ_METHODS and not self.sticky():
+            self._ensure_checker()
+
+            fit = [url for url in self.urls
+                   if self.lag(url) is not None and self.lag(url) <= self.max_lag]
+
+            if fit:
+                engine = self.engine(random.choice(fit))
+
+        g.read_replica = engine
+
+        return engine
+
+
+router = ReplicaRouter()
+
+
+###############################################################################
+# the session
+
+class RoutingSession(SignallingSession):
+    """A session that sends reads to router's replica, when it has one.
+
+    Statements for another shard go there instead, replicas are only for
+    the main database (shards.py sets shards, to its shard map).
+    """
+
+    shards = None
+
+    def get_bind(self, mapper=None, clause=None):
+        shard = self.shards.engine_for(mapper) if self.shards is not None else None
+
+        if self._flushing or is_write(clause):
+            self.info["wrote"] = True
+
+        # a bare connection() is for whatever the caller wants to run on
+        # it, so it's the primary's
+        elif (shard is None and not self.info.get("wrote")
+                and (mapper is not None or clause is not None)):
+            engine = router.read_engine()
+
+            if engine is not None:
+                return engine
+
+        if shard is not None:
+            return shard
+
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy with RoutingSession for its sessions."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def _committed(db_session):
+    """Start the user's read-your-writes window when a write commits."""
+
+    wrote = db_session.info.pop("wrote", False)
+
+    if wrote and router.urls and has_request_context():
+        session[LAST_WRITE_KEY] = time.time()
+
+
+def _rolled_back(db_session, previous_transaction):
+    db_session.info.pop("wrote", None)
+
+
+###############################################################################
+# flask setup
+
+def init_app(app, db):
+    """Route reads to the replicas in SQLALCHEMY_REPLICA_URIS."""
+
+    app.config.setdefault("SQLALCHEMY_REPLICA_URIS", [])
+    app.config.setdefault("REPLICA_MAX_LAG", 2)
+    app.config.setdefault("REPLICA_STICKY_SECONDS", 10)
+    app.config.setdefault("REPLICA_LAG_CHECK_INTERVAL", 1)
+
+    router.max_lag = app.config["REPLICA_MAX_LAG"]
+    router.sticky_seconds = app.config["REPLICA_STICKY_SECONDS"]
+    router.check_interval = app.config["REPLICA_LAG_CHECK_INTERVAL"]
+    router.configure(app.config["SQLALCHEMY_REPLICA_URIS"],
+                     pool_size=app.config["SQLALCHEMY_ENGINE_OPTIONS"].get("pool_size", 5))
+
+    event.listen(db.session, "after_commit", _committed)
+    event.listen(db.session, "after_soft_rollback", _rolled_back)
@@ -0,0 +1,83 @@
+# Bulk load ledger files (as written by the /movies/export.* routes)
+# into the database with COPY.
+#
+# run using
+#   $ python restore_ledger.py ledger.csv --user USERNAME
+#   $ python restore_ledger.py migrated.ndjson.gz
+#
+# without --user, every record must carry its own user_id (admin loads
+# of migrated data).  with --user, every record goes into that user's
+# ledger.  existing movies are updated to match the file.
+#
+# records for titles that aren't in the catalog are skipped, like the
+# web restore does, unless --add-titles: then the file's title data goes
+# into the shared catalog, so only use it on files you trust.
+#
+# with --user the popularity counters are updated as the web restore
+# does.  without it they're recounted from movies at the end (see
+# popularity.py), since we can't tell whose ledgers the files touch.
+#
+# with shards (see shards.py) the files go to the user's shard, so
+# --user is needed.
+
+import argparse
+import sys
+import time
+
+from models import db, User
+from app import app
+from ledger_io import open_ledger, restore_ledger
+import popularity
+import shards
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk restore movie ledgers.")
+    parser.add_argument("files", nargs="+", help=".csv or .ndjson, optionally .gz")
+    parser.add_argument("--user", help="username to restore the files into")
+    parser.add_argument("--add-titles", action="store_true",
+                        help="add titles missing from the catalog, from the files")
+    args = parser.parse_args(argv)
+
+    app.config['SQLALCHEMY_ECHO'] = False
+
+    with app.app_context():
+        user_id = None
+
+        if shards.shard_map.enabled and not args.user:
+            sys.exit("With shards, restore into one user's ledger with --user")
+
+        if args.user:
+            shards.use(shards.shard_of(username=args.user))
+            u = User.query.filter_by(username=args.user).first()
+
+            if not u:
+                sys.exit(f"No user named {args.user}")
+
+            user_id = u.id
+
+        for filename in args.files:
+            start = time.perf_counter()
+
+            before = popularity.ledger_points(user_id) if user_id else {}
+
+            with open(filename, "rb") as f:
+                counts = restore_ledger(open_ledger(f, filename), user_id=user_id,
+                                        trust_titles=args.add_titles)
+
+            if user_id:
+                popularity.record(popularity.changes(before, popularity.ledger_points(user_id)))
+
+            db.session.commit()
+
+            print(f"{filename}: {counts['inserted']} inserted, "
+                  f"{counts['updated']} updated, {counts['skipped']} skipped "
+                  f"in {time.perf_counter() - start:.1f}s")
+
+        if not user_id:
+            popularity.rebuild()
+            db.session.commit()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+"""An in memory index of every title we've seen, for searching without the api.
+
+Titles come from the catalog (every movie in anyone's ledger) and from
+every api response we get back.  The index answers:
+
+- prefix(): autocomplete as the user types.  Every word of a title is a
+  starting point, so "dark kn" finds "The Dark Knight".
+- fuzzy(): typo tolerant matching.  Titles are scored by the trigrams
+  they share with the term, the same similarity postgres' pg_trgm uses,
+  so "the drak knigt" still finds it.
+- search(): prefix matches, or fuzzy ones if there are none, in the
+  api's search result format, so the search page can show them when
+  there's no API_KEY, the api is down or the api found nothing.
+
+Each gunicorn worker builds its own index from the catalog the first
+time it's used, then keeps it up to date as titles come in.
+"""
+
+import re
+import unicodedata
+from bisect import bisect_left
+from collections import Counter
+from threading import Lock
+
+from sqlalchemy import event
+
+from models import db, Title
+from services import titles_seen
+from shards import all_shards
+
+
+# results per page, the same as the api
+PAGE_SIZE = 10
+
+# the most results a search returns, over all pages
+MAX_RESULTS = 100
+
+# how similar (0 to 1) a title has to be to count as a fuzzy match,
+# pg_trgm's default
+SIMILARITY_THRESHOLD = 0.3
+
+_NON_WORD = re.compile(r"[^\w]+")
+
+
+def normalize(text):
+    """Lowercase, strip accents and punctuation, and collapse whitespace."""
+
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(c for c in text if not unicodedata.combining(c))
+
+    return " ".join(_NON_WORD.sub(" ", text.lower()).split())
+
+
+def trigrams(text):
+    """The trigrams of normalized text, each word padded like pg_trgm does."""
+
+    grams = set()
+
+    for word in text.split():
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+
+    return grams
+
+
+class TitleIndex:
+    """Prefix and trigram indexes over titles, safe to share between threads."""
+
+    def __init__(self):
+        self.loaded = False
+
+        # imdb id -> the title as an api search result
+        self._titles = {}
+        # sorted (key, imdb id) pairs, one per word of each title, where
+        # key is the normalized title from that word on
+        self._prefixes = []
+        # trigram -> imdb ids of the titles that have it
+        self._postings = {}
+        # imdb id -> its title's trigrams
+        self._trigrams = {}
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._titles)
+
+    def get(self, imdb_id):
+        """A title as an api search result, or None if we haven't seen it."""
+
+        return self._titles.get(imdb_id)
+
+    @staticmethod
+    def _keys(title):
+        words = normalize(title).split()
+
+        return [" ".join(words[i:]) for i in range(len(words))]
+
+    def _add(self, imdb_id, title, year, poster, kind):
+        """Index one title.  Call with the lock held, returns the new prefix
+        entries so callers can insert them one by one or sort them in bulk.
+        """
+
+        current = self._titles.get(imdb_id)
+        result = {"Title": title, "Year": year or "", "imdbID": imdb_id,
+                  "Type": kind or "movie", "Poster": poster or "N/A"}
+
+        if current is not None:
+            if current["Title"] == title:
+                self._titles[imdb_id] = result
+                return []
+
+            self._remove(imdb_id)
+
+        self._titles[imdb_id] = result
+
+        grams = trigrams(normalize(title))
+        self._trigrams[imdb_id] = grams
+
+        for gram in grams:
+            self._postings.setdefault(gram, set()).add(imdb_id)
+
+        return [(key, imdb_id) for key in self._keys(title)]
+
+    def _remove(self, imdb_id):
+        """Drop a title's index entries.  Call with the lock held."""
+
+        title = self._titles.pop(imdb_id)["Title"]
+
+        for key in self._keys(title):
+            i = bisect_left(self._prefixes, (key, imdb_id))
+
+            if i < len(self._prefixes) and self._prefixes[i] == (key, imdb_id):
+                del self._prefixes[i]
+
+        for gram in self._trigrams.pop(imdb_id, ()):
+            ids = self._postings.get(gram)
+
+            if ids is not None:
+                ids.discard(imdb_id)
+
+                if not ids:
+                    del self._postings[gram]
+
+    def add(self, imdb_id, title, year=None, poster=None, kind="movie"):
+        """Add (or update) a title."""
+
+        if not imdb_id or not title:
+            return
+
+        with self._lock:
+            for entry in self._add(imdb_id, title, year, poster, kind):
+                i = bisect_left(self._prefixes, entry)
+                self._prefixes.insert(i, entry)
+
+    def add_result(self, result):
+        """Add a title from an api search result or movie."""
+
+        self.add(result.get("imdbID"), result.get("Title"), result.get("Year"),
+                 result.get("Poster"), result.get("Type"))
+
+    def load(self, rows):
+        """Replace the index with (imdb_id, title, year, poster) rows."""
+
+        with self._lock:
+            self._titles = {}
+            self._postings = {}
+            self._trigrams = {}
+
+            prefixes = []
+
+            for imdb_id, title, year, poster in rows:
+                if imdb_id and title:
+                    prefixes.extend(self._add(imdb_id, title, year, poster, "movie"))
+
+            prefixes.sort()
+            self._prefixes = prefixes
+            self.loaded = True
+
+    def ensure_loaded(self):
+        """Build the index from the catalog (every shard's), the first time
+        it's needed.
+        """
+
+        if not self.loaded:
+            self.load(all_shards(lambda: db.session.query(Title.imdb_id, Title.title,
+                                                          Title.year, Title.imdb_img)))
+
+    def reset(self):
+        """Rebuild from the catalog next time, after titles were added behind
+        the ORM's back (e.g. a restore).
+        """
+
+        self.loaded = False
+
+    def prefix(self, term, limit=PAGE_SIZE):
+        """Titles with a word starting with term, titles starting with it first."""
+
+        key = normalize(term)
+
+        if not key:
+            return []
+
+        found = {}
+
+        with self._lock:
+            i = bisect_left(self._prefixes, (key,))
+
+            # look a little past the limit, so titles that start with the
+            # term can be moved ahead of ones that only contain it
+            while (i < len(self._prefixes) and len(found) < limit * 5
+                    and self._prefixes[i][0].startswith(key)):
+                imdb_id = self._prefixes[i][1]
+                found.setdefault(imdb_id, self._titles[imdb_id])
+                i += 1
+
+        def rank(result):
+            title = normalize(result["Title"])
+            return (not title.startswith(key), len(title), title)
+
+        return sorted(found.values(), key=rank)[:limit]
+
+    def fuzzy(self, term, limit=PAGE_SIZE, threshold=SIMILARITY_THRESHOLD):
+        """Titles whose trigrams are similar enough to term's, best first."""
+
+        grams = trigrams(normalize(term))
+
+        if not grams:
+            return []
+
+        with self._lock:
+            shared = Counter()
+
+            for gram in grams:
+                shared.update(self._postings.get(gram, ()))
+
+            scored = []
+
+            for imdb_id, count in shared.items():
+                similarity = count / (len(grams) + len(self._trigrams[imdb_id]) - count)
+
+                if similarity >= threshold:
+                    scored.append((-similarity, self._titles[imdb_id]["Title"], imdb_id))
+
+            scored.sort()
+
+            return [self._titles[imdb_id] for _, _, imdb_id in scored[:limit]]
+
+    def search(self, term, page=1):
+        """A page of matches for term, shaped like an api search response."""
+
+        results = self.prefix(term, limit=MAX_RESULTS) or self.fuzzy(term, limit=MAX_RESULTS)
+
+        if not results:
+            return {"Response": "False", "Error": "Movie not found!"}
+
+        start = (page - 1) * PAGE_SIZE
+
+        return {
+            "Search": results[start:start + PAGE_SIZE],
+            "totalResults": str(len(results)),
+            "Response": "True",
+        }
+
+
+title_index = TitleIndex()
+
+
+###############################################################################
+# flask setup
+
+def _titles_seen(sender, results, **extra):
+    if title_index.loaded:
+        for result in results:
+            title_index.add_result(result)
+
+
+def init_app(app):
+    """Keep the index up to date with the catalog and the api."""
+
+    titles_seen.connect(_titles_seen)
+
+    # a title added in a transaction that's rolled back stays in the
+    # index until the next reset, which costs no more than a search
+    # result the api would have given us anyway
+    @event.listens_for(Title, "after_insert")
+    @event.listens_for(Title, "after_update")
+    def index_title(mapper, connection, target):
+        if title_index.loaded:
+            title_index.add(target.imdb_id, target.title, target.year, target.imdb_img)
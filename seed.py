@@ -1,19 +1,297 @@
-# run using 
-#   $ python seed.py
+# Fill the database with made up users and ledgers, for scaling tests
+# and benchmarks.
+#
+# run using
+#   $ python seed.py                                   (100 users, a few thousand movies)
+#   $ python seed.py --users 1000000 --movies 40       (about 40 million movies)
+#   $ python seed.py --users 5000 --seed 7 --password hunter22
+#
+# THIS DROPS AND RECREATES EVERY TABLE (on every shard, see shards.py)
+# before seeding.
+#
+# the same options (and --seed) always make the same data, so runs
+# against two versions of the code start from the same database:
+#
+# - --titles titles, whose popularity falls off like Zipf's law (--skew,
+#   0 makes every title as likely): a few are in most ledgers, most are
+#   in a few.
+# - --users users, user1 .. userN, whose ledger sizes are log-normal
+#   around --movies, so most ledgers are small and a few are huge (up to
+#   half the titles).
+# - --favorites of the movies are favorites, platforms follow PLATFORMS,
+#   and movies are added over the --years before --end (a fixed date,
+#   not today, so the data doesn't change from one day to the next),
+#   most viewed some days before they were added.
+#
+# every user has the --password, bcrypt hashed once for all of them,
+# and a ledger made by its own random generator (seeded from --seed and
+# their id).
+# users go in with COPY (executemany on sqlite) and ledgers with
+# restore_ledger, BATCH_USERS users per transaction, then the titles'
+# popularity is counted (see popularity.py).
 
-from models import db, User, Movie
+import argparse
+import csv
+import io
+import math
+import random
+import time
+from bisect import bisect
+from datetime import date, datetime, timedelta
+from itertools import accumulate
+
+from models import db, User, UserShard
 from app import app
+from backends import dialect
+from ledger_io import restore_ledger
+import popularity
+import shards
+from shards import MAIN, shard_map
+
+
+# users (and their ledgers) per transaction
+BATCH_USERS = 10000
+
+# how likely each platform is, None for movies without one
+PLATFORMS = {"netflix": 35, "amazon prime": 20, "hbo max": 12, "hulu": 10,
+             "apple tv": 5, None: 18}
+
+# how many movies have a date viewed, and how long before being added
+# they were viewed on average
+VIEWED_RATIO = 0.7
+VIEWED_DAYS_BEFORE = 30
+
+# how much ledger sizes vary, the sigma of their log-normal distribution
+LEDGER_SIGMA = 1.0
+
+TITLE_WORDS = (
+    ("The", "A", "Last", "Lost", "Dark", "Silent", "Broken", "Hidden", "Golden",
+     "Endless", "Secret", "Wild", "Little", "Final", "Burning", "Frozen"),
+    ("Night", "River", "Kingdom", "Summer", "Stranger", "Road", "Garden", "Storm",
+     "Empire", "Island", "Promise", "Shadow", "Game", "Letter", "Heart", "City"),
+)
+
+ACTORS = ("Ann Archer", "Ben Bright", "Cara Cole", "Dev Dunn", "Eve Ellis",
+          "Finn Ford", "Gia Grant", "Hal Hart", "Ivy Innes", "Jon Jury")
+
+
+###############################################################################
+# making it up
+
+def make_titles(rng, count):
+    """count title records, the first the most popular."""
+
+    first, second = TITLE_WORDS
+    titles = []
+
+    for i in range(count):
+        name = f"{rng.choice(first)} {rng.choice(second)}"
+
+        # there are only so many two word names
+        if i >= len(first) * len(second):
+            name += f" {i // (len(first) * len(second)) + 1}"
+
+        titles.append({
+            "imdb_id": f"tt{i + 1:08d}",
+            "title": name,
+            "year": str(max(1920, 2025 - int(rng.expovariate(1 / 15)))),
+            "actors": ", ".join(rng.sample(ACTORS, 3)),
+            "imdb_img": "N/A",
+        })
+
+    return titles
+
+
+def popularity_weights(count, skew):
+    """Cumulative Zipf weights for count titles, for bisecting a random
+    number into a title.
+    """
+
+    return list(accumulate(1 / (rank ** skew) for rank in range(1, count + 1)))
+
+
+def pick_titles(rng, cum_weights, k):
+    """k different titles' indexes, the popular ones more likely."""
+
+    total = cum_weights[-1]
+    picked = set()
+
+    for _ in range(k * 4):
+        picked.add(bisect(cum_weights, rng.random() * total))
+
+        if len(picked) == k:
+            return picked
+
+    # a big ledger runs out of popular titles, and finding the rest by
+    # popularity could take forever.  fill it up with any titles.
+    while len(picked) < k:
+        picked.add(rng.randrange(len(cum_weights)))
+
+    return picked
+
+
+def ledger_size(rng, mean, most):
+    """How many movies a user has, log-normal around mean."""
+
+    mu = math.log(mean) - LEDGER_SIGMA ** 2 / 2
+
+    return max(1, min(most, round(rng.lognormvariate(mu, LEDGER_SIGMA))))
+
+
+def ledger_records(rng, user_id, titles, cum_weights, args):
+    """A user's made up ledger, as records for restore_ledger."""
+
+    platforms = list(PLATFORMS)
+    platform_weights = list(accumulate(PLATFORMS.values()))
+    days = args.years * 365
+
+    size = ledger_size(rng, args.movies, len(titles) // 2)
+
+    for index in sorted(pick_titles(rng, cum_weights, size)):
+        added = args.end - timedelta(days=rng.randrange(days))
+        viewed = None
+
+        if rng.random() < VIEWED_RATIO:
+            viewed = added - timedelta(days=int(rng.expovariate(1 / VIEWED_DAYS_BEFORE)))
+
+        yield dict(titles[index],
+                   user_id=user_id,
+                   favorite=rng.random() < args.favorites,
+                   platform=rng.choices(platforms, cum_weights=platform_weights)[0],
+                   date_viewed=viewed,
+                   date_added=added)
+
+
+###############################################################################
+# loading
+
+USER_COLUMNS = ("id", "username", "email", "password", "img_url",
+                "ledger_version", "ledger_updated_at")
+
+
+def insert_rows(table, columns, rows):
+    """Bulk insert rows into table on the shard in use, with COPY on postgres."""
+
+    cursor = db.session.connection().connection.cursor()
+
+    try:
+        if dialect(db.session) == "postgresql":
+            buffer = io.StringIO()
+            # quoted, so empty strings stay empty strings, not NULLs
+            csv.writer(buffer, quoting=csv.QUOTE_ALL).writerows(rows)
+            buffer.seek(0)
+            cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)",
+                               buffer)
+        else:
+            cursor.executemany(f"INSERT INTO {table} ({', '.join(columns)}) "
+                               f"VALUES ({', '.join('?' * len(columns))})", rows)
+    finally:
+        cursor.close()
+
+
+def next_ids():
+    """Start postgres' id sequences after the ids we gave out."""
+
+    for _ in shards.each_shard():
+        if dialect(db.session) == "postgresql":
+            db.session.execute("SELECT setval(pg_get_serial_sequence('users', 'id'), "
+                               "(SELECT COALESCE(max(id), 0) + 1 FROM users), false)")
+
+    if shard_map.enabled and dialect(db.session) == "postgresql":
+        db.session.execute("SELECT setval(pg_get_serial_sequence('user_shards', 'user_id'), "
+                           "(SELECT COALESCE(max(user_id), 0) + 1 FROM user_shards), false)")
+
+
+def recreate_tables():
+    db.drop_all()
+
+    for name in shard_map.urls:
+        db.metadata.drop_all(shard_map.engine(name))
+
+    shards.create_tables()
+
+
+def seed(args):
+    """Seed the database, returns (users, movies) added."""
+
+    titles = make_titles(random.Random(args.seed), args.titles)
+    cum_weights = popularity_weights(args.titles, args.skew)
+    password = User.hash_password(args.password)
+    updated_at = datetime.combine(args.end, datetime.min.time())
+
+    def ledgers(user_ids):
+        # each user's ledger comes from its own generator, so it's the
+        # same whatever shard (or batch) they end up in
+        for user_id in user_ids:
+            rng = random.Random(f"{args.seed}:{user_id}")
+            yield from ledger_records(rng, user_id, titles, cum_weights, args)
+
+    movies = 0
+
+    for first in range(1, args.users + 1, BATCH_USERS):
+        last = min(first + BATCH_USERS, args.users + 1) - 1
+        placed = {name: [] for name in shard_map.names}
+
+        for user_id in range(first, last + 1):
+            placed[shard_map.place(user_id)].append(user_id)
+
+        if shard_map.enabled:
+            with shards.on_shard(MAIN):
+                insert_rows(UserShard.__tablename__, ("user_id", "username", "shard"),
+                            [(user_id, f"user{user_id}", name)
+                             for name, user_ids in placed.items() for user_id in user_ids])
+
+        for name in shards.each_shard():
+            if placed[name]:
+                insert_rows(User.__tablename__, USER_COLUMNS, [
+                    (user_id, f"user{user_id}", f"user{user_id}@example.com",
+                     password, "", 0, updated_at) for user_id in placed[name]])
+
+                # streamed into COPY, a batch's ledgers are never all in memory
+                movies += restore_ledger(ledgers(placed[name]), trust_titles=True)["inserted"]
+
+        db.session.commit()
+
+        print(f"{last} users, {movies} movies")
+
+    for _ in shards.each_shard():
+        popularity.rebuild()
+
+    next_ids()
+    db.session.commit()
+
+    return args.users, movies
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Seed the database with made up ledgers.")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--movies", type=float, default=40,
+                        help="average movies per user")
+    parser.add_argument("--titles", type=int, default=10000)
+    parser.add_argument("--skew", type=float, default=1.0,
+                        help="how much more popular popular titles are")
+    parser.add_argument("--favorites", type=float, default=0.15,
+                        help="the share of movies that are favorites")
+    parser.add_argument("--years", type=int, default=5,
+                        help="how many years of movies were added")
+    parser.add_argument("--end", type=date.fromisoformat, default=date(2026, 1, 1),
+                        help="the day the last movies were added")
+    parser.add_argument("--password", default="password")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
 
-db.drop_all()
-db.create_all()
+    app.config['SQLALCHEMY_ECHO'] = False
 
+    with app.app_context():
+        start = time.perf_counter()
 
-##### USER #####
+        recreate_tables()
+        users, movies = seed(args)
 
-# u1 = User(username='test', password='password', email='test@test.com', img_url='https://source.unsplash.com/random/300×300')
-# u2 = User(username='test2', password='password2', email='test@test.com', img_url='https://source.unsplash.com/random/300×300')
+        print(f"seeded {users} users and {movies} movies "
+              f"in {time.perf_counter() - start:.1f}s")
 
-# db.session.add(u1)
-# db.session.add(u2)
 
-# db.session.commit()
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,84 @@
 """Handle connecting to our external api!"""
 
 import os
+import threading
+import time
+
 import requests
+from blinker import Namespace
+from requests.adapters import HTTPAdapter
 
 if os.environ.get('FLASK_ENV') == "development":
     from keys import API_KEY
 else:
     API_KEY = os.environ.get('API_KEY')
 
-API_BASE_URL = f"http://www.omdbapi.com/?apikey={API_KEY}&"
+# OMDB_API_URL lets benchmarks and tests point us at a stub server
+API_URL = os.environ.get('OMDB_API_URL', "http://www.omdbapi.com/")
+API_BASE_URL = f"{API_URL}?apikey={API_KEY}&"
+
+# seconds to wait on the api before giving up: (connect, read)
+API_TIMEOUT = (3.05, float(os.environ.get('OMDB_TIMEOUT', 10)))
+
+# each thread (or greenlet) gets its own requests.Session, so we reuse
+# keep-alive connections to the api without sharing a session between
+# threads
+_local = threading.local()
+
+
+# sent after every api call with the seconds it took (see metrics.py)
+_signals = Namespace()
+api_called = _signals.signal("api-called")
+
+# sent with the titles in every successful search or movie lookup, as a
+# list of api results (see search_index.py)
+titles_seen = _signals.signal("titles-seen")
+
+
+def api_get(api_url):
+    """Make a get request to the api and return the decoded json."""
+
+    start = time.perf_counter()
+
+    try:
+        api_resp = get_session().get(api_url, timeout=API_TIMEOUT)
+    finally:
+        api_called.send(api_url, seconds=time.perf_counter() - start)
+
+    # the api returns a reponse with json
+    # but we need to convert to a python dictionary
+    return api_resp.json()
+
+
+def get_session():
+    """Return this thread's http session for the api."""
+
+    session = getattr(_local, "session", None)
+
+    if session is None:
+        session = requests.Session()
+        session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        _local.session = session
+
+    return session
+
+
+def api_configured():
+    """Do we have an API_KEY to call the api with?"""
+
+    return bool(API_KEY)
+
 
 def movie_search(search_term, page=1):
     """Make the external search call to the omdb movie database!"""
     
     api_url = f"{API_BASE_URL}s={search_term}&page={page}"
         
-    api_resp = requests.get(api_url)
+    results = api_get(api_url)
 
-    # the api returns a reponse with json
-    # but we need to convert to a python dictionary
-    results = api_resp.json()
+    if results.get("Response") == "True":
+        titles_seen.send(search_term, results=results["Search"])
 
     # import pdb
     # pdb.set_trace()
@@ -32,11 +91,10 @@ def movie_search_by_id(movie_id):
 
     api_url = f"{API_BASE_URL}i={movie_id}"
 
-    api_resp = requests.get(api_url)
+    results = api_get(api_url)
 
-    # the api returns a reponse with json
-    # but we need to convert to a python dictionary
-    results = api_resp.json()
+    if results.get("Response") == "True":
+        titles_seen.send(movie_id, results=[results])
 
     return results
 
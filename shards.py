@@ -0,0 +1,356 @@
+"""Spread users, and their ledgers, over several databases (shards).
+
+Everything we store is a user's: their row in users and their movies,
+always looked up by user id.  So each user lives, whole, in one shard:
+
+- the main database (SQLALCHEMY_DATABASE_URI) is the "main" shard, and
+  DATABASE_SHARD_URLS (comma separated) adds "shard1", "shard2", ...
+  Every shard has the full schema, and its own titles catalog with the
+  titles its ledgers use.
+- user_shards, in the main database, is the shard map: which shard each
+  user is in.  It also hands out user ids (so they're unique over all
+  the shards) and keeps usernames unique.  New users are placed by id,
+  user id % number of shards.
+- the session cookie carries the user's shard next to their id, so
+  add_user_to_g can load them without asking the map.  A user who was
+  moved isn't in the shard their cookie names, then (and only then) we
+  look them up in the map.
+- while a shard is in use (use(), on_shard()), every statement goes to
+  it, except those for the shard map itself.
+
+Features that cover everyone (leaderboards, the title index, the
+recommendation and similar title builds, popularity maintenance) read
+each shard in turn with each_shard() or all_shards() and combine what
+they get.  Read columns, not model instances, across shards in one
+session, so rows from different shards can't meet in its identity map.
+
+Move a user to another shard (to rebalance) with:
+
+    $ python shards.py move USER_ID SHARD
+
+and create the tables on every shard, and put the main database's
+users on the shard map, when turning sharding on with:
+
+    $ python shards.py init
+
+Without DATABASE_SHARD_URLS there's just the main database and none of
+this does anything.
+"""
+
+import sys
+import threading
+from contextlib import contextmanager
+
+from flask import g, has_app_context
+from sqlalchemy import create_engine
+
+from backends import dialect, engine_options
+from models import db, User, Movie, UserShard
+from replicas import RoutingSession
+
+
+MAIN = "main"
+
+
+class ShardMap:
+    """The shards we have, and the one the current request or job uses."""
+
+    def __init__(self):
+        self.urls = {}
+        self.pool_size = 5
+
+        self._engines = {}
+        self._lock = threading.Lock()
+
+    @property
+    def names(self):
+        return [MAIN, *self.urls]
+
+    @property
+    def enabled(self):
+        return bool(self.urls)
+
+    def configure(self, urls, pool_size=5):
+        """Use these shard urls (besides the main database) from now on."""
+
+        with self._lock:
+            self.urls = {f"shard{i}": url for i, url in enumerate(urls, start=1)}
+            self.pool_size = pool_size
+            self._engines = {}
+
+    def engine(self, name):
+        """The engine for a shard, None for the main one (the session's own)."""
+
+        if name is None or name == MAIN:
+            return None
+
+        engine = self._engines.get(name)
+
+        if engine is None:
+            with self._lock:
+                engine = self._engines.get(name)
+
+                if engine is None:
+                    url = self.urls[name]
+                    engine = self._engines[name] = create_engine(
+                        url, **engine_options(url, self.pool_size))
+
+        return engine
+
+    def engine_for(self, mapper):
+        """Where the session should send a statement, None for the usual
+        place (the main database, or its replicas).
+        """
+
+        if not self.enabled or mapper is not None and mapper.class_ is UserShard:
+            return None
+
+        return self.engine(current())
+
+    def place(self, user_id):
+        """The shard for a new user."""
+
+        return self.names[user_id % len(self.names)]
+
+
+shard_map = ShardMap()
+
+
+###############################################################################
+# the shard in use
+
+def current():
+    """The shard in use, None if it's the main one."""
+
+    return g.get("shard") if has_app_context() else None
+
+
+def use(name):
+    """Use a shard for the rest of the request (or app context)."""
+
+    g.shard = None if name == MAIN else name
+
+
+@contextmanager
+def on_shard(name):
+    """Use a shard inside the block."""
+
+    previous = current()
+    use(name)
+
+    try:
+        yield
+    finally:
+        use(previous)
+
+
+def each_shard():
+    """Use every shard in turn, yielding its name."""
+
+    for name in shard_map.names:
+        with on_shard(name):
+            yield name
+
+
+def all_shards(make_query):
+    """The rows of make_query() on every shard, one shard after another.
+
+    make_query is called once per shard, while that shard is in use.
+    """
+
+    for _ in each_shard():
+        yield from make_query()
+
+
+###############################################################################
+# the shard map
+
+def register(username):
+    """Put a new user on the map and use their shard, returning their id.
+
+    Returns None (let the database pick the id) without shards.  A taken
+    username raises IntegrityError on the flush, like a duplicate user.
+    The caller is responsible for committing.
+    """
+
+    if not shard_map.enabled:
+        return None
+
+    entry = UserShard(username=username, shard=MAIN)
+    db.session.add(entry)
+    db.session.flush()
+
+    entry.shard = shard_map.place(entry.user_id)
+    use(entry.shard)
+
+    return entry.user_id
+
+
+def shard_of(user_id=None, username=None):
+    """The shard a user is in, by id or username, None if they aren't on
+    the map (or there are no shards).
+    """
+
+    if not shard_map.enabled:
+        return None
+
+    query = db.session.query(UserShard.shard)
+
+    if user_id is not None:
+        query = query.filter(UserShard.user_id == user_id)
+    else:
+        query = query.filter(UserShard.username == username)
+
+    return query.scalar()
+
+
+def rename(user_id, username):
+    """Keep the map's username up to date.  The caller is responsible for
+    committing.
+    """
+
+    if shard_map.enabled:
+        (UserShard.query.filter_by(user_id=user_id)
+            .update({UserShard.username: username}, synchronize_session=False))
+
+
+def forget(user_id):
+    """Take a deleted user off the map.  The caller is responsible for
+    committing.
+    """
+
+    if shard_map.enabled:
+        UserShard.query.filter_by(user_id=user_id).delete(synchronize_session=False)
+
+
+###############################################################################
+# maintenance
+
+def move_user(user_id, to):
+    """Move a user and their ledger to another shard, returns how many
+    movies moved.
+
+    The user is copied to the new shard, then the map is pointed at it,
+    then they're deleted from the old one, committing after each step.
+    If it's interrupted, the map still says where the whole user is, and
+    running it again finishes the job.
+    """
+
+    from ledger_io import LEDGER_FIELDS, restore_ledger
+    import popularity
+
+    if to not in shard_map.names:
+        raise ValueError(f"No shard named {to}")
+
+    source = shard_of(user_id)
+
+    if source is None:
+        raise ValueError(f"User {user_id} isn't on the shard map")
+
+    if source == to:
+        return 0
+
+    users = User.__table__
+
+    with on_shard(source):
+        user = db.session.execute(users.select().where(users.c.id == user_id)).first()
+        points = popularity.ledger_points(user_id)
+
+        # started here, so the cursor is on the old shard's connection
+        ledger = iter(db.session.query(*[getattr(Movie, field) for field in LEDGER_FIELDS])
+                        .filter(Movie.user_id == user_id)
+                        .join(Movie.catalog)
+                        .yield_per(1000))
+
+    with on_shard(to):
+        if db.session.execute(users.select().where(users.c.id == user_id)).first() is None:
+            db.session.execute(users.insert(), dict(user))
+
+        before = popularity.ledger_points(user_id)
+        counts = restore_ledger((dict(zip(LEDGER_FIELDS, row)) for row in ledger),
+                                user_id=user_id, trust_titles=True)
+        popularity.record(popularity.changes(before, popularity.ledger_points(user_id)))
+
+    db.session.commit()
+
+    UserShard.query.filter_by(user_id=user_id).update({UserShard.shard: to},
+                                                      synchronize_session=False)
+    db.session.commit()
+
+    with on_shard(source):
+        Movie.query.filter_by(user_id=user_id).delete(synchronize_session=False)
+        popularity.record(popularity.changes(points, {}))
+        db.session.execute(users.delete().where(users.c.id == user_id))
+
+    db.session.commit()
+
+    return counts["inserted"] + counts["updated"]
+
+
+def create_tables():
+    """Create the tables on every shard (and the shard map on the main one)."""
+
+    db.create_all()
+
+    for name in shard_map.urls:
+        db.metadata.create_all(shard_map.engine(name))
+
+
+def init_map():
+    """Put the main database's users on the shard map, returns how many.
+
+    For turning sharding on over an existing database.  The caller is
+    responsible for committing.
+    """
+
+    known = {user_id for user_id, in db.session.query(UserShard.user_id)}
+    added = 0
+
+    with on_shard(MAIN):
+        users = db.session.query(User.id, User.username).all()
+
+    for user_id, username in users:
+        if user_id not in known:
+            db.session.add(UserShard(user_id=user_id, username=username, shard=MAIN))
+            added += 1
+
+    db.session.flush()
+
+    # new users' ids have to come after the ones we just put in
+    if dialect(db.session) == "postgresql":
+        db.session.execute("SELECT setval(pg_get_serial_sequence('user_shards', 'user_id'), "
+                           "(SELECT COALESCE(max(user_id), 0) + 1 FROM user_shards), false)")
+
+    return added
+
+
+###############################################################################
+# flask setup
+
+def init_app(app):
+    """Route each user's statements to the shard they're in."""
+
+    app.config.setdefault("SQLALCHEMY_SHARD_URIS", [])
+
+    shard_map.configure(app.config["SQLALCHEMY_SHARD_URIS"],
+                        pool_size=app.config["SQLALCHEMY_ENGINE_OPTIONS"].get("pool_size", 5))
+
+    RoutingSession.shards = shard_map
+
+
+if __name__ == "__main__":
+    from app import app
+
+    with app.app_context():
+        if sys.argv[1:2] == ["move"] and len(sys.argv) == 4:
+            moved = move_user(int(sys.argv[2]), sys.argv[3])
+            print(f"moved user {sys.argv[2]} to {sys.argv[3]} with {moved} movies")
+
+        elif sys.argv[1:] == ["init"]:
+            create_tables()
+            added = init_map()
+            db.session.commit()
+            print(f"init: {added} users put on the shard map")
+
+        else:
+            sys.exit("usage: python shards.py move USER_ID SHARD | init")
@@ -0,0 +1,244 @@
+"""Similar titles, by cast and year.
+
+Every title in the catalog has its cast (titles.actors).  Two titles
+that share actors, especially actors who aren't in much else, are
+probably alike, and more so if they came out around the same time.
+
+A precompute job encodes each title as a sparse vector over actors,
+weighted by how rare each actor is (idf, log(titles / their titles)),
+and scaled to unit length so a dot product is cosine similarity.  A
+title's similarity to another is that cosine times how close their
+years are:
+
+    cosine(a, b) / (1 + |year(a) - year(b)| / YEAR_SCALE)
+
+A @ A.T only has entries for titles that share an actor, and it's
+computed BLOCK_SIZE titles at a time, each block cut down to its top
+NEIGHBORS before the next, so the build scales with the titles and the
+pairs that share actors, not with every pair of titles.  Actors in one
+title can't make a pair and are only counted in the vectors' lengths,
+and actors in more than MAX_ACTOR_TITLES (an "N/A" that slipped through,
+a narrator in everything) are left out, they'd pair up thousands of
+titles that have little else in common.
+
+What's kept is a few flat arrays, the sorted imdb ids and NEIGHBORS
+neighbor columns and scores per title, about 90 bytes a title, written
+to SIMILAR_TITLES_FILE.  The detail page reads a title's neighbors out
+of them, a binary search and a slice.  Run the job after restores or
+every day or so (cron, Heroku Scheduler):
+
+    $ python similar.py build
+
+Titles new since the last build have no similar titles until the next.
+Like recommendations.py, this needs NumPy and SciPy, without them the
+detail page leaves similar titles out.
+"""
+
+import os
+import re
+import sys
+import time
+
+from models import db, Title
+from recommendations import BuiltModel, rank_in_rows, save, np, sparse
+from search_index import normalize
+from shards import all_shards
+
+
+# neighbors kept per title
+NEIGHBORS = 10
+
+# titles per block of A @ A.T
+BLOCK_SIZE = 1024
+
+# actors in more titles than this don't count
+MAX_ACTOR_TITLES = 2000
+
+# years apart at which similarity is halved
+YEAR_SCALE = 10
+
+# rows read from the titles table at a time by the build
+BUILD_BATCH_SIZE = 50000
+
+DEFAULT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            "similar.npz")
+
+_YEAR = re.compile(r"\d{4}")
+
+
+def cast(actors):
+    """A title's actors, normalized, from the api's "Ann Actor, Bob Actor"."""
+
+    if not actors or actors == "N/A":
+        return []
+
+    return [name for name in map(normalize, actors.split(",")) if name]
+
+
+def first_year(year):
+    """The year a title came out, from "2001" or "2001–2005", 0 if unknown."""
+
+    match = _YEAR.match(year or "")
+
+    return int(match.group()) if match else 0
+
+
+###############################################################################
+# building
+
+def build(rows):
+    """Build the index from (imdb_id, year, actors) rows, returns its arrays.
+
+    A title that comes up again (it's in more than one shard's catalog)
+    counts once.
+    """
+
+    seen = set()
+    imdb_ids = []
+    years = []
+    # a row and column (title and actor) per cast member
+    cast_rows = []
+    cast_cols = []
+    actor_ids = {}
+
+    for imdb_id, year, actors in rows:
+        if imdb_id in seen:
+            continue
+
+        seen.add(imdb_id)
+        row = len(imdb_ids)
+        imdb_ids.append(imdb_id.encode())
+        years.append(first_year(year))
+
+        for name in set(cast(actors)):
+            cast_rows.append(row)
+            cast_cols.append(actor_ids.setdefault(name, len(actor_ids)))
+
+    del actor_ids, seen
+
+    # sorted by imdb id, so lookups are a binary search
+    titles = np.array(imdb_ids, dtype="S10")
+    order = np.argsort(titles, kind="stable")
+    titles = titles[order]
+    years = np.array(years, dtype=np.int16)[order]
+    del imdb_ids
+
+    position = np.empty(len(order), dtype=np.int32)
+    position[order] = np.arange(len(order), dtype=np.int32)
+
+    cast_rows = position[np.array(cast_rows, dtype=np.int64)]
+    cast_cols = np.array(cast_cols, dtype=np.int64)
+
+    appearances = np.bincount(cast_cols) if len(cast_cols) else np.zeros(0, dtype=np.int64)
+    idf = np.log(max(len(titles), 1) / np.maximum(appearances, 1))
+
+    # unit length vectors, the length counting every actor
+    weights = idf[cast_cols]
+    lengths = np.sqrt(np.bincount(cast_rows, weights=weights ** 2, minlength=len(titles)))
+    weights = weights / np.where(lengths > 0, lengths, 1)[cast_rows]
+
+    # only actors in a few titles make pairs
+    pairs = (appearances[cast_cols] > 1) & (appearances[cast_cols] <= MAX_ACTOR_TITLES)
+
+    a = sparse.csr_matrix((weights[pairs].astype(np.float32),
+                           (cast_rows[pairs], cast_cols[pairs])),
+                          shape=(len(titles), len(appearances)))
+    del cast_rows, cast_cols, weights, pairs
+
+    neighbors = np.full((len(titles), NEIGHBORS), -1, dtype=np.int32)
+    scores = np.zeros((len(titles), NEIGHBORS), dtype=np.float32)
+
+    at = a.T.tocsr()
+
+    for first in range(0, len(titles), BLOCK_SIZE):
+        block = (a[first:first + BLOCK_SIZE] @ at).tocsr()
+        _top_neighbors(block, first, years, neighbors, scores)
+
+    return {"titles": titles, "neighbors": neighbors, "scores": scores}
+
+
+def _top_neighbors(block, first, years, neighbors, scores):
+    """Keep the top NEIGHBORS of each row of a block of A @ A.T."""
+
+    rows = np.repeat(np.arange(block.shape[0]), np.diff(block.indptr))
+    cols = block.indices
+    similarity = block.data.astype(np.float64)
+
+    keep = cols != rows + first
+    rows, cols, similarity = rows[keep], cols[keep], similarity[keep]
+
+    # unknown years don't count for or against
+    mine, theirs = years[rows + first], years[cols]
+    apart = np.where((mine > 0) & (theirs > 0), np.abs(mine - theirs.astype(np.int32)), 0)
+    similarity = similarity / (1 + apart / YEAR_SCALE)
+
+    order, rank = rank_in_rows(rows, similarity)
+    rows, cols, similarity = rows[order], cols[order], similarity[order]
+
+    top = rank < neighbors.shape[1]
+
+    neighbors[rows[top] + first, rank[top]] = cols[top]
+    scores[rows[top] + first, rank[top]] = similarity[top]
+
+
+###############################################################################
+# serving
+
+class SimilarTitles(BuiltModel):
+    """The precomputed neighbors of every title."""
+
+    def __init__(self, path=DEFAULT_FILE):
+        super().__init__(path)
+
+    def similar(self, imdb_id, limit=NEIGHBORS):
+        """imdb ids of the titles most like imdb_id, best first."""
+
+        self.ensure_loaded()
+
+        model = self._model
+
+        if model is None:
+            return []
+
+        column = self._column(model, imdb_id)
+
+        if column is None:
+            return []
+
+        titles = model["titles"]
+
+        return [titles[other].decode() for other in model["neighbors"][column][:limit].tolist()
+                    if other >= 0]
+
+
+similar_titles = SimilarTitles()
+
+
+###############################################################################
+# flask setup
+
+def init_app(app):
+    """Serve the build at SIMILAR_TITLES_FILE."""
+
+    app.config.setdefault("SIMILAR_TITLES_FILE", DEFAULT_FILE)
+
+    similar_titles.path = app.config["SIMILAR_TITLES_FILE"]
+
+
+if __name__ == "__main__":
+    from app import app
+
+    if sys.argv[1:] != ["build"]:
+        sys.exit("usage: python similar.py build")
+
+    if np is None:
+        sys.exit("similar titles need numpy and scipy installed")
+
+    with app.app_context():
+        started = time.monotonic()
+        rows = all_shards(lambda: db.session.query(Title.imdb_id, Title.year, Title.actors)
+                                      .yield_per(BUILD_BATCH_SIZE))
+        model = build(rows)
+        save(model, similar_titles.path)
+
+    print(f"build: {len(model['titles'])} titles in {time.monotonic() - started:.1f}s")
@@ -0,0 +1,380 @@
+"""Log slow queries, with their plans.
+
+SQLALCHEMY_ECHO shows every statement but not how long it took or why.
+Every statement that takes SLOW_QUERY_SECONDS or longer is logged
+instead, with its parameters and the endpoint and user it ran for, and
+kept in memory:
+
+- SLOW_QUERY_EXPLAIN_RATE of them (0.1 for one in ten) get their plan
+  too, at most once per statement shape per SLOW_QUERY_EXPLAIN_INTERVAL
+  seconds.  On postgres a plain SELECT gets EXPLAIN (ANALYZE, BUFFERS),
+  which runs the query again, inside a savepoint that's always rolled
+  back.  Anything that could change something when run (a WITH, a
+  SELECT ... FOR UPDATE, one calling setval() or another function that
+  might write) only gets EXPLAIN, which runs nothing.  sqlite gets
+  EXPLAIN QUERY PLAN, which doesn't run anything either.
+- every SLOW_QUERY_DIGEST_INTERVAL seconds each worker logs a digest of
+  its slow queries since the last one, grouped by shape: the statement
+  with its literals, parameters and IN lists made into "?", so the same
+  query with different values counts together.  Shapes whose plans
+  scanned a whole table (a "Seq Scan on movies", say) say so, which is
+  what a missing index looks like.
+
+The EXPLAIN runs straight on the DBAPI connection, so it isn't counted
+against query budgets or in the metrics' query count, but its time is
+part of the request's.  Parameters are cut short, and the values of
+ones named like passwords aren't logged at all.
+
+On postgres, queries read with yield_per() (the streamed /movies page,
+exports) run on a server side cursor: the time here is only its
+DECLARE, the rows are fetched (and most of the work done) while the
+response streams, so those never show up as slow.  Their time is in the
+request's (see metrics.py).
+
+With SLOW_QUERY_SECONDS unset (None), nothing is timed or kept.
+"""
+
+import logging
+import os
+import random
+import re
+import threading
+import time
+from collections import deque
+
+from flask import g, has_request_context, request
+from sqlalchemy import event, inspect
+from sqlalchemy.engine import Engine
+
+
+logger = logging.getLogger(__name__)
+
+# longest parameter value logged, in characters
+MAX_PARAM_LENGTH = 200
+
+# parameters whose values are never logged
+SECRET_PARAMS = re.compile(r"password", re.IGNORECASE)
+
+# what a shape's literals and placeholders look like: quoted strings,
+# numbers, and the %(name)s, %s, ? and :name paramstyles
+LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+PLACEHOLDERS = re.compile(r"%\(\w+\)s|%s|\?|(?<!:):\w+")
+PLACEHOLDER_LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+
+# what makes a SELECT more than a read: locking rows, or making a table
+WRITES = re.compile(r"\b(?:INSERT|UPDATE|DELETE|MERGE|INTO|FOR\s+(?:NO\s+KEY\s+|KEY\s+)?SHARE)\b",
+                    re.IGNORECASE)
+
+# function calls (as SQLAlchemy writes them, no space before the "("),
+# and the ones that only read.  any other (setval(), nextval(),
+# pg_advisory_lock(), ...) could write, so isn't run again.
+FUNCTION_CALLS = re.compile(r"\b(\w+)\(")
+READ_ONLY_FUNCTIONS = {"count", "sum", "min", "max", "avg", "coalesce", "lower",
+                       "upper", "length", "substr", "cast", "any", "array_agg",
+                       "string_agg", "row_number", "rank", "now", "date", "abs"}
+
+# plan lines that read a whole table, on postgres and sqlite
+FULL_SCANS = re.compile(r"Seq Scan on (\w+)|\bSCAN (?:TABLE )?(\w+)")
+
+
+def shape(statement):
+    """A statement with its values taken out, e.g.
+
+        SELECT * FROM movies WHERE user_id = %(user_id_1)s AND imdb_id IN (%s, %s)
+
+    is "SELECT * FROM movies WHERE user_id = ? AND imdb_id IN (?)".
+    """
+
+    statement = PLACEHOLDERS.sub("?", LITERALS.sub("?", statement))
+    statement = PLACEHOLDER_LISTS.sub("(?)", statement)
+
+    return " ".join(statement.split())
+
+
+def loggable(parameters):
+    """Parameters as they go in the log: short, and without secrets."""
+
+    def value(name, value):
+        if name is not None and SECRET_PARAMS.search(str(name)):
+            return "<hidden>"
+
+        text = repr(value)
+
+        if len(text) > MAX_PARAM_LENGTH:
+            text = text[:MAX_PARAM_LENGTH] + "..."
+
+        return text
+
+    if isinstance(parameters, dict):
+        return {name: value(name, v) for name, v in parameters.items()}
+
+    if isinstance(parameters, (list, tuple)):
+        return [value(None, v) for v in parameters]
+
+    return value(None, parameters)
+
+
+def full_scans(plan):
+    """The tables a plan reads all of."""
+
+    return sorted({first or second for first, second in FULL_SCANS.findall(plan or "")})
+
+
+def analyzable(statement):
+    """Can a statement be run again to explain it, because all it does is
+    read?
+    """
+
+    return (statement.lstrip().upper().startswith("SELECT")
+            and not WRITES.search(statement)
+            and all(name.lower() in READ_ONLY_FUNCTIONS
+                    for name in FUNCTION_CALLS.findall(statement)))
+
+
+def explain(conn, cursor, statement, parameters):
+    """The plan of a statement that just ran on conn, or None if it
+    can't be explained.
+    """
+
+    if not statement.lstrip().upper().startswith(("SELECT", "WITH")):
+        return None
+
+    dialect = conn.dialect.name
+    dbapi_conn = conn.connection
+
+    if dialect == "postgresql":
+        options = "(ANALYZE, BUFFERS) " if analyzable(statement) else ""
+        explain_cursor = dbapi_conn.cursor()
+
+        try:
+            explain_cursor.execute("SAVEPOINT slow_query_explain")
+
+            # rolled back even when it worked, whatever ANALYZE ran is undone
+            try:
+                explain_cursor.execute(f"EXPLAIN {options}" + statement, parameters)
+                return "\n".join(row[0] for row in explain_cursor.fetchall())
+            finally:
+                explain_cursor.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+                explain_cursor.execute("RELEASE SAVEPOINT slow_query_explain")
+
+        finally:
+            explain_cursor.close()
+
+    if dialect == "sqlite":
+        explain_cursor = dbapi_conn.cursor()
+
+        try:
+            explain_cursor.execute("EXPLAIN QUERY PLAN " + statement, parameters)
+            return "\n".join(row[-1] for row in explain_cursor.fetchall())
+        finally:
+            explain_cursor.close()
+
+    return None
+
+
+class SlowQueryLog:
+    """Slow queries, the most recent ones whole and the rest by shape."""
+
+    def __init__(self):
+        self.threshold = None
+        self.explain_rate = 0.1
+        self.explain_interval = 60
+        self.digest_interval = 3600
+        self.recent = deque(maxlen=100)
+
+        # shape -> {"count", "seconds", "max_seconds", "example", "endpoints", "full_scans"}
+        self._shapes = {}
+        # shape -> time.monotonic() it was last explained
+        self._explained = {}
+        self._digest_pid = None
+        self._lock = threading.Lock()
+
+    def should_explain(self, statement_shape):
+        """Is this slow query one of the sample to explain?"""
+
+        if random.random() >= self.explain_rate:
+            return False
+
+        now = time.monotonic()
+
+        with self._lock:
+            if now - self._explained.get(statement_shape, -self.explain_interval) < self.explain_interval:
+                return False
+
+            self._explained[statement_shape] = now
+
+        return True
+
+    def add(self, entry):
+        """Keep a slow query, and log it."""
+
+        self._ensure_digest()
+
+        with self._lock:
+            self.recent.append(entry)
+
+            found = self._shapes.get(entry["shape"])
+
+            if found is None:
+                found = self._shapes[entry["shape"]] = {
+                    "count": 0, "seconds": 0.0, "max_seconds": 0.0,
+                    "example": entry["statement"], "endpoints": set(), "full_scans": set()}
+
+            found["count"] += 1
+            found["seconds"] += entry["seconds"]
+            found["max_seconds"] = max(found["max_seconds"], entry["seconds"])
+            found["endpoints"].add(entry["endpoint"])
+            found["full_scans"].update(full_scans(entry["plan"]))
+
+        logger.warning("slow query, %.3fs on %s for user %s: %s %r%s",
+                       entry["seconds"], entry["endpoint"], entry["user_id"],
+                       entry["statement"], entry["parameters"],
+                       "\n" + entry["plan"] if entry["plan"] else "")
+
+    ###########################################################################
+    # the digest
+
+    def digest(self, reset=False):
+        """The slow queries by shape, most total time first."""
+
+        with self._lock:
+            shapes = self._shapes
+
+            if reset:
+                self._shapes = {}
+
+            return [{"shape": statement_shape,
+                     **{name: sorted(value, key=str) if isinstance(value, set) else value
+                        for name, value in found.items()}}
+                    for statement_shape, found in sorted(shapes.items(),
+                                                         key=lambda item: -item[1]["seconds"])]
+
+    def log_digest(self):
+        """Log (and start over) the digest of the slow queries so far."""
+
+        for found in self.digest(reset=True):
+            logger.warning("slow query digest: %d x %.3fs total, %.3fs max, on %s%s: %s",
+                           found["count"], found["seconds"], found["max_seconds"],
+                           ", ".join(str(endpoint) for endpoint in found["endpoints"]),
+                           f", full scans of {', '.join(found['full_scans'])}"
+                           if found["full_scans"] else "",
+                           found["shape"])
+
+    def _log_digests(self):
+        while True:
+            time.sleep(self.digest_interval)
+            self.log_digest()
+
+    def _ensure_digest(self):
+        """Start this worker's digest thread (like replicas.py's lag checker,
+        one per process, gunicorn forks after preloading the app).
+        """
+
+        if self._digest_pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._digest_pid != os.getpid():
+                self._digest_pid = os.getpid()
+                threading.Thread(target=self._log_digests, daemon=True,
+                                 name="slow-query-digest").start()
+
+    def clear(self):
+        with self._lock:
+            self.recent.clear()
+            self._shapes = {}
+            self._explained = {}
+
+
+slow_log = SlowQueryLog()
+
+
+###############################################################################
+# timing
+
+def _current_user_id():
+    """The id of the request's user, without loading anything (this runs
+    in the middle of a query).
+    """
+
+    user = g.get("user")
+
+    if user is None:
+        return None
+
+    identity = inspect(user).identity
+
+    return identity[0] if identity else None
+
+
+def _query_started(conn, cursor, statement, parameters, context, executemany):
+    if slow_log.threshold is not None:
+        conn.info.setdefault("slow_query_start", []).append(time.perf_counter())
+
+
+def _query_finished(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get("slow_query_start")
+
+    if not starts:
+        return
+
+    seconds = time.perf_counter() - starts.pop()
+
+    if slow_log.threshold is None or seconds < slow_log.threshold:
+        return
+
+    statement_shape = shape(statement)
+    plan = None
+
+    if not executemany and slow_log.should_explain(statement_shape):
+        try:
+            plan = explain(conn, cursor, statement, parameters)
+        except Exception:
+            logger.warning("couldn't explain %s", statement, exc_info=True)
+
+    if has_request_context():
+        endpoint = request.endpoint or "unknown"
+        user_id = _current_user_id()
+    else:
+        endpoint = user_id = None
+
+    slow_log.add({
+        "at": time.time(),
+        "seconds": round(seconds, 6),
+        "statement": statement,
+        "shape": statement_shape,
+        "parameters": loggable(parameters),
+        "endpoint": endpoint,
+        "user_id": user_id,
+        "plan": plan,
+    })
+
+
+def _query_failed(context):
+    # after_cursor_execute never runs for a failed query
+    starts = context.connection.info.get("slow_query_start") if context.connection else None
+
+    if starts:
+        starts.pop()
+
+
+###############################################################################
+# flask setup
+
+def init_app(app):
+    """Log statements slower than SLOW_QUERY_SECONDS."""
+
+    app.config.setdefault("SLOW_QUERY_SECONDS", None)
+    app.config.setdefault("SLOW_QUERY_EXPLAIN_RATE", 0.1)
+    app.config.setdefault("SLOW_QUERY_EXPLAIN_INTERVAL", 60)
+    app.config.setdefault("SLOW_QUERY_DIGEST_INTERVAL", 3600)
+
+    slow_log.threshold = app.config["SLOW_QUERY_SECONDS"]
+    slow_log.explain_rate = app.config["SLOW_QUERY_EXPLAIN_RATE"]
+    slow_log.explain_interval = app.config["SLOW_QUERY_EXPLAIN_INTERVAL"]
+    slow_log.digest_interval = app.config["SLOW_QUERY_DIGEST_INTERVAL"]
+
+    if not event.contains(Engine, "before_cursor_execute", _query_started):
+        event.listen(Engine, "before_cursor_execute", _query_started)
+        event.listen(Engine, "after_cursor_execute", _query_finished)
+        event.listen(Engine, "handle_error", _query_failed)
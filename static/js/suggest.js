@@ -0,0 +1,38 @@
+/**
+ * Autocomplete search terms from titles we already know
+ */
+
+const termInput = document.getElementById("term")
+const termSuggestions = document.getElementById("termSuggestions")
+
+// wait for a pause in typing before asking the server
+const SUGGEST_DELAY = 150
+
+let suggestTimer = null
+
+termInput.addEventListener('input', function() {
+  clearTimeout(suggestTimer)
+
+  const term = termInput.value.trim()
+
+  if (term.length < 2) {
+    termSuggestions.innerHTML = ""
+    return
+  }
+
+  suggestTimer = setTimeout(function() {
+    fetch(`/movie-search/suggest?term=${encodeURIComponent(term)}`)
+    .then(resp => resp.ok ? resp.json() : [])
+    .then(suggestions => {
+      termSuggestions.innerHTML = ""
+
+      suggestions.forEach(movie => {
+        const option = document.createElement("option")
+        option.value = movie["Title"]
+        option.label = movie["Year"]
+        termSuggestions.appendChild(option)
+      })
+    })
+    .catch(err => console.log(err))
+  }, SUGGEST_DELAY)
+})
@@ -0,0 +1,123 @@
+"""Stream big pages to the browser as they render.
+
+render_template() builds the whole page in memory before the first
+byte goes out, so a ledger with tens of thousands of movies means a long
+wait for a blank page and every item's markup held at once.
+stream_page() renders the same template as a stream instead:
+
+    rows = Rows(query.yield_per(STREAM_BATCH_SIZE))
+    return stream_page("movies.html", movies=rows, ...)
+
+- the page goes out in chunks of about STREAM_CHUNK_SIZE as it renders,
+  the head and the filter form first, then the list a chunk at a time.
+- Rows wraps the rows of a server-side cursor so the template can ask
+  {% if movies %} (it reads ahead one row) and loop over them once.
+- Later(make) is for template values that need the rows first, e.g.
+  recommendations, made the first time the template uses them.
+
+The view's query runs while the body is sent, inside the request (see
+stream_with_context), so it's still counted against the view's query
+budget and in its timings, once the body is done (see after_stream(),
+query_budget.py and metrics.py).
+"""
+
+from flask import Response, get_flashed_messages, stream_template
+
+
+# rows fetched from the database at a time
+STREAM_BATCH_SIZE = 500
+
+# bytes of markup sent at a time, small enough for the head to go out
+# right away, big enough not to send a packet per list item
+STREAM_CHUNK_SIZE = 8192
+
+
+class Rows:
+    """Rows that can be tested for emptiness, then iterated once."""
+
+    def __init__(self, rows):
+        self._rows = iter(rows)
+        self._first = None
+        self._empty = None
+
+    def __bool__(self):
+        if self._empty is None:
+            try:
+                self._first = next(self._rows)
+                self._empty = False
+            except StopIteration:
+                self._empty = True
+
+        return not self._empty
+
+    def __iter__(self):
+        if self:
+            first, self._first = self._first, None
+            yield first
+            yield from self._rows
+
+
+class Later:
+    """A list made by make() the first time it's needed."""
+
+    def __init__(self, make):
+        self._make = make
+        self._value = None
+
+    def _get(self):
+        if self._value is None:
+            self._value = list(self._make())
+
+        return self._value
+
+    def __bool__(self):
+        return bool(self._get())
+
+    def __iter__(self):
+        return iter(self._get())
+
+    def __len__(self):
+        return len(self._get())
+
+
+def chunked(pieces, size=STREAM_CHUNK_SIZE):
+    """Join rendered pieces of markup into chunks of about size bytes."""
+
+    buffer = []
+    buffered = 0
+
+    for piece in pieces:
+        buffer.append(piece)
+        buffered += len(piece)
+
+        if buffered >= size:
+            yield "".join(buffer)
+            buffer = []
+            buffered = 0
+
+    if buffer:
+        yield "".join(buffer)
+
+
+def after_stream(response, callback):
+    """Call callback() once a streamed response's body has all been
+    produced, e.g. to count the queries it ran.
+    """
+
+    def body(chunks):
+        yield from chunks
+        callback()
+
+    response.response = body(response.response)
+
+
+def stream_page(template_name, **context):
+    """A response that streams a template, rendered as it's sent."""
+
+    # the session cookie is saved before the body renders, so the
+    # flashes have to come out of the session now.  the template's
+    # get_flashed_messages() gets them from the request after that.
+    get_flashed_messages()
+
+    return Response(chunked(stream_template(template_name, **context)),
+                    mimetype="text/html")
@@ -4,22 +4,29 @@
 #    python -m unittest test_movie_model.py
 
 import os
-from unittest import TestCase
+from unittest import TestCase, skipUnless
 
-from models import db, Movie, User
+from models import db, Movie, User, Title
 
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
 # before we import our app, since that will have already
 # connected to the database
+#
+# tests run on an in memory sqlite db, set TEST_DATABASE_URL (e.g. to
+# postgresql:///movie_ledger_test) to run them against postgres.  we
+# hash passwords with the fewest bcrypt rounds, full strength hashing
+# would be most of the run time.
 
-os.environ['DATABASE_URL'] = "postgresql:///movie_ledger_test"
+os.environ['DATABASE_URL'] = os.environ.get('TEST_DATABASE_URL', "sqlite://")
+os.environ['BCRYPT_LOG_ROUNDS'] = "4"
 
 
 # Now we can import app
 
 from app import app
+import similar
 
 
 ################################################################################
@@ -264,3 +271,76 @@ class MovieModelTestCase(TestCase):
 
         # there should be no movies with our user_id in our db
         self.assertEqual(num_movies, 0)
+
+
+    def test_movies_share_title_catalog(self):
+        """Do the same title in two ledgers share one catalog row?"""
+
+        # get our users
+        u1 = User.query.filter_by(username="testuser").first()
+        u2 = User.query.filter_by(username="testuser2").first()
+
+        Title.query.filter_by(imdb_id="testID789").delete()
+
+        # add the same title to both ledgers in one flush
+        for u in (u1, u2):
+            db.session.add(Movie(
+                imdb_id="testID789",
+                user_id=u.id,
+                title="Shared Movie",
+                year="1999",
+                imdb_img='http://www.test-url.com/test-directory/static/images/test.jpg'
+            ))
+
+        db.session.commit()
+
+        # there should be only one catalog row for the title
+        self.assertEqual(Title.query.filter_by(imdb_id="testID789").count(), 1)
+
+        # updating the catalog row is seen by every ledger entry
+        t = Title.query.get("testID789")
+        t.title = "Shared Movie (Remastered)"
+        db.session.commit()
+
+        titles = [m.title for m in Movie.query.filter_by(imdb_id="testID789")]
+        self.assertEqual(titles, ["Shared Movie (Remastered)"] * 2)
+
+        # a new ledger entry can't rewrite the shared row
+        Movie.query.filter_by(imdb_id="testID789", user_id=u1.id).delete()
+        db.session.commit()
+
+        db.session.add(Movie(imdb_id="testID789", user_id=u1.id, title="Defaced",
+                             imdb_img="http://evil.example.com/poster.jpg"))
+        db.session.commit()
+
+        t = Title.query.get("testID789")
+        self.assertEqual(t.title, "Shared Movie (Remastered)")
+        self.assertEqual(t.imdb_img, 'http://www.test-url.com/test-directory/static/images/test.jpg')
+
+
+    @skipUnless(similar.np, "needs numpy and scipy")
+    def test_similar_titles(self):
+        """Are titles with the same cast similar, closer years first?"""
+
+        u = User.query.filter_by(username="testuser").first()
+
+        for imdb_id, year, actors in [("simID1", "2001", "Ann Actor, Bob Actor"),
+                                      ("simID2", "2003", "Ann Actor, Bob Actor"),
+                                      ("simID3", "1960", "Bob Actor, Ann Actor"),
+                                      ("simID4", "2001", "Cal Actor"),
+                                      ("simID5", "2001", "N/A")]:
+            db.session.add(Movie(imdb_id=imdb_id, user_id=u.id, title=imdb_id, year=year,
+                                 actors=actors, imdb_img="N/A"))
+
+        db.session.commit()
+
+        rows = (db.session.query(Title.imdb_id, Title.year, Title.actors)
+                    .filter(Title.imdb_id.like("simID%")))
+
+        index = similar.SimilarTitles(path="no-such-build.npz")
+        index.load(similar.build(rows))
+
+        self.assertEqual(index.similar("simID1"), ["simID2", "simID3"])
+        self.assertEqual(index.similar("simID4"), [])
+        self.assertEqual(index.similar("simID5"), [])
+        self.assertEqual(index.similar("notInIndex"), [])
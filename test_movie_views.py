@@ -3,24 +3,52 @@
 # run these tests like:
 #    FLASK_ENV=production python -m unittest test_message_views.py
 
+import gzip
+import io
+import json
+import marshal
 import os
-from unittest import TestCase
+import tracemalloc
+from datetime import date
+from unittest import TestCase, skipUnless
 
-from models import db, connect_db, User, Movie
+from sqlalchemy import event
+
+from models import db, connect_db, User, Movie, Title, PopularityBucket
+from query_budget import QueryBudgetTestMixin
 
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
 # before we import our app, since that will have already
 # connected to the database
+#
+# tests run on an in memory sqlite db, set TEST_DATABASE_URL (e.g. to
+# postgresql:///movie_ledger_test) to run them against postgres.  we
+# hash passwords with the fewest bcrypt rounds, full strength hashing
+# would be most of the run time.
 
-os.environ['DATABASE_URL'] = "postgresql:///movie_ledger_test"
+os.environ['DATABASE_URL'] = os.environ.get('TEST_DATABASE_URL', "sqlite://")
+os.environ['BCRYPT_LOG_ROUNDS'] = "4"
 
 
 # Now we can import app
 
-from app import app, CURR_USER_KEY
+from app import app, CURR_USER_KEY, LEDGER_PAGE_COLUMNS, ledger_query
+from fragments import fragment_cache
+from popularity import leaderboards
+import recommendations
+from recommendations import recommender
+from replicas import router
+import ledger_cache
+from ledger_cache import ledgers
+from profiler import profiles
+from slow_queries import slow_log, analyzable, explain
+
 
+# flask-sqlalchemy makes a new engine (so a new, empty in memory db)
+# if SQLALCHEMY_ECHO changes, so set it before creating our tables
+app.config['SQLALCHEMY_ECHO'] = False
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -34,7 +62,10 @@ db.create_all()
 
 app.config['TESTING'] = True
 app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
-app.config['SQLALCHEMY_ECHO'] = False
+
+# fail any request that goes over its view's query budget or looks like
+# an N+1 (see query_budget.py)
+app.config['QUERY_BUDGET_RAISE'] = True
 
 # Don't have WTForms use CSRF at all, since it's a pain to test
 
@@ -44,7 +75,7 @@ app.config['WTF_CSRF_ENABLED'] = False
 ################################################################################
 # tests
 
-class MovieViewTestCase(TestCase):
+class MovieViewTestCase(QueryBudgetTestMixin, TestCase):
     """Test views for movies."""
 
     def setUp(self):
@@ -52,6 +83,11 @@ class MovieViewTestCase(TestCase):
 
         Movie.query.delete()
         User.query.delete()
+        PopularityBucket.query.delete()
+        Title.query.delete()
+
+        # ids can come around again, and with them ledger versions
+        ledgers.clear()
 
         # create an initial user
         self.testuser = User.signup(username="testuser",
@@ -230,3 +266,711 @@ class MovieViewTestCase(TestCase):
             
             self.assertEqual(resp.status_code, 200)
             self.assertEqual(resp.json, {"message": "success"})
+
+
+    def test_batch_edit_movies(self):
+        """Can user edit many movies in one request?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            m = Movie(
+                imdb_id="test456",
+                user_id=self.testuser.id,
+                title="Test Movie 2",
+                year="2023",
+                imdb_img="http://www.test-url.com/test-directory/static/images/test.jpg"
+            )
+
+            db.session.add(m)
+            db.session.commit()
+
+            json = {"operations": [
+                {"action": "unfavorite", "ids": ["testID123", "missing1"]},
+                {"action": "set-platform", "ids": ["testID123"], "value": "hulu"},
+                {"action": "set-date_viewed", "ids": ["testID123"], "value": "2023-01-02"},
+                {"action": "delete", "ids": ["test456"]}
+            ]}
+
+            resp = c.post("/movies/batch", json=json)
+
+            self.assertEqual(resp.status_code, 200)
+            results = resp.json["results"]
+            self.assertEqual(results[0]["results"], {"testID123": "ok", "missing1": "not found"})
+            self.assertEqual(results[3]["results"], {"test456": "ok"})
+
+            movie = Movie.query.filter_by(user_id=self.testuser.id).one()
+            self.assertEqual(movie.imdb_id, "testID123")
+            self.assertFalse(movie.favorite)
+            self.assertEqual(movie.platform, "hulu")
+            self.assertEqual(str(movie.date_viewed), "2023-01-02")
+
+
+    def test_batch_edit_movies_invalid(self):
+        """Is a batch with a bad operation rejected without applying any of it?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            json = {"operations": [
+                {"action": "delete", "ids": ["testID123"]},
+                {"action": "set-platform", "ids": ["testID123"], "value": "betamax"}
+            ]}
+
+            resp = c.post("/movies/batch", json=json)
+
+            self.assertEqual(resp.status_code, 400)
+            self.assertEqual(Movie.query.filter_by(user_id=self.testuser.id).count(), 1)
+
+            # so is a body that isn't an object at all
+            resp = c.post("/movies/batch", json=[{"action": "delete", "ids": ["testID123"]}])
+
+            self.assertEqual(resp.status_code, 400)
+            self.assertEqual(Movie.query.filter_by(user_id=self.testuser.id).count(), 1)
+
+            # and a platform that isn't a string
+            for value in ([], {}):
+                resp = c.post("/movies/batch", json={"action": "set-platform",
+                                                     "ids": ["testID123"], "value": value})
+
+                self.assertEqual(resp.status_code, 400)
+                self.assertIn("Unknown platform", resp.json["message"])
+
+
+    def test_export_movies_csv(self):
+        """Can user export their ledger as csv with the ledger filters?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            m = Movie(
+                imdb_id="test456",
+                user_id=self.testuser.id,
+                title="A Test Movie",
+                year="1999",
+                imdb_img="http://www.test-url.com/test-directory/static/images/test.jpg"
+            )
+
+            db.session.add(m)
+            db.session.commit()
+
+            resp = c.get("/movies/export.csv?sort=title&order=asc")
+            lines = resp.get_data(as_text=True).splitlines()
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.mimetype, "text/csv")
+            self.assertTrue(lines[0].startswith("imdb_id,title,year"))
+            self.assertTrue(lines[1].startswith("test456,A Test Movie,1999"))
+            self.assertTrue(lines[2].startswith("testID123,Test Movie,2023"))
+
+            # only our favorite should be exported with the favorites filter
+            resp = c.get("/movies/export.csv?filter=favorites")
+            lines = resp.get_data(as_text=True).splitlines()
+
+            self.assertEqual(len(lines), 2)
+
+
+    def test_export_movies_ndjson_gzip(self):
+        """Is the ndjson export gzipped when the client accepts it?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.get("/movies/export.ndjson", headers={"Accept-Encoding": "gzip"})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+
+            rows = [json.loads(line) for line in gzip.decompress(resp.data).splitlines()]
+            self.assertEqual(len(rows), 1)
+            self.assertEqual(rows[0]["imdb_id"], "testID123")
+            self.assertEqual(rows[0]["favorite"], True)
+
+
+    def test_restore_movies(self):
+        """Can user restore a ledger file into their ledger?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            # a title some other user has, it's in the catalog already
+            db.session.add(Title(imdb_id="test789", title="New Movie", year="1999",
+                                 imdb_img="http://test.com/b.jpg"))
+            db.session.commit()
+
+            ledger = (
+                "imdb_id,title,year,actors,imdb_img,favorite,platform,date_viewed,date_added\n"
+                "testID123,Test Movie,2023,,http://test.com/a.jpg,False,hulu,,2023-01-01\n"
+                "test789,Defaced,1999,,http://evil.com/b.jpg,True,,2023-02-03,2023-01-01\n"
+                "test999,Not In Catalog,1999,,http://evil.com/c.jpg,True,,,\n"
+                ",Bad Row,1999,,http://test.com/c.jpg,True,,,\n"
+                "test000,No Title Data,,,,True,,,\n"
+            )
+
+            data = {"file": (io.BytesIO(ledger.encode("utf8")), "movie-ledger.csv")}
+            resp = c.post("/movies/restore", data=data, content_type="multipart/form-data")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json["inserted"], 1)
+            self.assertEqual(resp.json["updated"], 1)
+            self.assertEqual(resp.json["skipped"], 3)
+
+            updated = Movie.query.filter_by(imdb_id="testID123", user_id=self.testuser.id).one()
+            self.assertFalse(updated.favorite)
+            self.assertEqual(updated.platform, "hulu")
+
+            # the catalog's data, not the file's
+            added = Movie.query.filter_by(imdb_id="test789", user_id=self.testuser.id).one()
+            self.assertEqual(added.title, "New Movie")
+            self.assertEqual(added.imdb_img, "http://test.com/b.jpg")
+            self.assertTrue(added.favorite)
+
+            # and an upload never adds to the shared catalog
+            self.assertIsNone(Title.query.get("test999"))
+
+
+    def test_movies_flash_shown_once(self):
+        """Is a flash shown on the streamed ledger page once, and the page
+        conditional again after that?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+                sess["_flashes"] = [("success", "Movie updated!")]
+
+            resp = c.get("/movies")
+            self.assertIn("Movie updated!", resp.get_data(as_text=True))
+
+            resp = c.get("/movies")
+            self.assertNotIn("Movie updated!", resp.get_data(as_text=True))
+
+            resp = c.get("/movies", headers={"If-None-Match": resp.headers["ETag"]})
+            self.assertEqual(resp.status_code, 304)
+
+
+    def test_movies_conditional_get(self):
+        """Do we get a 304 for an unchanged ledger, and a fresh page after a change?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.get("/movies")
+            etag = resp.headers["ETag"]
+
+            self.assertEqual(resp.status_code, 200)
+
+            # nothing changed, so the browser's copy is still good
+            resp = c.get("/movies", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+
+            # a different sort is a different page
+            resp = c.get("/movies?sort=title", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+
+            # any write to the ledger gets us a new page
+            c.post("/movie/testID123/favorite")
+
+            resp = c.get("/movies", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotEqual(resp.headers["ETag"], etag)
+
+
+    def test_movies_fragment_cache(self):
+        """Are ledger items rendered from the fragment cache and refreshed on change?"""
+
+        fragment_cache.clear()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            first = c.get("/movies").get_data(as_text=True)
+            hits = fragment_cache.hits
+
+            # the same ledger renders the same page from the cache
+            second = c.get("/movies").get_data(as_text=True)
+            self.assertEqual(fragment_cache.hits, hits + 1)
+            self.assertEqual(first, second)
+            self.assertIn('class="fa-star fas ml__my-list--fav"', second)
+
+            # unfavoriting changes the item's markup
+            c.post("/movie/testID123/favorite")
+
+            html = c.get("/movies").get_data(as_text=True)
+            self.assertIn('class="far fa-star ml__my-list--fav"', html)
+
+
+    def test_server_timing_and_metrics(self):
+        """Are db and template times reported per request and aggregated in /metrics?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            # the ledger page streams, its header goes out before the
+            # template renders, so look at a page that doesn't
+            resp = c.get("/profile")
+            timing = resp.headers["Server-Timing"]
+
+            self.assertIn("db;dur=", timing)
+            self.assertIn("tmpl;dur=", timing)
+            self.assertIn("total;dur=", timing)
+
+            # a streamed page is counted once it's been sent
+            c.get("/movies").get_data()
+
+            resp = c.get("/metrics")
+            text = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('movie_ledger_request_duration_seconds_count{endpoint="show_my_movies"}', text)
+            self.assertIn('movie_ledger_part_calls_total{endpoint="show_my_movies",part="db"}', text)
+            self.assertIn('movie_ledger_part_calls_total{endpoint="show_my_movies",part="tmpl"}', text)
+
+
+    def test_profiler(self):
+        """Are requests profiled when asked for, and the results only shown
+        to token holders?"""
+
+        profiles.clear()
+        app.config["PROFILER_TOKEN"] = "profile-me"
+        auth = {"Authorization": "Bearer profile-me"}
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser.id
+
+                # not asked for, or asked for without the token
+                c.get("/movies").get_data()
+                c.get("/movies", headers={"X-Profile": "wrong"}).get_data()
+                self.assertEqual(c.get("/admin/profiles").status_code, 401)
+                self.assertEqual(c.get("/admin/profiles", headers=auth).json["recent"], [])
+
+                # the streamed body is part of the profile
+                c.get("/movies", headers={"X-Profile": "profile-me"}).get_data()
+
+                found = c.get("/admin/profiles", headers=auth).json
+                self.assertEqual(found["hotspots"]["show_my_movies"]["requests"], 1)
+                self.assertTrue(found["hotspots"]["show_my_movies"]["functions"])
+
+                profile_id = found["recent"][0]["id"]
+                raw = c.get(f"/admin/profiles/{profile_id}.prof", headers=auth).get_data()
+                stats = marshal.loads(raw)
+                self.assertTrue(any(name == "show_my_movies" for _, _, name in stats))
+
+                # snapshots start tracing, and compare with the one before
+                first = c.post("/admin/memory/snapshot", headers=auth).json
+                self.assertIsNone(first["growth"])
+                second = c.post("/admin/memory/snapshot", headers=auth).json
+                self.assertIsInstance(second["growth"], list)
+                c.post("/admin/memory/stop", headers=auth)
+
+            app.config["PROFILER_TOKEN"] = None
+            self.assertEqual(self.client.get("/admin/profiles").status_code, 404)
+
+        finally:
+            app.config["PROFILER_TOKEN"] = None
+            tracemalloc.stop()
+
+
+    def test_slow_query_log(self):
+        """Are slow queries kept with their endpoint, user and plan, and
+        grouped by shape?"""
+
+        slow_log.clear()
+        slow_log.threshold, slow_log.explain_rate = 0, 1
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser.id
+
+                with self.assertLogs("slow_queries", "WARNING"):
+                    c.get("/movies?sort=title").get_data()
+
+        finally:
+            slow_log.threshold, slow_log.explain_rate = None, 0.1
+
+        ledger = [entry for entry in slow_log.recent
+                  if entry["endpoint"] == "show_my_movies" and "FROM movies" in entry["statement"]]
+
+        self.assertTrue(ledger)
+        self.assertEqual(ledger[0]["user_id"], self.testuser.id)
+        self.assertTrue(ledger[0]["plan"])
+        self.assertIn("movies", ledger[0]["plan"])
+
+        # the user query ran with a different id than another user's
+        # would, it's still one shape
+        shapes = {found["shape"]: found for found in slow_log.digest()}
+        self.assertIn(ledger[0]["shape"], shapes)
+        self.assertNotIn(str(self.testuser.id) + " ", ledger[0]["shape"])
+
+        with self.assertLogs("slow_queries", "WARNING") as logs:
+            slow_log.log_digest()
+
+        self.assertIn("slow query digest", logs.output[0])
+        self.assertEqual(slow_log.digest(), [])
+
+        # only plain reads are run again to be explained
+        self.assertTrue(analyzable("SELECT count(*) FROM movies WHERE movies.user_id = ?"))
+
+        for statement in ("SELECT setval(pg_get_serial_sequence('users', 'id'), 1, false)",
+                          "SELECT * FROM users WHERE users.id = ? FOR UPDATE",
+                          "WITH gone AS (DELETE FROM movies RETURNING *) SELECT * FROM gone"):
+            self.assertFalse(analyzable(statement), statement)
+
+        # and nothing one does is kept
+        if db.engine.dialect.name == "postgresql":
+            with db.engine.connect() as conn:
+                before = conn.execute("SELECT last_value FROM users_id_seq").scalar()
+                plan = explain(conn, None, "SELECT setval('users_id_seq', 12345)", {})
+
+                self.assertTrue(plan)
+                self.assertEqual(conn.execute("SELECT last_value FROM users_id_seq").scalar(),
+                                 before)
+
+
+    def test_movies_query_budget(self):
+        """Does a bigger ledger still load in the same number of queries?"""
+
+        for i in range(10):
+            db.session.add(Movie(
+                imdb_id=f"budget{i}",
+                user_id=self.testuser.id,
+                title=f"Budget Movie {i}",
+                year="2023",
+                imdb_img="http://www.test-url.com/test-directory/static/images/test.jpg"
+            ))
+
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            # the user, then the movies joined to their titles
+            # the page streams, its queries run as the body is read
+            with self.assertQueryBudget(2):
+                resp = c.get("/movies?sort=title")
+                html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Budget Movie 9", html)
+
+
+    def test_movies_page_streamed(self):
+        """Is the ledger page streamed, with its empty states intact?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.get("/movies")
+
+            self.assertTrue(resp.is_streamed)
+            self.assertIn("Test Movie", resp.get_data(as_text=True))
+
+            Movie.query.update({Movie.favorite: False})
+            User.bump_ledger_version(self.testuser.id)
+            db.session.commit()
+
+            # no favorites: the form stays, with a note instead of a list
+            html = c.get("/movies?filter=favorites").get_data(as_text=True)
+
+            self.assertIn('id="favorites"', html)
+            self.assertIn("No movies found....", html)
+            self.assertNotIn("Search Now", html)
+            self.assertNotIn('id="myMovieList"', html)
+
+
+    def test_movies_page_reads_rows(self):
+        """Is the ledger page rendered from plain rows, without loading
+        Movie instances?"""
+
+        loaded = []
+        listener = lambda target, context: loaded.append(target)
+        event.listen(Movie, "load", listener)
+        self.addCleanup(event.remove, Movie, "load", listener)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            html = c.get("/movies?sort=year&order=desc").get_data(as_text=True)
+
+        self.assertIn("Test Movie", html)
+        self.assertIn('data-id="testID123"', html)
+        self.assertIn("fa-star fas", html)
+        self.assertEqual(loaded, [])
+
+
+    def test_suggest_movies(self):
+        """Does autocomplete find titles by the start of any word?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.get("/movie-search/suggest?term=mov")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn({"imdbID": "testID123", "Title": "Test Movie", "Year": "2023"},
+                          resp.json)
+
+
+    def test_search_movies_from_title_index(self):
+        """Without an API_KEY, does search answer from our own titles, typos and all?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.get("/movie-search?term=tset movie")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Test Movie", html)
+            self.assertIn("Already in My List", html)
+            self.assertIn("ml__search-results--local-note", html)
+
+
+    def test_popularity_counters(self):
+        """Do adds, favorites and deletes keep a title's popularity up to date?"""
+
+        popularity = lambda: db.session.query(Title.popularity).filter_by(imdb_id="testID123").scalar()
+
+        start = popularity()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            # testmovie is a favorite, unfavoriting takes a point away
+            c.post("/movie/testID123/favorite")
+            self.assertEqual(popularity(), start - 1)
+
+            c.delete("/movie/testID123")
+            self.assertEqual(popularity(), start - 2)
+
+
+    def test_popular_leaderboards(self):
+        """Are popular titles shown on the home and search pages?"""
+
+        other = User.signup(username="otheruser",
+                            email="other@test.com",
+                            password="otheruser",
+                            img_url='')
+        db.session.commit()
+
+        db.session.add(Movie(imdb_id="testID123", user_id=other.id, favorite=True))
+        db.session.commit()
+
+        leaderboards.clear()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            html = c.get("/").get_data(as_text=True)
+            self.assertIn("Popular this week", html)
+            self.assertIn('<a href="/movie/testID123">Test Movie</a>', html)
+
+            html = c.get("/movie-search").get_data(as_text=True)
+            self.assertIn("Popular all time", html)
+
+
+    @skipUnless(recommendations.np, "needs numpy and scipy")
+    def test_recommendations(self):
+        """Are titles saved in the same ledgers recommended, and kept up
+        with adds and deletes?"""
+
+        other = User.signup(username="otheruser",
+                            email="other@test.com",
+                            password="otheruser",
+                            img_url='')
+        db.session.commit()
+        other_id = other.id
+
+        db.session.add_all([
+            Movie(imdb_id="testID123", user_id=other_id),
+            Movie(imdb_id="testID456", user_id=other_id, title="Other Movie", year="2020",
+                  imdb_img="N/A"),
+        ])
+        db.session.commit()
+
+        recommender.load(recommendations.build(db.session.query(Movie.user_id, Movie.imdb_id)))
+        self.addCleanup(recommender.clear)
+
+        self.assertEqual(recommender.also_saved("testID123"), ["testID456"])
+        self.assertEqual(recommender.also_saved("testID456"), ["testID123"])
+
+        testuser_id = self.testuser.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            html = c.get("/movies").get_data(as_text=True)
+            self.assertIn("Recommended for you", html)
+            self.assertIn('<a href="/movie/testID456">Other Movie</a>', html)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = other_id
+
+            # the only ledger with both titles loses one
+            c.delete("/movie/testID456")
+            self.assertEqual(recommender.also_saved("testID123"), [])
+
+        # and another gets it, through the orm
+        db.session.add(Movie(imdb_id="testID456", user_id=testuser_id))
+        db.session.commit()
+
+        self.assertEqual(recommender.also_saved("testID123"), ["testID456"])
+
+        # a ledger too big to count isn't, for any of a commit's deletes
+        self.addCleanup(setattr, recommendations, "MAX_USER_TITLES",
+                        recommendations.MAX_USER_TITLES)
+        recommendations.MAX_USER_TITLES = 1
+
+        pending = dict(recommender._savers)
+        recommender.apply([(testuser_id, "testID123", -1), (testuser_id, "testID456", -1)])
+
+        self.assertEqual(recommender._savers, pending)
+        self.assertEqual(len(recommender._deleted[testuser_id]), 2)
+
+
+    @skipUnless(ledger_cache.np, "needs numpy")
+    def test_ledger_cache(self):
+        """Are sorts and filters answered from the cached ledger, in the
+        database's order, and kept up with writes?"""
+
+        for i, (title, year, viewed) in enumerate([("Alpha", "1999", date(2020, 5, 1)),
+                                                   ("Charlie", "2010", None),
+                                                   ("Bravo", "1985", date(2021, 1, 2)),
+                                                   # after every capital, whatever the
+                                                   # database's collation
+                                                   ("alpha", "2001", date(2018, 3, 3))]):
+            db.session.add(Movie(imdb_id=f"cacheID{i}", user_id=self.testuser.id,
+                                 title=title, year=year, date_viewed=viewed,
+                                 date_added=date(2022, 1, 1 + i), favorite=i == 2,
+                                 platform="hulu" if i else None, imdb_img="N/A"))
+
+        # one movie with no date viewed, ties could come back either way
+        Movie.query.filter_by(imdb_id="testID123").update({Movie.date_viewed: date(2019, 1, 1)})
+
+        User.bump_ledger_version(self.testuser.id)
+        db.session.commit()
+
+        user = User.query.get(self.testuser.id)
+        ledger = ledgers.get(user, lambda limit: ledger_query(db.session.query(*LEDGER_PAGE_COLUMNS),
+                                                              user.id, {}, "").limit(limit).all())
+
+        # every sort and filter matches the database
+        for sort in ("", "title", "year", "date_added", "date_viewed"):
+            for order in ("", " asc", " desc"):
+                for kwargs in ({}, {"favorite": True}):
+                    sort_str = sort + order if sort else ""
+                    expected = ledger_query(db.session.query(*LEDGER_PAGE_COLUMNS),
+                                            user.id, kwargs, sort_str).all()
+
+                    if not sort:
+                        expected.sort(key=lambda row: row.imdb_id)
+
+                    rows = list(ledger.rows(kwargs, sort_str))
+
+                    if not sort:
+                        rows.sort(key=lambda row: row.imdb_id)
+
+                    self.assertEqual([tuple(row) for row in rows],
+                                     [tuple(row) for row in expected], sort_str)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            # sorting a cached ledger takes just the user
+            with self.assertQueryBudget(1):
+                html = c.get("/movies?sort=title&order=desc").get_data(as_text=True)
+
+            self.assertLess(html.index("Charlie"), html.index("Bravo"))
+
+            # writes go through to the cached ledger
+            c.post("/movie/cacheID0/favorite")
+            c.delete("/movie/cacheID2")
+
+            with self.assertQueryBudget(1):
+                html = c.get("/movies?filter=favorites").get_data(as_text=True)
+
+            self.assertIn("Alpha", html)
+            self.assertNotIn("Bravo", html)
+            self.assertNotIn("Charlie", html)
+
+        # and the least recently viewed ledgers make room for others
+        self.addCleanup(setattr, ledgers, "max_rows", ledgers.max_rows)
+        ledgers.max_rows = 1
+        ledgers._store(-1, ledger_cache.Ledger.from_rows(0, []))
+        ledgers._store(-2, ledger_cache.Ledger.from_rows(0, [ledger.rows({}, "").__next__()]))
+
+        self.assertEqual(len(ledgers), 2)
+        self.assertIsNone(ledgers._ledgers.get(self.testuser.id))
+
+        # a ledger too big to keep is streamed, and not read again
+        with self.client as c:
+            with self.assertQueryBudget(3):
+                html = c.get("/movies?sort=title").get_data(as_text=True)
+
+            self.assertLess(html.index("Alpha"), html.index("Charlie"))
+            self.assertIsNone(ledgers._ledgers.get(self.testuser.id))
+
+            with self.assertQueryBudget(2):
+                html = c.get("/movies?sort=title").get_data(as_text=True)
+
+            self.assertIn("Alpha", html)
+
+
+    def test_read_replica_routing(self):
+        """Do GETs read from a replica, except just after a write or while
+        it lags behind?"""
+
+        router.configure(["sqlite://"])
+        self.addCleanup(router.configure, [])
+        self.addCleanup(setattr, router, "max_lag", router.max_lag)
+
+        # the replica has the same user, under a name that shows where
+        # the page was read from
+        replica = router.engine("sqlite://")
+        db.Model.metadata.create_all(bind=replica)
+        replica.execute(User.__table__.insert(), id=self.testuser.id, username="replicauser",
+                        email="test@test.com", password="testuser", img_url="")
+
+        router.measure()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            html = c.get("/movies").get_data(as_text=True)
+            self.assertIn("replicauser's Ledger", html)
+
+            # after a write we read our writes, from the primary
+            c.post("/movie/testID123/favorite")
+
+            html = c.get("/movies").get_data(as_text=True)
+            self.assertIn("testuser's Ledger", html)
+
+        # and a lagging replica isn't used at all
+        router.max_lag = -1
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            html = c.get("/movies").get_data(as_text=True)
+            self.assertIn("testuser's Ledger", html)
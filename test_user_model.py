@@ -13,8 +13,14 @@ from models import db, User, Movie
 # to use a different database for tests (we need to do this
 # before we import our app, since that will have already
 # connected to the database
-
-os.environ['DATABASE_URL'] = "postgresql:///movie_ledger_test"
+#
+# tests run on an in memory sqlite db, set TEST_DATABASE_URL (e.g. to
+# postgresql:///movie_ledger_test) to run them against postgres.  we
+# hash passwords with the fewest bcrypt rounds, full strength hashing
+# would be most of the run time.
+
+os.environ['DATABASE_URL'] = os.environ.get('TEST_DATABASE_URL', "sqlite://")
+os.environ['BCRYPT_LOG_ROUNDS'] = "4"
 
 
 # Now we can import app
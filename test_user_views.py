@@ -3,27 +3,46 @@
 # run these tests like:
 #    FLASK_ENV=production python -m unittest test_message_views.py
 
+import gzip
+import json
 import os
+import re
+import tempfile
 from unittest import TestCase
 
 from flask import session
 
-from models import db, connect_db, User, Movie
+from models import db, connect_db, User, Movie, UserShard
+from query_budget import QueryBudgetTestMixin
 
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
 # before we import our app, since that will have already
 # connected to the database
+#
+# tests run on an in memory sqlite db, set TEST_DATABASE_URL (e.g. to
+# postgresql:///movie_ledger_test) to run them against postgres.  we
+# hash passwords with the fewest bcrypt rounds, full strength hashing
+# would be most of the run time.
 
-os.environ['DATABASE_URL'] = "postgresql:///movie_ledger_test"
+os.environ['DATABASE_URL'] = os.environ.get('TEST_DATABASE_URL', "sqlite://")
+os.environ['BCRYPT_LOG_ROUNDS'] = "4"
 
 
 # Now we can import app
 
 from app import app, CURR_USER_KEY
+from popularity import leaderboards
+import shards
+from shards import shard_map
+from traffic_capture import traffic_log
 
 
+# flask-sqlalchemy makes a new engine (so a new, empty in memory db)
+# if SQLALCHEMY_ECHO changes, so set it before creating our tables
+app.config['SQLALCHEMY_ECHO'] = False
+
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
 # and create fresh new clean test data
@@ -37,7 +56,10 @@ db.create_all()
 
 app.config['TESTING'] = True
 app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
-app.config['SQLALCHEMY_ECHO'] = False
+
+# fail any request that goes over its view's query budget or looks like
+# an N+1 (see query_budget.py)
+app.config['QUERY_BUDGET_RAISE'] = True
 
 # Don't have WTForms use CSRF at all, since it's a pain to test
 
@@ -47,7 +69,7 @@ app.config['WTF_CSRF_ENABLED'] = False
 ################################################################################
 # tests
 
-class UserViewTestCase(TestCase):
+class UserViewTestCase(QueryBudgetTestMixin, TestCase):
     """Test views for users."""
 
     def setUp(self):
@@ -272,3 +294,172 @@ class UserViewTestCase(TestCase):
             # check that we are redirected to the edit profile page
             self.assertEqual(resp.status_code, 302)
 
+
+
+    def test_static_asset_fingerprinted(self):
+        """Are static files linked by content hash and cached for good?"""
+        with app.test_client() as client:
+            html = client.get('/').get_data(as_text=True)
+
+            # our stylesheet is linked with its fingerprint
+            url = re.search(r'href="(/static/css/index\.[0-9a-f]{12}\.css)"', html).group(1)
+
+            resp = client.get(url)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("immutable", resp.headers["Cache-Control"])
+            self.assertIn("max-age=31536000", resp.headers["Cache-Control"])
+
+
+    def test_html_compressed(self):
+        """Are pages gzipped for clients that accept it?"""
+        with app.test_client() as client:
+            resp = client.get('/', headers={"Accept-Encoding": "gzip"})
+
+            self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+            self.assertIn("Welcome to", gzip.decompress(resp.data).decode("utf8"))
+
+
+    def test_traffic_capture(self):
+        """Are requests recorded for replay, without passwords or user ids?"""
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "capture.ndjson")
+            traffic_log.configure(path, salt="test-salt")
+            user_key = traffic_log.user_key(self.testuser.id)
+
+            try:
+                with app.test_client() as client:
+                    client.post('/login', data={'username': 'testuser', 'password': 'password'})
+                    client.get('/movies?sort=title&order=asc').get_data()
+                    client.get('/static/css/index.css')
+
+            finally:
+                traffic_log.configure(None)
+
+            with open(path) as f:
+                records = [json.loads(line) for line in f]
+
+        login, movies = records
+
+        self.assertEqual(login["endpoint"], "login")
+        self.assertEqual(login["form"], {})
+        self.assertNotIn("password", json.dumps(records))
+
+        self.assertEqual(movies["endpoint"], "show_my_movies")
+        self.assertEqual(movies["args"], {"sort": ["title"], "order": ["asc"]})
+        self.assertEqual(movies["status"], 200)
+        self.assertIn("ms", movies)
+
+        # the same stand in for all of a user's requests, that isn't their id
+        self.assertEqual(movies["user"], user_key)
+        self.assertNotEqual(movies["user"], str(self.testuser.id))
+
+
+    def test_delete_user_query_budget(self):
+        """Are a user's movies deleted without loading them one by one?"""
+
+        for i in range(5):
+            db.session.add(Movie(
+                imdb_id=f"budget{i}",
+                user_id=self.testuser.id,
+                title=f"Budget Movie {i}",
+                year="2023",
+                imdb_img='http://www.test-url.com/test-directory/static/images/test.jpg'
+            ))
+
+        db.session.commit()
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            # the user, authenticate, the movies' points, the movies, the
+            # popularity counters (titles and buckets), then the user again
+            with self.assertQueryBudget(7):
+                resp = client.post('/profile/delete', data={"password": "password"})
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(Movie.query.filter_by(user_id=self.testuser.id).count(), 0)
+
+
+    def test_sharded_users(self):
+        """Do users live in the shard the shard map gives them, and still
+        get their ledger after being moved to another?"""
+
+        shard_map.configure(["sqlite://"])
+        self.addCleanup(shard_map.configure, [])
+        self.addCleanup(leaderboards.clear)
+        self.addCleanup(lambda: (UserShard.query.delete(), db.session.commit()))
+
+        with app.app_context():
+            shards.create_tables()
+            shards.init_map()
+            db.session.commit()
+
+        for username in ("sharded1", "sharded2"):
+            resp = app.test_client().post('/signup', data={
+                'username': username, 'password': 'password',
+                'email': 'sharded@test.com', 'img_url': ''})
+            self.assertEqual(resp.status_code, 302)
+
+        # usernames are unique across the shards
+        resp = app.test_client().post('/signup', data={
+            'username': 'sharded1', 'password': 'password',
+            'email': 'sharded@test.com', 'img_url': ''})
+        self.assertIn("Username already taken", resp.get_data(as_text=True))
+
+        placed = {entry.shard: (entry.user_id, entry.username)
+                  for entry in UserShard.query.filter(UserShard.username.like("sharded%"))}
+        self.assertEqual(set(placed), {"main", "shard1"})
+
+        # each user is only in their own shard, with a ledger there
+        with app.app_context():
+            for name, (user_id, _) in placed.items():
+                for other in shard_map.names:
+                    with shards.on_shard(other):
+                        self.assertEqual(User.query.get(user_id) is not None, other == name)
+
+                with shards.on_shard(name):
+                    db.session.add(Movie(imdb_id="shardID1", user_id=user_id, favorite=True,
+                                         title="Shard Movie", year="2023",
+                                         imdb_img='http://www.test-url.com/shard.jpg'))
+                    db.session.commit()
+
+        # the leaderboards add up the shards' points
+        with app.app_context():
+            leaderboards.clear()
+            top = leaderboards.get()["all_time"]
+            self.assertIn(("shardID1", 4), [(entry.imdb_id, entry.points) for entry in top])
+
+        user_id, username = placed["shard1"]
+
+        with app.test_client() as client:
+            resp = client.post('/login', data={'username': username, 'password': 'password'},
+                               follow_redirects=True)
+            html = resp.get_data(as_text=True)
+
+            self.assertIn(f"{username}'s Ledger", html)
+            self.assertIn("Shard Movie", html)
+            self.assertEqual(session["curr_shard"], "shard1")
+
+            # rebalance them onto the main database
+            with app.app_context():
+                self.assertEqual(shards.move_user(user_id, "main"), 1)
+
+                with shards.on_shard("shard1"):
+                    self.assertIsNone(User.query.get(user_id))
+                    self.assertEqual(Movie.query.filter_by(user_id=user_id).count(), 0)
+
+            self.assertEqual(UserShard.query.get(user_id).shard, "main")
+
+            # their cookie still says shard1, finding them costs a look
+            # at the shard map
+            app.config['QUERY_BUDGET_RAISE'] = False
+            self.addCleanup(app.config.__setitem__, 'QUERY_BUDGET_RAISE', True)
+
+            html = client.get('/movies').get_data(as_text=True)
+
+            self.assertIn(f"{username}'s Ledger", html)
+            self.assertIn("Shard Movie", html)
+            self.assertEqual(session["curr_shard"], "main")
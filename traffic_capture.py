@@ -0,0 +1,202 @@
+"""Record real traffic, to replay it later (see replay_traffic.py).
+
+Benchmarks (bench_routes.py, bench_serving.py) drive the routes we
+thought of, with the search terms and ledgers we made up.  To load a
+staging build the way production is loaded, set TRAFFIC_CAPTURE_FILE
+and each worker appends a line of JSON per request to it:
+
+    {"at": 1760000000.123, "method": "GET", "endpoint": "movie_search",
+     "path": "/movie-search", "args": {"term": ["alien"], "page": ["2"]},
+     "user": "9f86d081884c7d65", "status": 200, "ms": 182.4}
+
+TRAFFIC_CAPTURE_RATE of requests (1 for all of them) are recorded.
+Nothing in a record says who a user is:
+
+- users are a keyed hash of their id ("user"), the same for all of a
+  user's requests, so a replay can give each one their own stand-in.
+  The key is TRAFFIC_CAPTURE_SALT, so hashes can't be matched to ids
+  without it.
+- fields named like passwords, emails, usernames or tokens (query
+  string, form or JSON) are left out, and long values cut short.
+- uploads only say that there were files ("files": true).
+
+Static files, /metrics and /admin aren't recorded.  Streamed pages are
+recorded (and timed) once their body has been sent.
+"""
+
+import hashlib
+import hmac
+import json
+import os
+import random
+import time
+from threading import Lock
+
+from flask import g, request
+from sqlalchemy import inspect
+
+from streaming import after_stream
+
+
+# fields whose values are never recorded
+SECRET_FIELDS = ("password", "email", "username", "token", "csrf", "secret")
+
+# longest value recorded, in characters
+MAX_VALUE_LENGTH = 200
+
+# requests that aren't worth recording
+SKIPPED_PATHS = ("/static/", "/metrics", "/admin/")
+
+
+def sanitized(fields):
+    """A dict of field lists (or a JSON object) without secrets, and with
+    long values cut short.
+    """
+
+    def value(v):
+        if isinstance(v, str) and len(v) > MAX_VALUE_LENGTH:
+            return v[:MAX_VALUE_LENGTH]
+
+        if isinstance(v, (list, tuple)):
+            return [value(item) for item in v]
+
+        if isinstance(v, dict):
+            return sanitized(v)
+
+        return v
+
+    return {name: value(v) for name, v in fields.items()
+            if not any(secret in name.lower() for secret in SECRET_FIELDS)}
+
+
+class TrafficLog:
+    """Appends request records to a file, one JSON object per line."""
+
+    def __init__(self):
+        self.path = None
+        self.rate = 1.0
+        self.salt = b""
+        self._file = None
+        self._pid = None
+        self._lock = Lock()
+
+    def configure(self, path, rate=1.0, salt=""):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+
+            self.path = path
+            self.rate = rate
+            self.salt = salt.encode("utf8") if isinstance(salt, str) else salt
+            self._file = None
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def user_key(self, user_id):
+        """The stand-in for a user id in the records."""
+
+        if user_id is None:
+            return None
+
+        return hmac.new(self.salt, str(user_id).encode("utf8"), hashlib.sha256).hexdigest()[:16]
+
+    def write(self, record):
+        line = json.dumps(record, default=str) + "\n"
+
+        with self._lock:
+            # every worker opens the file for itself (gunicorn forks after
+            # preloading the app), appends of whole lines don't interleave
+            if self._file is None or self._pid != os.getpid():
+                self._file = open(self.path, "a", buffering=1, encoding="utf8")
+                self._pid = os.getpid()
+
+            self._file.write(line)
+
+
+traffic_log = TrafficLog()
+
+
+def _user_id():
+    """The request's user's id, without loading anything."""
+
+    user = g.get("user")
+
+    if user is None:
+        return None
+
+    identity = inspect(user).identity
+
+    return identity[0] if identity else None
+
+
+def record_request(response, start, user):
+    """The record of the current request, sent as response, for user (a
+    user_key()).
+    """
+
+    record = {
+        "at": round(time.time() - (time.perf_counter() - start), 3),
+        "method": request.method,
+        "endpoint": request.endpoint,
+        "path": request.path,
+        "args": sanitized(request.args.to_dict(flat=False)),
+        "user": user,
+        "status": response.status_code,
+    }
+
+    if request.form:
+        record["form"] = sanitized(request.form.to_dict(flat=False))
+
+    if request.is_json:
+        body = request.get_json(silent=True)
+        record["json"] = sanitized(body) if isinstance(body, dict) else body
+
+    if request.files:
+        record["files"] = True
+
+    return record
+
+
+###############################################################################
+# flask setup
+
+def init_app(app):
+    """Record TRAFFIC_CAPTURE_RATE of requests to TRAFFIC_CAPTURE_FILE."""
+
+    app.config.setdefault("TRAFFIC_CAPTURE_FILE", None)
+    app.config.setdefault("TRAFFIC_CAPTURE_RATE", 1.0)
+    app.config.setdefault("TRAFFIC_CAPTURE_SALT", app.config.get("SECRET_KEY") or "")
+
+    traffic_log.configure(app.config["TRAFFIC_CAPTURE_FILE"],
+                          rate=app.config["TRAFFIC_CAPTURE_RATE"],
+                          salt=app.config["TRAFFIC_CAPTURE_SALT"])
+
+    @app.before_request
+    def start_capture():
+        if (not traffic_log.enabled or request.path.startswith(SKIPPED_PATHS)
+                or random.random() >= traffic_log.rate):
+            return
+
+        g.capture_start = time.perf_counter()
+
+    @app.after_request
+    def finish_capture(response):
+        start = g.pop("capture_start", None)
+
+        if start is None:
+            return response
+
+        record = record_request(response, start, traffic_log.user_key(_user_id()))
+
+        def finish():
+            record["ms"] = round((time.perf_counter() - start) * 1000, 2)
+            traffic_log.write(record)
+
+        if response.is_streamed:
+            after_stream(response, finish)
+        else:
+            finish()
+
+        return response